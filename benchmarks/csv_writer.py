@@ -0,0 +1,47 @@
+"""Micro benchmark of the CSV writers for API responses
+
+Usage:
+    python benchmarks/csv_writer.py [number of rows]
+"""
+
+import io
+import sys
+import time
+
+from mara_google_analytics_downloader.__main__ import write_ga_response_as_csv_to_stream, \
+    write_mcf_response_as_csv_to_stream
+
+
+def ga_response(n_rows: int) -> dict:
+    return {'reports': [{
+        'columnHeader': {'dimensions': ['ga:date', 'ga:landingPagePath'],
+                         'metricHeader': {'metricHeaderEntries': [{'name': 'ga:sessions', 'type': 'INTEGER'},
+                                                                  {'name': 'ga:users', 'type': 'INTEGER'},
+                                                                  {'name': 'ga:bounceRate', 'type': 'PERCENT'}]}},
+        'data': {'rows': [{'dimensions': ['20200101', f'/page/{i}'],
+                           'metrics': [{'values': [str(i), str(i // 2), '12.5']}]}
+                          for i in range(n_rows)]}}]}
+
+
+def mcf_response(n_rows: int) -> dict:
+    return {'columnHeaders': [{'name': 'mcf:conversionDate', 'dataType': 'STRING'},
+                              {'name': 'mcf:basicChannelGroupingPath', 'dataType': 'MCF_SEQUENCE'},
+                              {'name': 'mcf:totalConversions', 'dataType': 'INTEGER'}],
+            'rows': [[{'primitiveValue': '20200101'},
+                      {'conversionPathValue': [{'interactionType': 'CLICK', 'nodeValue': 'Direct'}]},
+                      {'primitiveValue': str(i)}]
+                     for i in range(n_rows)]}
+
+
+def measure(name: str, write, response, n_rows: int):
+    stream = io.StringIO()
+    start = time.perf_counter()
+    write(response, stream=stream, view_id='12345', write_header=False)
+    seconds = time.perf_counter() - start
+    print(f'{name:<5} {n_rows:>9} rows  {seconds:7.3f} s  {n_rows / seconds:>12,.0f} rows/s')
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    measure('ga', write_ga_response_as_csv_to_stream, ga_response(n_rows), n_rows)
+    measure('mcf', write_mcf_response_as_csv_to_stream, mcf_response(n_rows), n_rows)
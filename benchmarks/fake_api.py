@@ -0,0 +1,280 @@
+"""A local fake of the Reporting API V4 and the Multi-Channel Funnels API
+
+Answers `v4/reports:batchGet` and `analytics/v3/data/mcf` requests with generated rows, and `token` requests with
+an access token, so that the downloader can be benchmarked without a Google Analytics view:
+
+    with FakeApiServer(rows=100000, latency=0.05) as server:
+        subprocess.run(['mara-google-analytics-downloader', '--api-root-url', server.url,
+                        '--token-uri', server.token_uri, ...])
+
+The rows of a query do not depend on its page size, so that downloads with different page sizes, shards or engines
+can be compared. Rows are spread over the days of the date range when `ga:date` (or `mcf:conversionDate`) is
+requested. A share of the requests can fail with 503 backendError or 429 rateLimitExceeded errors.
+
+Also runs standalone (`--port 0` for a free port), then `GET /stats` returns the number of requests:
+    python benchmarks/fake_api.py --port 8080 --rows 100000 --latency 0.05
+"""
+
+import argparse
+import datetime
+import gzip
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import typing as t
+import urllib.parse
+
+from mara_google_analytics_downloader.date_ranges import resolve_date
+
+
+class FakeApiServer:
+    def __init__(self,
+                 rows: int = 1000,
+                 max_page_size: int = 100000,
+                 latency: float = 0.0,
+                 latency_per_1000_rows: float = 0.0,
+                 error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0,
+                 sampled: bool = False,
+                 unsampled_days: int = 0,
+                 seed: int = 0,
+                 port: int = 0) -> None:
+        """
+        A fake API server in a background thread, use it as context manager
+
+        Args:
+            rows: the number of rows of each report request and MCF query
+            max_page_size: the maximum number of rows per page, also when a client asks for more
+            latency: the seconds before each response
+            latency_per_1000_rows: additional seconds per 1000 rows of a page
+            error_rate: the share of the requests which fail with 503 backendError
+            rate_limit_rate: the share of the requests which fail with 429 rateLimitExceeded
+            sampled: if the responses report sampled data
+            unsampled_days: with sampled, Reporting API V4 date ranges of up to this many days are not sampled
+            seed: the seed of the failures
+            port: the port to listen on, 0 for a free port
+        """
+        self.rows = rows
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.latency_per_1000_rows = latency_per_1000_rows
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.sampled = sampled
+        self.unsampled_days = unsampled_days
+        self.port = port
+        self.requests = 0
+        self.failed_requests = 0
+        self.requests_in_flight = 0
+        self.max_requests_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        """The root url of the APIs, see `--api-root-url`"""
+        return f'http://127.0.0.1:{self._server.server_address[1]}/'
+
+    @property
+    def token_uri(self) -> str:
+        """The url of the token endpoint, see `--token-uri`"""
+        return self.url + 'token'
+
+    def start(self) -> 'FakeApiServer':
+        fake = self
+
+        class Handler(_Handler):
+            server_api = fake
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'FakeApiServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def failure(self) -> t.Optional[t.Tuple[int, str]]:
+        """Counts a request and returns the status and reason if it should fail"""
+        with self._lock:
+            self.requests += 1
+            value = self._random.random()
+            if value < self.rate_limit_rate:
+                failure = (429, 'rateLimitExceeded')
+            elif value < self.rate_limit_rate + self.error_rate:
+                failure = (503, 'backendError')
+            else:
+                return None
+            self.failed_requests += 1
+            return failure
+
+    def batch_get(self, body: dict) -> t.Tuple[dict, int]:
+        """The response of a batchGet request and its number of rows"""
+        reports, nrows = [], 0
+        for report_request in body['reportRequests']:
+            date_ranges = report_request['dateRanges']
+            dimensions = [dimension['name'] for dimension in report_request.get('dimensions', [])]
+            metrics = [metric['expression'] for metric in report_request['metrics']]
+            days = _days(date_ranges[0]['startDate'], date_ranges[0]['endDate'])
+            start = int(report_request.get('pageToken') or 0)
+            end = min(self.rows, start + min(int(report_request.get('pageSize', 1000)), self.max_page_size))
+
+            report = {
+                'columnHeader': {
+                    'dimensions': dimensions,
+                    'metricHeader': {'metricHeaderEntries': [{'name': metric, 'type': 'INTEGER'}
+                                                             for metric in metrics]}},
+                'data': {'rows': [{'dimensions': [days[i % len(days)] if dimension == 'ga:date'
+                                                  else f'{dimension[3:]} {i}' for dimension in dimensions],
+                                   'metrics': [{'values': [str(i + k) for k in range(len(metrics))]}
+                                               for _ in date_ranges]}
+                                  for i in range(start, end)],
+                         'rowCount': self.rows,
+                         'isDataGolden': True}}
+            if self.sampled and len(days) > self.unsampled_days:
+                report['data']['samplesReadCounts'] = ['1000'] * len(date_ranges)
+                report['data']['samplingSpaceSizes'] = ['10000'] * len(date_ranges)
+            if end < self.rows:
+                report['nextPageToken'] = str(end)
+            reports.append(report)
+            nrows += end - start
+        return {'reports': reports}, nrows
+
+    def mcf(self, query: dict) -> t.Tuple[dict, int]:
+        """The response of a Multi-Channel Funnels API request and its number of rows"""
+        dimensions = query['dimensions'].split(',') if query.get('dimensions') else []
+        metrics = query['metrics'].split(',')
+        days = _days(query['start-date'], query['end-date'])
+        page_size = min(int(query.get('max-results', 1000)), self.max_page_size)
+        start = int(query.get('start-index', 1)) - 1
+        end = min(self.rows, start + page_size)
+
+        response = {
+            'columnHeaders': [{'name': name, 'columnType': 'DIMENSION', 'dataType': 'STRING'} for name in dimensions]
+                             + [{'name': name, 'columnType': 'METRIC', 'dataType': 'INTEGER'} for name in metrics],
+            'rows': [[{'primitiveValue': days[i % len(days)] if dimension == 'mcf:conversionDate'
+                       else f'{dimension[4:]} {i}'} for dimension in dimensions]
+                     + [{'primitiveValue': str(i + k)} for k in range(len(metrics))]
+                     for i in range(start, end)],
+            'totalResults': self.rows,
+            'itemsPerPage': page_size,
+            'containsSampledData': self.sampled}
+        if end < self.rows:
+            response['nextLink'] = 'next'
+        return response, end - start
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_api: FakeApiServer = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/token':
+            self._send({'access_token': 'fake', 'token_type': 'Bearer', 'expires_in': 3600})
+        elif path == '/v4/reports:batchGet':
+            self._answer(lambda: self.server_api.batch_get(json.loads(body.decode('utf-8'))))
+        else:
+            self._send_error(404, 'notFound')
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/stats':
+            self._send({'requests': self.server_api.requests, 'failed_requests': self.server_api.failed_requests,
+                        'max_requests_in_flight': self.server_api.max_requests_in_flight})
+        elif url.path == '/analytics/v3/data/mcf':
+            query = {name: values[0] for name, values in urllib.parse.parse_qs(url.query).items()}
+            self._answer(lambda: self.server_api.mcf(query))
+        else:
+            self._send_error(404, 'notFound')
+
+    def _answer(self, respond: t.Callable[[], t.Tuple[dict, int]]):
+        api = self.server_api
+        with api._lock:
+            api.requests_in_flight += 1
+            api.max_requests_in_flight = max(api.max_requests_in_flight, api.requests_in_flight)
+        try:
+            self._answer_request(respond)
+        finally:
+            with api._lock:
+                api.requests_in_flight -= 1
+
+    def _answer_request(self, respond: t.Callable[[], t.Tuple[dict, int]]):
+        api = self.server_api
+        failure = api.failure()
+        if failure:
+            time.sleep(api.latency)
+            self._send_error(*failure)
+            return
+        try:
+            response, nrows = respond()
+        except (KeyError, ValueError) as e:
+            self._send_error(400, 'badRequest', repr(e))
+            return
+        time.sleep(api.latency + api.latency_per_1000_rows * nrows / 1000)
+        self._send(response)
+
+    def _send_error(self, status: int, reason: str, message: str = None):
+        self._send({'error': {'code': status, 'message': message or reason,
+                              'errors': [{'reason': reason, 'message': message or reason}]}}, status)
+
+    def _send(self, response: dict, status: int = 200):
+        content = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _days(start_date: str, end_date: str) -> t.List[str]:
+    """The days of a date range in the format of ga:date"""
+    start, end = resolve_date(start_date), resolve_date(end_date)
+    return [(start + datetime.timedelta(days=day)).strftime('%Y%m%d') for day in range((end - start).days + 1)] \
+           or [start.strftime('%Y%m%d')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A local fake of the Reporting API V4 and the Multi-Channel '
+                                                 'Funnels API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rows', type=int, default=1000, help='rows per report request and MCF query')
+    parser.add_argument('--max-page-size', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response')
+    parser.add_argument('--latency-per-1000-rows', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 backendError responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of 429 rateLimitExceeded responses')
+    parser.add_argument('--sampled', action='store_true')
+    parser.add_argument('--unsampled-days', type=int, default=0,
+                        help='with --sampled, date ranges of up to this many days are not sampled')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the failures')
+    arguments = parser.parse_args()
+
+    server = FakeApiServer(**vars(arguments)).start()
+    print(f'Serving on {server.url}, use --api-root-url={server.url} --token-uri={server.token_uri}', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
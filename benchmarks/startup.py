@@ -0,0 +1,56 @@
+"""Startup benchmark of the downloader CLI
+
+Measures the time of `python -m mara_google_analytics_downloader --help` and checks that importing the CLI does
+not import modules which are only needed once a download runs (the Google API client, the metric and dimension
+catalogue, sqlite3, ...). Exits with 1 when such a module is imported or the median startup time exceeds the
+given limit.
+
+Usage:
+    python benchmarks/startup.py [number of runs] [max median milliseconds]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+DEFERRED_MODULES = ['googleapiclient', 'oauth2client', 'httplib2', 'http.client', 'urllib.request', 'sqlite3',
+                    'concurrent.futures', 'hashlib', 'mara_google_analytics_downloader.static', 'pyarrow', 'ijson',
+                    'asyncio', 'aiohttp']
+"""Modules which must not be imported at startup"""
+
+
+def imported_deferred_modules() -> list:
+    code = ('import sys, mara_google_analytics_downloader.__main__; '
+            f'print(" ".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))')
+    return subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout.split()
+
+
+def startup_seconds(n_runs: int) -> list:
+    seconds = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'mara_google_analytics_downloader', '--help'], check=True,
+                       stdout=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+if __name__ == '__main__':
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    max_milliseconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    seconds = startup_seconds(n_runs)
+    median = statistics.median(seconds) * 1000
+    print(f'--help {n_runs:>4} runs  median {median:7.1f} ms  min {min(seconds) * 1000:7.1f} ms')
+
+    failed = False
+    modules = imported_deferred_modules()
+    if modules:
+        print(f'imported at startup: {", ".join(modules)}')
+        failed = True
+    if max_milliseconds is not None and median > max_milliseconds:
+        print(f'median startup time exceeds {max_milliseconds} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
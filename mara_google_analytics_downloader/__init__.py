@@ -5,4 +5,5 @@ def MARA_CONFIG_MODULES():
 def MARA_CLICK_COMMANDS():
     from mara_google_analytics_downloader.__main__ import ga_download_to_csv
     from mara_google_analytics_downloader.user_credential_helper import generate_user_refresh_token
-    return [ga_download_to_csv, generate_user_refresh_token]
+    from mara_google_analytics_downloader.worker import ga_download_worker
+    return [ga_download_to_csv, generate_user_refresh_token, ga_download_worker]
@@ -8,16 +8,38 @@ Mainly to be used with mara to import a Google Analytics to a database table.
 """
 
 import click
+import datetime
+import io
+import itertools
+import os
 import sys
-import random
 import typing as t
 import time
 
-from apiclient.discovery import build
-
 from mara_google_analytics_downloader import config as c
+from mara_google_analytics_downloader.checkpoint import Checkpoint, query_fingerprint
+from mara_google_analytics_downloader.columnar import ColumnarWriter, ga_columns, mcf_columns, OUTPUT_FORMATS, \
+    is_available as columnar_is_available
+from mara_google_analytics_downloader.date_ranges import resolve_date, split_date_range, DATE_RANGE_LAYOUTS, \
+    COMPARE_COLUMN_SUFFIX
 from mara_google_analytics_downloader.filter_parsing import ga_parse_filter
-
+from mara_google_analytics_downloader.parallel import ordered_map, submit_in_context
+from mara_google_analytics_downloader.rate_limiting import configure_rate_limiter, rate_limiter
+from mara_google_analytics_downloader.reporting import iter_report_pages, batch_report_requests, join_reports, \
+    metric_groups, MAX_METRICS_PER_REQUEST, MAX_DIMENSIONS_PER_REQUEST
+from mara_google_analytics_downloader.response_cache import cache_key, configure_response_cache, response_cache, \
+    ga_cache_key
+from mara_google_analytics_downloader.retry import RetryPolicy, is_rate_limit_error
+from mara_google_analytics_downloader.services import analytics_reporting_service, analytics_service, \
+    api_root_url, configure_api_root_url
+from mara_google_analytics_downloader.telemetry import configure_telemetry, telemetry
+from mara_google_analytics_downloader.token_cache import cache_credentials
+from mara_google_analytics_downloader.streaming import execute_streaming, GA_ROWS_PREFIX, MCF_ROWS_PREFIX, \
+    is_available as streaming_is_available
+
+ENGINES = ['threads', 'asyncio']
+"""How the requests are sent: with google-api-python-client from threads or from an asyncio event loop, see the
+module `async_engine`"""
 
 
 def detect_api(metrics: t.List[str], dimensions: t.List[str]) -> str:
@@ -54,12 +76,26 @@ def detect_api(metrics: t.List[str], dimensions: t.List[str]) -> str:
 
 
 @click.command()
-@click.option('--view-id', help='Google Analytics View ID',
+@click.option('--view-id', help='Google Analytics View ID, or a comma-separated list of view ids which are '
+                                'downloaded concurrently',
               required=True)
 @click.option('--start-date', help='The start of a date range, e.g. 30daysAgo, 7daysAgo, today etc.',
               required=True)
 @click.option('--end-date', help='The end of a date range, e.g. 30daysAgo, 7daysAgo, today etc.',
               required=True)
+@click.option('--compare-start-date', help='Reporting API V4 only: the start of a second date range which is '
+                                           'requested together with the first one, e.g. 60daysAgo.',
+              required=False)
+@click.option('--compare-end-date', help='Reporting API V4 only: the end of the second date range.',
+              required=False)
+@click.option('--date-range-layout', help='How the metrics of two date ranges are written: "rows" writes one row per '
+                                          'date range with the index of the date range (0 or 1) as first column '
+                                          '(after the view id), "columns" writes the metrics of the second date range '
+                                          'after the metrics of the first one.',
+              type=click.Choice(DATE_RANGE_LAYOUTS),
+              default='rows',
+              show_default=True,
+              required=False)
 @click.option('--dimensions', help='A comma-separated list of dimensions to be used in the request',
               required=False)
 @click.option('--metrics', help='A comma-separated list of metrics to be used in the request',
@@ -80,6 +116,96 @@ def detect_api(metrics: t.List[str], dimensions: t.List[str]) -> str:
               required=False)
 @click.option('--user-account-refresh-token', help='User Account refresh_token',
               required=False)
+@click.option('--page-size', help='The maximum number of rows requested per page from the Reporting API V4.',
+              type=click.IntRange(1, 100000),
+              default=10000,
+              show_default=True,
+              required=False)
+@click.option('--shard-by', help='Splits the date range into day, week or month shards which are downloaded '
+                                 'concurrently. Only use this when the metrics can be summed up over the shards, '
+                                 'e.g. when a date dimension is requested.',
+              type=click.Choice(['day', 'week', 'month']),
+              required=False)
+@click.option('--max-workers', help='The maximum number of views and shards downloaded concurrently (with '
+                                    '--split-sampled, of requests in flight). With --engine asyncio, also '
+                                    'hundreds are possible.',
+              type=click.IntRange(1, 1024),
+              default=4,
+              show_default=True,
+              required=False)
+@click.option('--requests-per-second', help='The maximum number of requests per second for all views. No limit by '
+                                            'default.',
+              type=float,
+              required=False)
+@click.option('--requests-per-second-per-view', help='The maximum number of requests per second for a single view. '
+                                                     'No limit by default. The concurrent requests of a view are '
+                                                     'bounded by --max-workers and --page-workers.',
+              type=float,
+              required=False)
+@click.option('--rate-limit-state-file', help='A SQLite file to share the rate limits with other downloader processes.',
+              required=False)
+@click.option('--worker-socket', help='The Unix socket of a running downloader worker which runs the download, see '
+                                      'mara-google-analytics-downloader-worker. The worker uses its own rate limits and '
+                                      'caches. If the worker is not running, the download runs in this process.',
+              required=False)
+@click.option('--token-cache-file', help='A file in which the access token is shared with other downloader processes.',
+              required=False)
+@click.option('--api-root-url', help='Send the requests to another root url than the one of the Google APIs, e.g. '
+                                     'to a local fake server for benchmarks (see benchmarks/fake_api.py).',
+              required=False)
+@click.option('--token-uri', help='Request the access tokens from another url than the Google OAuth 2.0 endpoint.',
+              required=False)
+@click.option('--response-cache-file', help='A SQLite file in which the received pages are cached. Pages of '
+                                            'historical dates are taken from the cache in later runs. Not used with '
+                                            '--streaming.',
+              required=False)
+@click.option('--telemetry-json-lines/--no-telemetry-json-lines',
+              help='Write a JSON line with the latency, bytes, rows, retries and backoff time of each request and the '
+                   'totals of the download to stderr.',
+              default=False,
+              required=False)
+@click.option('--prometheus-textfile', help='A file to which the totals of the download are written in the Prometheus '
+                                            'text format, e.g. for the textfile collector of node_exporter. '
+                                            'Default: ga_downloader_<view ids>.prom in the directory of the config '
+                                            'ga_telemetry_prometheus_dir, if set.',
+              required=False)
+@click.option('--checkpoint-dir', help='Multi-Channel Funnels API only: a directory where the pages are spooled and a '
+                                       'checkpoint is recorded after each page. The output is written when the '
+                                       'download is complete.',
+              required=False)
+@click.option('--resume/--no-resume', help='Continue a failed download from its checkpoint in --checkpoint-dir.',
+              default=False,
+              required=False)
+@click.option('--page-workers', help='Multi-Channel Funnels API only: the maximum number of pages downloaded '
+                                     'concurrently.',
+              type=click.IntRange(1, 32),
+              default=1,
+              show_default=True,
+              required=False)
+@click.option('--streaming/--no-streaming', help='Decode the responses incrementally while they are received, so '
+                                                'memory does not grow with the page size. Needs the package ijson.',
+              default=False,
+              required=False)
+@click.option('--split-sampled/--no-split-sampled', help='Reporting API V4 only: split the date range while the '
+                                                        'responses are sampled, down to single days. Only use this '
+                                                        'when the metrics can be summed up over the date ranges.',
+              default=False,
+              required=False)
+@click.option('--engine', help='How the requests are sent: from threads or from an asyncio event loop, which needs '
+                               'the package aiohttp and can not be combined with --checkpoint-dir, --streaming and '
+                               '--split-sampled.',
+              type=click.Choice(ENGINES),
+              default='threads',
+              show_default=True,
+              required=False)
+@click.option('--output-format', help='The format of the output. Parquet and Arrow IPC files need the package pyarrow '
+                                      'and an --output-path.',
+              type=click.Choice(['csv'] + list(OUTPUT_FORMATS)),
+              default='csv',
+              show_default=True,
+              required=False)
+@click.option('--output-path', help='A file to write the output to instead of stdout.',
+              required=False)
 @click.option('--delimiter-char', help='A character that delimits the output fields.',
               default='\t',
               show_default="\\t",
@@ -107,13 +233,51 @@ def ga_download_to_csv(view_id: int,
                        user_account_client_id: str = None,
                        user_account_client_secret: str = None,
                        user_account_refresh_token: str = None,
-                       fail_on_no_data: bool = True
+                       fail_on_no_data: bool = True,
+                       page_size: int = 10000,
+                       shard_by: str = None,
+                       max_workers: int = 4,
+                       requests_per_second: float = None,
+                       requests_per_second_per_view: float = None,
+                       rate_limit_state_file: str = None,
+                       checkpoint_dir: str = None,
+                       resume: bool = False,
+                       page_workers: int = 1,
+                       streaming: bool = False,
+                       output_format: str = 'csv',
+                       output_path: str = None,
+                       response_cache_file: str = None,
+                       split_sampled: bool = False,
+                       token_cache_file: str = None,
+                       worker_socket: str = None,
+                       compare_start_date: str = None,
+                       compare_end_date: str = None,
+                       date_range_layout: str = 'rows',
+                       engine: str = 'threads',
+                       telemetry_json_lines: bool = False,
+                       prometheus_textfile: str = None,
+                       api_root_url: str = None,
+                       token_uri: str = None
                        ):
     """Download google analytics data as CSV to stdout
 
     Needs google credentials, either from a service account or from a user account.
 
     The csv is formatted as csv.excel dialect suitable for e.g. CSV loads into DBs. No header is written.
+
+    Paged responses are followed until the last page; each page is written to stdout as soon as it arrives.
+    With --shard-by, the date range is split into shards which are downloaded concurrently. The shards are
+    written to stdout in the order of the date range. Several view ids are downloaded concurrently as well and
+    written in the given order, use --add-view-id-column to tell them apart.
+
+    With --compare-start-date and --compare-end-date, a second date range is requested in the same requests, e.g.
+    for period-over-period comparisons, see --date-range-layout.
+
+    With --output-format parquet or arrow-ipc, a file with typed columns and a header is written to --output-path
+    instead.
+
+    With --telemetry-json-lines and --prometheus-textfile, the latency, size, retries and sampling of the requests
+    are reported, see the module `telemetry`. Not when the download runs in a worker.
     """
     if not view_id:
         raise RuntimeError("Need a view_id")
@@ -124,10 +288,1050 @@ def ga_download_to_csv(view_id: int,
     if not metrics:
         raise RuntimeError("Need metrics")
 
+    if checkpoint_dir and detect_api(metrics.split(','), dimensions.split(',') if dimensions else []) != 'mcf':
+        raise click.UsageError('--checkpoint-dir is only supported for the Multi-Channel Funnels API')
+    if streaming and not streaming_is_available():
+        raise click.UsageError('--streaming needs the package ijson, install it with `pip install ijson`')
+    if streaming and page_workers > 1:
+        raise click.UsageError('--streaming can not be combined with --page-workers')
+    if streaming and split_sampled:
+        raise click.UsageError('--streaming can not be combined with --split-sampled')
+    if output_format != 'csv' and not output_path:
+        raise click.UsageError(f'--output-format {output_format} needs an --output-path')
+    if output_format != 'csv' and not columnar_is_available():
+        raise click.UsageError(f'--output-format {output_format} needs the package pyarrow, '
+                               f'install it with `pip install pyarrow`')
+    if output_format != 'csv' and checkpoint_dir:
+        raise click.UsageError(f'--output-format {output_format} can not be combined with --checkpoint-dir')
+    if engine == 'asyncio' and not _async_engine_is_available():
+        raise click.UsageError('--engine asyncio needs the package aiohttp, install it with `pip install aiohttp`')
+    if engine == 'asyncio' and (checkpoint_dir or streaming or split_sampled):
+        raise click.UsageError('--engine asyncio can not be combined with --checkpoint-dir, --streaming or '
+                               '--split-sampled')
+    if bool(compare_start_date) != bool(compare_end_date):
+        raise click.UsageError('--compare-start-date and --compare-end-date need to be given together')
+    if compare_start_date and (shard_by or split_sampled):
+        raise click.UsageError('A second date range can not be combined with --shard-by or --split-sampled')
+
+    if worker_socket and output_format == 'csv':
+        from mara_google_analytics_downloader.worker import submit
+
+        credential_arguments = dict(
+            service_account_private_key_id=service_account_private_key_id,
+            service_account_private_key=service_account_private_key,
+            service_account_client_email=service_account_client_email,
+            service_account_client_id=service_account_client_id,
+            user_account_client_id=user_account_client_id,
+            user_account_client_secret=user_account_client_secret,
+            user_account_refresh_token=user_account_refresh_token,
+            token_cache_file=token_cache_file,
+            token_uri=token_uri)
+        job = dict(view_id=view_id, start_date=start_date, end_date=end_date, metrics=metrics, dimensions=dimensions,
+                   filters=filters, delimiter_char=delimiter_char, add_view_id_column=add_view_id_column,
+                   fail_on_no_data=fail_on_no_data, page_size=page_size, shard_by=shard_by,
+                   max_workers=max_workers, checkpoint_dir=checkpoint_dir, resume=resume,
+                   page_workers=page_workers, streaming=streaming, split_sampled=split_sampled,
+                   compare_start_date=compare_start_date, compare_end_date=compare_end_date,
+                   date_range_layout=date_range_layout, engine=engine, api_root_url=api_root_url,
+                   credentials={name: value for name, value in credential_arguments.items() if value})
+        # newline='' as recommended for csv writers
+        stream = open(output_path, 'w', newline='', encoding='utf-8') if output_path else sys.stdout
+        try:
+            submit(worker_socket, job, stream)
+            return
+        except (ConnectionRefusedError, FileNotFoundError):
+            print(f'No downloader worker is running at {worker_socket}, downloading in this process',
+                  file=sys.stderr, flush=True)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+    credentials = _google_analytics_credentials(
+        service_account_private_key_id=service_account_private_key_id,
+        service_account_private_key=service_account_private_key,
+        service_account_client_email=service_account_client_email,
+        service_account_client_id=service_account_client_id,
+        user_account_client_id=user_account_client_id,
+        user_account_client_secret=user_account_client_secret,
+        user_account_refresh_token=user_account_refresh_token,
+        token_cache_file=token_cache_file,
+        token_uri=token_uri)
+
+    if api_root_url:
+        configure_api_root_url(api_root_url)
+    # the parameters override the config, the limits are off unless given in one of them
+    configure_rate_limiter(requests_per_second=requests_per_second or c.ga_requests_per_second_limit(),
+                           requests_per_second_per_view=requests_per_second_per_view
+                                                        or c.ga_requests_per_second_per_view_limit(),
+                           requests_per_day=c.ga_requests_per_day_limit(),
+                           requests_per_day_per_view=c.ga_requests_per_day_per_view_limit(),
+                           state_file=rate_limit_state_file or c.ga_rate_limit_state_file())
+    if response_cache_file:
+        configure_response_cache(response_cache_file,
+                                 max_size=c.ga_response_cache_max_size(),
+                                 freshness_days=c.ga_response_cache_freshness_days(),
+                                 ttl_seconds=c.ga_response_cache_ttl_seconds())
+    # the parameters override the config
+    telemetry_json_lines = telemetry_json_lines or c.ga_telemetry_json_lines()
+    if not prometheus_textfile and c.ga_telemetry_prometheus_dir():
+        prometheus_textfile = os.path.join(c.ga_telemetry_prometheus_dir(),
+                                           f'ga_downloader_{str(view_id).replace(",", "_")}.prom')
+    if telemetry_json_lines or prometheus_textfile:
+        configure_telemetry(json_lines=telemetry_json_lines, prometheus_textfile=prometheus_textfile)
+
+    if output_format != 'csv':
+        stream = ColumnarWriter(output_path, output_format)
+    elif output_path:
+        # newline='' as recommended for csv writers
+        stream = open(output_path, 'w', newline='', encoding='utf-8')
+    else:
+        stream = sys.stdout
+
+    try:
+        download(view_id, start_date, end_date, metrics, dimensions=dimensions, filters=filters,
+                 stream=stream, delimiter_char=delimiter_char, add_view_id_column=add_view_id_column,
+                 fail_on_no_data=fail_on_no_data, page_size=page_size, shard_by=shard_by, max_workers=max_workers,
+                 checkpoint_dir=checkpoint_dir, resume=resume, page_workers=page_workers, streaming=streaming,
+                 split_sampled=split_sampled, compare_start_date=compare_start_date,
+                 compare_end_date=compare_end_date, date_range_layout=date_range_layout, engine=engine,
+                 credentials=credentials)
+    except BaseException:
+        if isinstance(stream, ColumnarWriter):
+            stream.abort()
+        raise
+    finally:
+        if stream is not sys.stdout and not isinstance(stream, ColumnarWriter):
+            stream.close()
+    if isinstance(stream, ColumnarWriter):
+        stream.close()
+
+
+def download(view_id: t.Union[int, str],
+             start_date: str,
+             end_date: str,
+             metrics: str,
+             dimensions: str = None,
+             filters: str = None,
+             stream: t.TextIO = None,
+             delimiter_char: str = '\t',
+             add_view_id_column: bool = False,
+             fail_on_no_data: bool = True,
+             page_size: int = 10000,
+             shard_by: str = None,
+             max_workers: int = 4,
+             checkpoint_dir: str = None,
+             resume: bool = False,
+             page_workers: int = 1,
+             streaming: bool = False,
+             split_sampled: bool = False,
+             compare_start_date: str = None,
+             compare_end_date: str = None,
+             date_range_layout: str = 'rows',
+             engine: str = 'threads',
+             credentials=None) -> int:
+    """Downloads google analytics data as CSV (without header) into a stream, see ga_download_to_csv
+
+    Args:
+    view_id: t.Union[int, str], the Google Analytics view id or a comma-separated list of view ids
+    start_date: str, the start of the date range
+    end_date: str, the end of the date range
+    metrics: str, a comma-separated list of metrics
+    dimensions: str (default: None), a comma-separated list of dimensions
+    filters: str (default: None), a filter string in the v3 URL filter syntax
+    stream: t.TextIO (default: sys.stdout), sink where the processed content is written to. Instead of a text
+            stream, also an object with `writerow`, `writerows` and `flush` methods which receives the rows.
+    delimiter_char: str (default: '\t'), A character that delimits the output fields.
+    add_view_id_column: bool (default: False), If the view id should be added as a first column
+    fail_on_no_data: bool (default: True), if true fail on no data rows received
+    page_size: int (default: 10000), the maximum number of rows per page requested from the Reporting API V4
+    shard_by: str (default: None), 'day', 'week' or 'month' to download date range shards concurrently
+    max_workers: int (default: 4), the maximum number of views and shards downloaded concurrently, and with
+                 `split_sampled` of a single view and date range the maximum number of requests in flight
+    checkpoint_dir: str (default: None), see download_to_stream
+    resume: bool (default: False), see download_to_stream
+    page_workers: int (default: 1), see download_to_stream
+    streaming: bool (default: False), see download_to_stream
+    split_sampled: bool (default: False), see download_to_stream
+    compare_start_date: str (default: None), see download_to_stream
+    compare_end_date: str (default: None), see download_to_stream
+    date_range_layout: str (default: 'rows'), see download_to_stream
+    engine: str (default: 'threads'), 'threads' to send the requests from threads, 'asyncio' to send them from an
+            event loop with aiohttp (see the module `async_engine`). Then up to `max_workers` views and shards are
+            downloaded concurrently, checkpoints, streaming and splitting sampled date ranges are not possible.
+    credentials: the oauth2 credentials (default: the credentials from the config)
+
+    Returns:
+    The number of rows written
+    """
+    stream = stream or sys.stdout
+    credentials = credentials or _google_analytics_credentials()
+
     metrics_list = metrics.split(',') if metrics else []
     dimensions_list = dimensions.split(',') if dimensions else []
     api = detect_api(metrics_list, dimensions_list)
 
+    if checkpoint_dir and api != 'mcf':
+        raise ValueError('A checkpoint dir is only supported for the Multi-Channel Funnels API')
+    if checkpoint_dir and _is_row_sink(stream):
+        raise ValueError('A checkpoint dir can only be used when writing to a text stream')
+
+    if streaming and not streaming_is_available():
+        raise ValueError('Streaming needs the package ijson, install it with `pip install ijson`')
+    if streaming and page_workers > 1:
+        raise ValueError('Streaming can not be combined with more than one page worker')
+    if split_sampled and streaming:
+        raise ValueError('Splitting sampled date ranges can not be combined with streaming')
+    if bool(compare_start_date) != bool(compare_end_date):
+        raise ValueError('A second date range needs a start date and an end date')
+    if compare_start_date and api != 'ga':
+        raise ValueError('A second date range is only supported for the Reporting API V4')
+    if compare_start_date and (shard_by or split_sampled):
+        raise ValueError('A second date range can not be combined with sharding or splitting sampled date ranges')
+    if api == 'ga' and len(dimensions_list) > MAX_DIMENSIONS_PER_REQUEST:
+        raise ValueError(f'The Reporting API V4 supports at most {MAX_DIMENSIONS_PER_REQUEST} dimensions, '
+                         f'got {len(dimensions_list)}')
+    if api == 'ga' and len(metrics_list) > MAX_METRICS_PER_REQUEST and (streaming or split_sampled):
+        raise ValueError(f'More than {MAX_METRICS_PER_REQUEST} metrics can not be combined with streaming or '
+                         f'splitting sampled date ranges')
+    if engine not in ENGINES:
+        raise ValueError(f'Unsupported engine "{engine}", use one of {", ".join(ENGINES)}')
+    if engine == 'asyncio' and not _async_engine_is_available():
+        raise ValueError('The asyncio engine needs the package aiohttp, install it with `pip install aiohttp`')
+    if engine == 'asyncio' and (checkpoint_dir or streaming or split_sampled):
+        raise ValueError('The asyncio engine can not be combined with a checkpoint dir, streaming or splitting '
+                         'sampled date ranges')
+    if date_range_layout not in DATE_RANGE_LAYOUTS:
+        raise ValueError(f'Unsupported date range layout "{date_range_layout}", '
+                         f'use one of {", ".join(DATE_RANGE_LAYOUTS)}')
+
+    view_ids = view_id.split(',') if isinstance(view_id, str) else [view_id]
+    if shard_by:
+        date_ranges = [(shard_start.isoformat(), shard_end.isoformat()) for shard_start, shard_end
+                       in split_date_range(resolve_date(start_date), resolve_date(end_date), shard_by)]
+    else:
+        date_ranges = [(start_date, end_date)]
+    jobs = [(job_view_id, job_start_date, job_end_date)
+            for job_view_id in view_ids for job_start_date, job_end_date in date_ranges]
+
+    telemetry().start_download()
+    try:
+        if engine == 'asyncio':
+            from mara_google_analytics_downloader.async_engine import run
+
+            nrows = run(_download_jobs_async(credentials, api, jobs, stream=stream, max_workers=max_workers,
+                                             metrics=metrics, dimensions=dimensions, filters=filters,
+                                             delimiter_char=delimiter_char, add_view_id_column=add_view_id_column,
+                                             page_size=page_size, compare_start_date=compare_start_date,
+                                             compare_end_date=compare_end_date, date_range_layout=date_range_layout))
+        elif len(jobs) > 1:
+            # refresh the access token once instead of in each thread
+            credentials.get_access_token()
+
+            def download_job(job: t.Tuple[str, str, str]) -> t.Tuple[t.Union[io.StringIO, _RowBuffer], int]:
+                buffer = _RowBuffer() if _is_row_sink(stream) else io.StringIO()
+                job_nrows = download_to_stream(credentials, api, view_id=job[0], start_date=job[1], end_date=job[2],
+                                               metrics=metrics, dimensions=dimensions, filters=filters,
+                                               stream=buffer, delimiter_char=delimiter_char,
+                                               add_view_id_column=add_view_id_column, page_size=page_size,
+                                               checkpoint_dir=checkpoint_dir, resume=resume,
+                                               page_workers=page_workers, streaming=streaming,
+                                               split_sampled=split_sampled, compare_start_date=compare_start_date,
+                                               compare_end_date=compare_end_date,
+                                               date_range_layout=date_range_layout)
+                return buffer, job_nrows
+
+            # views and shards are downloaded concurrently but written in the order of the views and the date range.
+            # The date ranges of a job are then not split concurrently, so that at most `max_workers` requests are
+            # in flight
+            nrows = 0
+            for buffer, job_nrows in ordered_map(download_job, jobs, max_workers=max_workers):
+                _write_buffer(stream, buffer)
+                nrows += job_nrows
+        else:
+            nrows = download_to_stream(credentials, api, view_ids[0], start_date, end_date,
+                                       metrics=metrics, dimensions=dimensions, filters=filters,
+                                       stream=stream, delimiter_char=delimiter_char,
+                                       add_view_id_column=add_view_id_column, page_size=page_size,
+                                       checkpoint_dir=checkpoint_dir, resume=resume,
+                                       page_workers=page_workers, streaming=streaming,
+                                       split_sampled=split_sampled, compare_start_date=compare_start_date,
+                                       compare_end_date=compare_end_date, date_range_layout=date_range_layout,
+                                       max_workers=max_workers)
+    except BaseException as e:
+        telemetry().finish_download(api, view_id, 0, error=e)
+        raise
+    telemetry().finish_download(api, view_id, nrows)
+
+    if fail_on_no_data and nrows == 0:
+        raise ValueError("Received no data rows, failing")
+    return nrows
+
+
+class _RowBuffer:
+    """Collects the rows of a download for a row sink, see `download`"""
+
+    def __init__(self) -> None:
+        self.rows = []
+        self.columns = None
+
+    def set_columns(self, columns: t.List[t.Tuple[str, str]]):
+        self.columns = columns
+
+    def writerow(self, row: list):
+        self.rows.append(row)
+
+    def writerows(self, rows: t.Iterable[list]):
+        self.rows.extend(rows)
+
+    def flush(self):
+        pass
+
+
+def _write_buffer(stream, buffer: t.Union[io.StringIO, _RowBuffer]):
+    """Writes the rows of a buffer of a concurrent download into the stream"""
+    if isinstance(buffer, _RowBuffer):
+        if buffer.columns:
+            _set_columns(stream, lambda: buffer.columns)
+        stream.writerows(buffer.rows)
+    else:
+        stream.write(buffer.getvalue())
+    stream.flush()
+
+
+def _is_row_sink(stream) -> bool:
+    """If the stream receives rows instead of text, see `download`"""
+    return hasattr(stream, 'writerows')
+
+def download_to_stream(credentials,
+                       api: str,
+                       view_id: int,
+                       start_date: str,
+                       end_date: str,
+                       metrics: str,
+                       dimensions: str = None,
+                       filters: str = None,
+                       stream: t.TextIO = None,
+                       delimiter_char: str = '\t',
+                       add_view_id_column: bool = False,
+                       page_size: int = 10000,
+                       checkpoint_dir: str = None,
+                       resume: bool = False,
+                       page_workers: int = 1,
+                       streaming: bool = False,
+                       split_sampled: bool = False,
+                       compare_start_date: str = None,
+                       compare_end_date: str = None,
+                       date_range_layout: str = 'rows',
+                       max_workers: int = 1) -> int:
+    """Downloads a google analytics query and writes all pages as CSV (without header) into a stream
+
+    Args:
+    credentials: the oauth2 credentials used for the requests
+    api: str, the API to be used, either 'ga' or 'mcf', see detect_api
+    view_id: int, the Google Analytics view id
+    start_date: str, the start of the date range
+    end_date: str, the end of the date range
+    metrics: str, a comma-separated list of metrics
+    dimensions: str (default: None), a comma-separated list of dimensions
+    filters: str (default: None), a filter string in the v3 URL filter syntax
+    stream: t.TextIO (default: sys.stdout), sink where the processed content is written to
+    delimiter_char: str (default: '\t'), A character that delimits the output fields.
+    add_view_id_column: bool (default: False), If the view id should be added as a first column
+    page_size: int (default: 10000), the maximum number of rows per page requested from the Reporting API V4
+    checkpoint_dir: str (default: None), Multi-Channel Funnels API only: if given, the pages are spooled in this
+                    directory and a checkpoint is recorded after each page. The rows are written to the stream
+                    when the download is complete.
+    resume: bool (default: False), if a download should continue from its checkpoint in `checkpoint_dir`
+    page_workers: int (default: 1), Multi-Channel Funnels API only: the maximum number of pages downloaded
+                  concurrently. The pages after the first one are computed from its 'totalResults'.
+    streaming: bool (default: False), if the responses are decoded incrementally while they are received, see
+               the module `streaming`. Not possible with `page_workers` > 1.
+    split_sampled: bool (default: False), Reporting API V4 only: if sampled date ranges are split until they are
+                   not sampled anymore, see download_unsampled_to_stream. Not possible with `streaming`.
+    compare_start_date: str (default: None), Reporting API V4 only: the start of a second date range which is
+                        requested together with the first one
+    compare_end_date: str (default: None), the end of the second date range
+    date_range_layout: str (default: 'rows'), with a second date range: 'rows' for one row per date range with
+                       the index of the date range (0 or 1) as first column after the view id, 'columns' for
+                       the metrics of the second date range after the metrics of the first one, see
+                       write_ga_response_as_csv_to_stream
+    max_workers: int (default: 1), with `split_sampled`: the maximum number of requests in flight
+
+    Returns:
+    The number of rows written
+    """
+    stream = stream or sys.stdout
+
+    if api == 'ga' and split_sampled:
+        nrows, date_ranges, samples_read, sampling_space = download_unsampled_to_stream(
+            credentials, view_id, start_date, end_date, metrics=metrics, dimensions=dimensions, filters=filters,
+            stream=stream, delimiter_char=delimiter_char, add_view_id_column=add_view_id_column,
+            page_size=page_size, max_workers=max_workers)
+        sampling = (f'{samples_read} of {sampling_space} sessions ({samples_read / sampling_space:.1%}) read in the '
+                    f'sampled single days' if sampling_space else 'not sampled')
+        print(f'View {view_id} {start_date} - {end_date}: {date_ranges} date range(s), {sampling}',
+              file=sys.stderr, flush=True)
+        return nrows
+    elif api == 'ga':
+        report_requests = _ga_metric_group_report_requests(view_id, start_date, end_date, metrics, dimensions,
+                                                           filters, page_size, compare_start_date, compare_end_date)
+        if len(report_requests) > 1:
+            return download_metric_groups_to_stream(credentials, report_requests, stream=stream,
+                                                    delimiter_char=delimiter_char,
+                                                    add_view_id_column=add_view_id_column,
+                                                    date_range_layout=date_range_layout if compare_start_date else None)
+        report_request = report_requests[0]
+        return download_report_requests_to_stream(credentials, [report_request], stream=stream,
+                                                  delimiter_char=delimiter_char,
+                                                  add_view_id_column=add_view_id_column,
+                                                  streaming=streaming,
+                                                  date_range_layout=date_range_layout if compare_start_date else None)
+    elif api == 'mcf':
+        if checkpoint_dir:
+            checkpoint = Checkpoint(checkpoint_dir, query_fingerprint(
+                view_id=view_id, start_date=resolve_date(start_date), end_date=resolve_date(end_date),
+                metrics=metrics, dimensions=dimensions, filters=filters, delimiter_char=delimiter_char,
+                add_view_id_column=add_view_id_column))
+            start_index, nrows = checkpoint.start(resume)
+            start_index = start_index or 1
+            if start_index > 1:
+                print(f'Resuming download at start_index={start_index}', file=sys.stderr, flush=True)
+            page_stream = checkpoint.spool
+        else:
+            checkpoint = None
+            start_index, nrows = 1, 0
+            page_stream = stream
+
+        def fetch_page(page_start_index: int) -> t.Tuple[dict, t.Optional[int]]:
+            """Returns the response of the page and, when streaming, the number of rows already written"""
+            # the service object is built once per thread and reused for all pages and retries
+            request = analytics_service(credentials).data().mcf().get(
+                ids=f'ga:{view_id}',
+                start_date=start_date,
+                end_date=end_date,
+                metrics=metrics,
+                dimensions=dimensions,
+                filters=filters,
+                start_index=page_start_index
+            )
+            if not streaming:
+                if not response_cache():
+                    return _execute_with_retries(request, view_id), None
+                return _execute_with_cache(request, view_id, cache_key(
+                    api='mcf', view_id=str(view_id), start_date=resolve_date(start_date),
+                    end_date=resolve_date(end_date), metrics=metrics, dimensions=dimensions, filters=filters,
+                    start_index=page_start_index), resolve_date(end_date)), None
+
+            def write_rows(_, rows: list, partial_response: dict):
+                pending_rows.extend(rows)
+                if 'columnHeaders' in partial_response:
+                    _set_columns(page_stream, lambda: mcf_columns(partial_response['columnHeaders'],
+                                                                  add_view_id_column=add_view_id_column))
+                    _csv_writer(page_stream, delimiter_char).writerows(
+                        map(_mcf_row_projection(partial_response['columnHeaders'],
+                                                view_id if add_view_id_column else None), pending_rows))
+                    pending_rows.clear()
+
+            pending_rows = []
+            row_writer = _StreamedRowWriter(write_rows)
+            response = _execute_with_retries(request, view_id, execute=lambda: row_writer.execute(
+                lambda: execute_streaming(request, credentials, MCF_ROWS_PREFIX, row_writer)),
+                                             streamed_rows=row_writer.received_rows)
+            if pending_rows:
+                write_rows(0, [], response)
+            return response, row_writer.nrows
+
+        def write_page(page: t.Tuple[dict, t.Optional[int]]) -> int:
+            response, streamed_nrows = page
+            if streamed_nrows is not None:
+                return streamed_nrows
+            return write_mcf_response_as_csv_to_stream(response,
+                                                       stream=page_stream,
+                                                       delimiter_char=delimiter_char,
+                                                       view_id=view_id if add_view_id_column else None,
+                                                       write_header=False)
+
+        page = fetch_page(start_index)
+        while True:
+            nrows += write_page(page)
+            page_stream.flush()
+
+            response = page[0]
+            if 'nextLink' not in response: # if 'nextLink' is in response, there are more pages
+                break
+
+            items_per_page = response.get('itemsPerPage', 1000)
+            start_index = start_index + items_per_page
+            if checkpoint:
+                checkpoint.commit(start_index, nrows)
+
+            if page_workers > 1:
+                # all remaining pages are known from 'totalResults', fetch them concurrently but write them in order
+                remaining_start_indexes = range(start_index, response.get('totalResults', 0) + 1, items_per_page)
+                for page in ordered_map(fetch_page, remaining_start_indexes, max_workers=page_workers):
+                    nrows += write_page(page)
+                    page_stream.flush()
+                    start_index = start_index + items_per_page
+                    if checkpoint:
+                        checkpoint.commit(start_index, nrows)
+                break
+
+            page = fetch_page(start_index)
+
+        if checkpoint:
+            checkpoint.finish(stream)
+        return nrows
+    else:
+        raise NotImplementedError('Unexpected')
+
+
+def download_unsampled_to_stream(credentials,
+                                 view_id: int,
+                                 start_date: str,
+                                 end_date: str,
+                                 metrics: str,
+                                 dimensions: str = None,
+                                 filters: str = None,
+                                 stream: t.TextIO = None,
+                                 delimiter_char: str = '\t',
+                                 add_view_id_column: bool = False,
+                                 page_size: int = 10000,
+                                 max_workers: int = 4) -> t.Tuple[int, int, int, int]:
+    """Downloads a Reporting API V4 query and splits the date range while the responses are sampled
+
+    When the first page of a date range is sampled, the date range is split into two halves, until a half is not
+    sampled anymore or is a single day. The first pages of all halves and the remaining pages of the date ranges
+    which are not split anymore are requested in one pool of `max_workers` threads, so that at most `max_workers`
+    requests are in flight at any depth of splitting. The first page of a date range is requested only once. The
+    date ranges are written in their order. Like with shards, this only gives correct results when the metrics can
+    be summed up over the halves, e.g. when a date dimension is requested.
+
+    Args:
+    credentials: the oauth2 credentials used for the requests
+    view_id: int, the Google Analytics view id
+    start_date: str, the start of the date range
+    end_date: str, the end of the date range
+    metrics: str, a comma-separated list of metrics
+    dimensions: str (default: None), a comma-separated list of dimensions
+    filters: str (default: None), a filter string in the v3 URL filter syntax
+    stream: t.TextIO (default: sys.stdout), sink where the processed content is written to
+    delimiter_char: str (default: '\t'), A character that delimits the output fields.
+    add_view_id_column: bool (default: False), If the view id should be added as a first column
+    page_size: int (default: 10000), the maximum number of rows per page
+    max_workers: int (default: 4), the maximum number of requests in flight
+
+    Returns:
+    The number of rows written, the number of date ranges after splitting, and the number of sessions read and
+    the number of sessions in the sampling space of the date ranges which are still sampled
+    """
+    import concurrent.futures
+
+    stream = stream or sys.stdout
+    execute = _ga_execute_function()
+
+    def report_request(date_range: t.Tuple[datetime.date, datetime.date]) -> dict:
+        return ga_report_request(view_id, date_range[0].isoformat(), date_range[1].isoformat(),
+                                 metrics=metrics.split(','),
+                                 dimensions=dimensions.split(',') if dimensions else [],
+                                 filters=filters, page_size=page_size)
+
+    def request_first_page(date_range: t.Tuple[datetime.date, datetime.date]) -> dict:
+        return execute(analytics_reporting_service(credentials).reports().batchGet(
+            body={'reportRequests': [report_request(date_range)]}), str(view_id))
+
+    def is_split(date_range: t.Tuple[datetime.date, datetime.date], response: dict) -> bool:
+        return bool(response['reports'][0].get('data', {}).get('samplesReadCounts')) and date_range[0] < date_range[1]
+
+    def halves(date_range: t.Tuple[datetime.date, datetime.date]) -> t.List[t.Tuple[datetime.date, datetime.date]]:
+        start, end = date_range
+        middle = start + (end - start) // 2
+        return [(start, middle), (middle + datetime.timedelta(days=1), end)]
+
+    def download_date_range(date_range: t.Tuple[datetime.date, datetime.date], response: dict,
+                            date_range_stream) -> t.Tuple[int, int, int, int]:
+        """Writes the first page and requests and writes the remaining pages of a date range"""
+        report = response['reports'][0]
+        data = report.get('data', {})
+        nrows = write_ga_response_as_csv_to_stream(response, stream=date_range_stream, delimiter_char=delimiter_char,
+                                                   view_id=view_id if add_view_id_column else None,
+                                                   write_header=False)
+        date_range_stream.flush()
+        if report.get('nextPageToken'):
+            nrows += download_report_requests_to_stream(credentials, [dict(report_request(date_range),
+                                                                           pageToken=report['nextPageToken'])],
+                                                        stream=date_range_stream, delimiter_char=delimiter_char,
+                                                        add_view_id_column=add_view_id_column)
+        return (nrows, 1,
+                sum(map(int, data.get('samplesReadCounts', []))),
+                sum(map(int, data.get('samplingSpaceSizes', []))))
+
+    def download_to_buffer(date_range: t.Tuple[datetime.date, datetime.date], response: dict):
+        buffer = _RowBuffer() if _is_row_sink(stream) else io.StringIO()
+        return buffer, download_date_range(date_range, response, buffer)
+
+    date_range = (resolve_date(start_date), resolve_date(end_date))
+    response = request_first_page(date_range)
+    if not is_split(date_range, response):
+        return download_date_range(date_range, response, stream)
+
+    totals = [0, 0, 0, 0]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix='ga-split-sampled') as executor:
+        # the date ranges in their order, each with the future of its first page ('split') or of its download
+        pending = [(half, 'split', submit_in_context(executor, request_first_page, half)) for half in halves(date_range)]
+        try:
+            while pending:
+                concurrent.futures.wait([future for _, _, future in pending],
+                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                next_pending = []
+                for date_range, kind, future in pending:
+                    if kind == 'split' and future.done():
+                        response = future.result()
+                        if is_split(date_range, response):
+                            next_pending += [(half, 'split', submit_in_context(executor, request_first_page, half))
+                                             for half in halves(date_range)]
+                        else:
+                            next_pending.append((date_range, 'download',
+                                                 submit_in_context(executor, download_to_buffer, date_range, response)))
+                    else:
+                        next_pending.append((date_range, kind, future))
+                pending = next_pending
+
+                while pending and pending[0][1] == 'download' and pending[0][2].done():
+                    buffer, date_range_totals = pending.pop(0)[2].result()
+                    _write_buffer(stream, buffer)
+                    totals = [total + date_range_total for total, date_range_total in zip(totals, date_range_totals)]
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+    return tuple(totals)
+
+
+def ga_report_request(view_id: int,
+                      start_date: str,
+                      end_date: str,
+                      metrics: t.List[str],
+                      dimensions: t.List[str] = None,
+                      filters: str = None,
+                      page_size: int = 10000) -> dict:
+    """Returns a report request for the Analytics Reporting API V4
+
+    Args:
+    view_id: int, the Google Analytics view id
+    start_date: str, the start of the date range
+    end_date: str, the end of the date range
+    metrics: t.List[str], the metrics
+    dimensions: t.List[str] (default: None), the dimensions
+    filters: str (default: None), a filter string in the v3 URL filter syntax
+    page_size: int (default: 10000), the maximum number of rows per page
+    """
+    report_request = {
+        'viewId': str(view_id),
+        'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
+        'metrics': [{'expression': metric_name} for metric_name in metrics],
+        'dimensions': [{'name': dimension_name} for dimension_name in dimensions or []],
+        'pageSize': page_size
+    }
+
+    if filters:
+        ga_parse_filter(report_request, filters)
+
+    return report_request
+
+
+def download_report_requests_to_stream(credentials,
+                                       report_requests: t.List[dict],
+                                       stream: t.TextIO = None,
+                                       delimiter_char: str = '\t',
+                                       add_view_id_column: bool = False,
+                                       streaming: bool = False,
+                                       date_range_layout: str = None) -> int:
+    """Downloads several Reporting API V4 report requests and writes all pages as CSV (without header) into a stream
+
+    Report requests with the same view and date ranges are sent together, up to five per batchGet call. Each
+    page is written as soon as it is received, so the rows of the reports are interleaved page by page.
+
+    Args:
+    credentials: the oauth2 credentials used for the requests
+    report_requests: t.List[dict], the report requests, see ga_report_request
+    stream: t.TextIO (default: sys.stdout), sink where the processed content is written to
+    delimiter_char: str (default: '\t'), A character that delimits the output fields.
+    add_view_id_column: bool (default: False), If the view id of the report request should be added as a first column
+    streaming: bool (default: False), if the rows are written while the responses are received, see the module
+               `streaming`
+    date_range_layout: str (default: None), how the metrics of report requests with two date ranges are written,
+                       see write_ga_response_as_csv_to_stream
+
+    Returns:
+    The number of rows written
+    """
+    stream = stream or sys.stdout
+
+    # the service object is built once per thread and reused for all pages and retries
+    analytics = analytics_reporting_service(credentials)
+
+    if not streaming:
+        execute = _ga_execute_function()
+    else:
+        csv_writer = _csv_writer(stream, delimiter_char)
+        streamed_nrows = 0
+
+        def execute(request, view_id: str) -> dict:
+            # all report requests of a batch have the same view
+            rows_projection = _ga_rows_projection(view_id if add_view_id_column else None, date_range_layout)
+
+            def write_rows(report_index: int, rows: list, partial_response: dict):
+                nonlocal streamed_nrows
+
+                _set_columns(stream, lambda: ga_columns(partial_response['reports'][report_index]['columnHeader'],
+                                                        add_view_id_column=add_view_id_column,
+                                                        date_range_layout=date_range_layout))
+                csv_writer.writerows(rows_projection(rows))
+                streamed_nrows += _ga_csv_row_count(rows, date_range_layout)
+
+            row_writer = _StreamedRowWriter(write_rows)
+            response = _execute_with_retries(request, view_id, execute=lambda: row_writer.execute(
+                lambda: execute_streaming(request, credentials, GA_ROWS_PREFIX, row_writer)),
+                                             streamed_rows=row_writer.received_rows)
+            return response
+
+    nrows = 0
+    for index, report in iter_report_pages(analytics, report_requests, execute=execute):
+        if streaming:
+            # the rows are already written
+            nrows, streamed_nrows = nrows + streamed_nrows, 0
+        else:
+            nrows += write_ga_response_as_csv_to_stream({'reports': [report]},
+                                                        stream=stream,
+                                                        delimiter_char=delimiter_char,
+                                                        view_id=report_requests[index]['viewId'] if add_view_id_column else None,
+                                                        write_header=False,
+                                                        date_range_layout=date_range_layout)
+        stream.flush()
+    return nrows
+
+
+def _ga_metric_group_report_requests(view_id: int, start_date: str, end_date: str, metrics: str, dimensions: str,
+                                     filters: str, page_size: int, compare_start_date: str = None,
+                                     compare_end_date: str = None) -> t.List[dict]:
+    """The report requests of a query, one per group of metrics, see `reporting.metric_groups`"""
+    report_requests = [ga_report_request(view_id, start_date, end_date,
+                                         metrics=group,
+                                         dimensions=dimensions.split(',') if dimensions else [],
+                                         filters=filters, page_size=page_size)
+                       for group in metric_groups(metrics.split(','))]
+    if compare_start_date:
+        for report_request in report_requests:
+            report_request['dateRanges'].append({'startDate': compare_start_date, 'endDate': compare_end_date})
+    return report_requests
+
+
+def download_metric_groups_to_stream(credentials,
+                                     report_requests: t.List[dict],
+                                     stream: t.TextIO = None,
+                                     delimiter_char: str = '\t',
+                                     add_view_id_column: bool = False,
+                                     date_range_layout: str = None) -> int:
+    """Downloads report requests which differ only in their metrics and writes the joined rows into a stream
+
+    The Reporting API V4 allows at most 10 metrics per report request, so more metrics are requested in groups,
+    see `reporting.metric_groups`. Up to five groups are sent in one batchGet call, several calls are sent
+    concurrently. The rows of the groups are joined by their dimension values (see `reporting.join_reports`), so all
+    rows are kept in memory until the last page of all groups is received.
+
+    Args:
+    credentials: the oauth2 credentials used for the requests
+    report_requests: t.List[dict], the report requests of the metric groups, in the order of the metrics
+    stream: t.TextIO (default: sys.stdout), sink where the processed content is written to
+    delimiter_char: str (default: '\t'), A character that delimits the output fields.
+    add_view_id_column: bool (default: False), If the view id should be added as a first column
+    date_range_layout: str (default: None), see write_ga_response_as_csv_to_stream
+
+    Returns:
+    The number of rows written
+    """
+    stream = stream or sys.stdout
+    execute = _ga_execute_function()
+
+    def download_batch(batch: t.List[int]) -> t.List[dict]:
+        # the service object is built once per thread
+        analytics = analytics_reporting_service(credentials)
+        reports = {}
+        for index, report in iter_report_pages(analytics, [report_requests[index] for index in batch],
+                                               execute=execute):
+            _add_report_page(reports, index, report)
+        return [reports[index] for index in range(len(batch))]
+
+    batches = batch_report_requests(report_requests)
+    reports = list(itertools.chain.from_iterable(ordered_map(download_batch, batches, max_workers=len(batches))))
+    nrows = write_ga_response_as_csv_to_stream({'reports': [join_reports(reports)]},
+                                               stream=stream,
+                                               delimiter_char=delimiter_char,
+                                               view_id=report_requests[0]['viewId'] if add_view_id_column else None,
+                                               write_header=False,
+                                               date_range_layout=date_range_layout)
+    stream.flush()
+    return nrows
+
+
+def _add_report_page(reports: t.Dict[int, dict], index: int, report: dict):
+    """Adds the rows of a page of a report to the complete reports by the index of their report request"""
+    if index not in reports:
+        reports[index] = dict(report, data=dict(report.get('data', {}),
+                                                rows=list(report.get('data', {}).get('rows', []))))
+    else:
+        reports[index]['data']['rows'].extend(report.get('data', {}).get('rows', []))
+
+
+async def _download_jobs_async(credentials,
+                               api: str,
+                               jobs: t.List[t.Tuple[str, str, str]],
+                               stream,
+                               max_workers: int,
+                               **kwargs) -> int:
+    """Downloads (view id, start date, end date) jobs with the asyncio engine and writes them in their order
+
+    At most `max_workers` jobs are downloaded concurrently. See the module `async_engine`.
+    """
+    import asyncio
+    import collections
+    from mara_google_analytics_downloader.async_engine import AsyncClient
+
+    root_urls = dict(reporting_api_root_url=api_root_url(), analytics_api_root_url=api_root_url()) \
+        if api_root_url() else {}
+    async with AsyncClient(credentials, max_concurrency=max_workers, **root_urls) as client:
+        if len(jobs) == 1:
+            return await download_to_stream_async(client, api, *jobs[0], stream=stream, **kwargs)
+
+        async def download_job(job: t.Tuple[str, str, str]) -> t.Tuple[t.Union[io.StringIO, _RowBuffer], int]:
+            buffer = _RowBuffer() if _is_row_sink(stream) else io.StringIO()
+            return buffer, await download_to_stream_async(client, api, *job, stream=buffer, **kwargs)
+
+        nrows = 0
+        pending = collections.deque()
+        try:
+            for job in jobs:
+                pending.append(asyncio.ensure_future(download_job(job)))
+                if len(pending) >= max_workers:
+                    buffer, job_nrows = await pending.popleft()
+                    _write_buffer(stream, buffer)
+                    nrows += job_nrows
+            while pending:
+                buffer, job_nrows = await pending.popleft()
+                _write_buffer(stream, buffer)
+                nrows += job_nrows
+        finally:
+            for task in pending:
+                task.cancel()
+        return nrows
+
+
+async def download_to_stream_async(client,
+                                   api: str,
+                                   view_id: int,
+                                   start_date: str,
+                                   end_date: str,
+                                   metrics: str,
+                                   dimensions: str = None,
+                                   filters: str = None,
+                                   stream: t.TextIO = None,
+                                   delimiter_char: str = '\t',
+                                   add_view_id_column: bool = False,
+                                   page_size: int = 10000,
+                                   compare_start_date: str = None,
+                                   compare_end_date: str = None,
+                                   date_range_layout: str = 'rows') -> int:
+    """Downloads a google analytics query with the asyncio engine and writes all pages as CSV into a stream
+
+    The coroutine version of download_to_stream, without checkpoints, streaming and splitting of sampled date
+    ranges.
+
+    Args:
+    client: async_engine.AsyncClient, the client which sends the requests
+    For the other arguments, see download_to_stream
+
+    Returns:
+    The number of rows written
+    """
+    stream = stream or sys.stdout
+
+    if api == 'ga':
+        report_requests = _ga_metric_group_report_requests(view_id, start_date, end_date, metrics, dimensions,
+                                                           filters, page_size, compare_start_date, compare_end_date)
+        date_range_layout = date_range_layout if compare_start_date else None
+        write_view_id = report_requests[0]['viewId'] if add_view_id_column else None
+        if len(report_requests) > 1:
+            reports = {}
+            async for index, report in client.report_pages(report_requests):
+                _add_report_page(reports, index, report)
+            response = {'reports': [join_reports([reports[index] for index in range(len(report_requests))])]}
+            nrows = write_ga_response_as_csv_to_stream(response, stream=stream, delimiter_char=delimiter_char,
+                                                       view_id=write_view_id, write_header=False,
+                                                       date_range_layout=date_range_layout)
+            stream.flush()
+            return nrows
+
+        nrows = 0
+        async for _, report in client.report_pages(report_requests):
+            nrows += write_ga_response_as_csv_to_stream({'reports': [report]}, stream=stream,
+                                                        delimiter_char=delimiter_char, view_id=write_view_id,
+                                                        write_header=False, date_range_layout=date_range_layout)
+            stream.flush()
+        return nrows
+    elif api == 'mcf':
+        nrows = 0
+        async for response in client.mcf_pages(view_id, start_date, end_date, metrics, dimensions, filters):
+            nrows += write_mcf_response_as_csv_to_stream(response, stream=stream, delimiter_char=delimiter_char,
+                                                         view_id=view_id if add_view_id_column else None,
+                                                         write_header=False)
+            stream.flush()
+        return nrows
+    else:
+        raise NotImplementedError('Unexpected')
+
+
+class _StreamedRowWriter:
+    """Passes the rows of a streamed response to a write function, skips rows already written by an earlier try
+
+    When a streamed response breaks off and the request is retried, the rows of the first try are already written.
+    They are skipped on the following tries, relying on the API returning the same page again.
+    """
+
+    def __init__(self, write_rows: t.Callable[[int, list, dict], None]) -> None:
+        self.write_rows = write_rows
+        self.written = {}
+        self.received = {}
+
+    def execute(self, execute: t.Callable[[], dict]) -> dict:
+        """Executes one try of the request"""
+        self.received = {}
+        return execute()
+
+    def __call__(self, report_index: int, rows: list, partial_response: dict):
+        received = self.received.get(report_index, 0)
+        self.received[report_index] = received + len(rows)
+        skip = self.written.get(report_index, 0) - received
+        if skip < len(rows):
+            self.write_rows(report_index, rows[max(skip, 0):], partial_response)
+            self.written[report_index] = self.received[report_index]
+
+    @property
+    def nrows(self) -> int:
+        return sum(self.written.values())
+
+    def received_rows(self) -> int:
+        """The number of rows received by the last try"""
+        return sum(self.received.values())
+
+
+def _execute_with_retries(request, view_id: t.Union[int, str] = None, retry_policy: RetryPolicy = None,
+                          execute: t.Callable[[], dict] = None, streamed_rows: t.Callable[[], int] = None) -> dict:
+    """Executes a request, retries it with exponential backoff when it fails with a transient error
+
+    Each try waits for the rate limiter of the view first. Other errors, e.g. for invalid requests, are raised
+    immediately. `execute` replaces `request.execute()` for each try, e.g. for streaming, then `streamed_rows`
+    returns the number of rows received by the last try. The request is recorded in the telemetry.
+    """
+    if execute is None:
+        execute = request.execute
+        bytes_received = _count_received_bytes(request)
+    else:
+        bytes_received = None
+    limiter = rate_limiter()
+    retry_policy = retry_policy or RetryPolicy()
+    api = 'ga' if 'batchGet' in getattr(request, 'uri', '') else 'mcf'
+    retry, backoff_seconds, rate_limited_errors = 0, 0.0, 0
+    while True:
+        limiter.acquire(view_id)
+        start = time.monotonic()
+        try:
+            response = execute()
+            limiter.report_success(view_id)
+            telemetry().record_request(api, view_id, time.monotonic() - start, response,
+                                       bytes_received=bytes_received[0] if bytes_received else None,
+                                       rows=streamed_rows() if streamed_rows else None, retries=retry,
+                                       backoff_seconds=backoff_seconds, rate_limited_errors=rate_limited_errors)
+            return response
+        except Exception as e:
+            if is_rate_limit_error(e):
+                limiter.report_rate_limited(view_id)
+                rate_limited_errors += 1
+            if retry >= retry_policy.max_retries or not retry_policy.is_retryable(e):
+                telemetry().record_request(api, view_id, time.monotonic() - start, retries=retry,
+                                           backoff_seconds=backoff_seconds, rate_limited_errors=rate_limited_errors,
+                                           error=e)
+                raise e
+            sleep_seconds = retry_policy.backoff_seconds(retry, e)
+            print(f'Got exception, but will retry again in {sleep_seconds:.1f} seconds: {e!r}',
+                  file=sys.stderr, flush=True)
+            time.sleep(sleep_seconds)
+            backoff_seconds += sleep_seconds
+            retry += 1
+
+
+def _count_received_bytes(request) -> t.Optional[list]:
+    """Makes a request of google-api-python-client count the bytes of its response body in a one element list"""
+    postproc = getattr(request, 'postproc', None)
+    if postproc is None:
+        return None
+    received = [None]
+
+    def count_and_postproc(resp, content):
+        received[0] = len(content)
+        return postproc(resp, content)
+
+    request.postproc = count_and_postproc
+    return received
+
+
+def _ga_execute_function() -> t.Callable[[t.Any, str], dict]:
+    """The function which executes batchGet requests, with the response cache if it is configured"""
+    if not response_cache():
+        return _execute_with_retries
+
+    def execute(request, view_id: str) -> dict:
+        return _execute_with_cache(request, view_id, *_ga_cache_key(request), is_final=_ga_is_golden)
+
+    return execute
+
+
+def _execute_with_cache(request, view_id: t.Union[int, str], key: str, end_date: datetime.date,
+                        is_final: t.Callable[[dict], bool] = None) -> dict:
+    """Returns the response from the response cache, or executes the request and caches the response"""
+    cache = response_cache()
+    response = cache.get(key)
+    if response is None:
+        response = _execute_with_retries(request, view_id)
+        cache.put(key, response, end_date, final=is_final(response) if is_final else True)
+    return response
+
+
+def _ga_cache_key(request) -> t.Tuple[str, datetime.date]:
+    """The cache key of a batchGet request with absolute dates, and the last end date of its report requests"""
+    import json
+
+    return ga_cache_key(json.loads(request.body))
+
+
+def _ga_is_golden(response: dict) -> bool:
+    """If the API did not report that the data of a batchGet response may still change"""
+    return all(report.get('data', {}).get('isDataGolden') is not False for report in response.get('reports', []))
+
+
+def _google_analytics_credentials(service_account_private_key_id: str = None,
+                                  service_account_private_key: str = None,
+                                  service_account_client_email: str = None,
+                                  service_account_client_id: str = None,
+                                  user_account_client_id: str = None,
+                                  user_account_client_secret: str = None,
+                                  user_account_refresh_token: str = None,
+                                  token_cache_file: str = None,
+                                  token_uri: str = None):
+    """Returns the credentials for a user account or a service account, missing values are taken from the config
+
+    With a token cache file, the access token is shared with other processes, see the module `token_cache`.
+    """
+
     # TODO: make sure we only get a single credential config overall and warn/abort if we have more than one
     #       (warn: no print to stdout allowed!)
 
@@ -140,12 +1344,15 @@ def ga_download_to_csv(view_id: int,
     user_account_client_id = user_account_client_id or c.ga_user_account_client_id()
     user_account_client_secret = user_account_client_secret or c.ga_user_account_client_secret()
     user_account_refresh_token = user_account_refresh_token or c.ga_user_account_refresh_token()
+    token_cache_file = token_cache_file or c.ga_token_cache_file()
+    token_uri = token_uri or c.ga_token_uri()
 
     if user_account_client_id:
         credentials = _google_analytics_credentials_from_user_credentials(
             client_id=user_account_client_id,
             client_secret=user_account_client_secret,
             refresh_token=user_account_refresh_token,
+            token_uri=token_uri,
         )
     elif service_account_client_id:
         credentials = _google_analytics_credentials_from_service_account_credentials(
@@ -153,98 +1360,14 @@ def ga_download_to_csv(view_id: int,
             private_key=service_account_private_key,
             client_email=service_account_client_email,
             client_id=service_account_client_id,
+            token_uri=token_uri,
         )
     else:
         raise RuntimeError("Need either credentials for a google user account or for a google service account")
 
-    overall_tries = 0
-    api_errors = 0
-    start_index = 1
-    stream = sys.stdout
-    nrows = 0
-    while True:
-        try:
-            if api == 'ga':
-                # Builds the google analytics service object
-                analytics = build('analyticsreporting', 'v4', credentials=credentials, cache_discovery=False)
-
-                request_metrics = list(map(
-                    lambda metric_name: {'expression': metric_name},
-                    metrics.split(',')
-                ))
-
-                reuqest_dimensions = []
-                if dimensions:
-                    reuqest_dimensions = list(map(
-                        lambda dimension_name: {'name': dimension_name},
-                        dimensions.split(',')
-                    ))
-
-                reportRequest = {
-                    'viewId': view_id,
-                    'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
-                    'metrics': request_metrics,
-                    'dimensions': reuqest_dimensions
-                }
-
-                if filters:
-                    ga_parse_filter(reportRequest, filters)
-
-                response = analytics.reports().batchGet(body={'reportRequests': [reportRequest]}).execute()
-                break
-            elif api == 'mcf':
-                # Builds the google analytics service object
-                analytics = build('analytics', 'v3', credentials=credentials, cache_discovery=False)
-
-                request = analytics.data().mcf().get(
-                    ids=f'ga:{view_id}',
-                    start_date=start_date,
-                    end_date=end_date,
-                    metrics=metrics,
-                    dimensions=dimensions,
-                    filters=filters,
-                    start_index=start_index
-                )
-
-                response = request.execute()
-
-                nrows += write_mcf_response_as_csv_to_stream(response,
-                                                             stream=stream,
-                                                             delimiter_char=delimiter_char,
-                                                             view_id=view_id if add_view_id_column else None,
-                                                             write_header=False)
-
-                stream.flush()
-
-                if 'nextLink' in response: # if 'nextLink' is in response, the response is paged.
-                    start_index = start_index + response.get('max-results',1000)
-                    #print(f'Request next page with start_index={start_index}', file=sys.stderr, flush=True)
-                else:
-                    break
-            else:
-                raise NotImplementedError('Unexpected')
-        except Exception as e:
-            # some API down or so -> wait a bit and try again
-            if overall_tries > 3:
-                raise e
-            print(f'Got exception, but will retry again: {e!r}', file=sys.stderr, flush=True)
-            overall_tries += 1
-            sleep_seconds = 20 * (overall_tries + 1)
-            time.sleep(sleep_seconds)
-            continue
-
-    if api == 'ga':
-        nrows += write_ga_response_as_csv_to_stream(response,
-                                                    stream=stream,
-                                                    delimiter_char=delimiter_char,
-                                                    view_id=view_id if add_view_id_column else None,
-                                                    write_header=False)
-
-        stream.flush()
-
-    if fail_on_no_data and nrows == 0:
-        raise ValueError("Received no data rows, failing")
-
+    if token_cache_file:
+        cache_credentials(credentials, token_cache_file)
+    return credentials
 
 SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
 
@@ -256,23 +1379,24 @@ def _google_analytics_credentials_from_service_account_credentials(
     private_key_id: str,
     private_key: str,
     client_email: str,
-    client_id: str
+    client_id: str,
+    token_uri: str = None
 ):
     '''Returns the credentials for a service account
     '''
     import oauth2client
     from oauth2client.service_account import ServiceAccountCredentials
-    from oauth2client import crypt
 
     # adapted from ServiceAccountCredentials._from_parsed_json_keyfile()
     service_account_email = client_email
     private_key_pkcs8_pem = private_key
     private_key_id = private_key_id
     client_id = client_id
-    token_uri = oauth2client.GOOGLE_TOKEN_URI
+    token_uri = token_uri or oauth2client.GOOGLE_TOKEN_URI
     revoke_uri = oauth2client.GOOGLE_REVOKE_URI
 
-    signer = crypt.Signer.from_string(private_key_pkcs8_pem)
+    # the private key is only parsed when a token is requested, not when the token is taken from a token cache
+    signer = _LazySigner(private_key_pkcs8_pem)
     credentials = ServiceAccountCredentials(service_account_email, signer, scopes=SCOPES,
                                             private_key_id=private_key_id,
                                             client_id=client_id, token_uri=token_uri,
@@ -282,10 +1406,25 @@ def _google_analytics_credentials_from_service_account_credentials(
     return credentials
 
 
+class _LazySigner:
+    """A `oauth2client.crypt.Signer` which parses the private key on first use"""
+
+    def __init__(self, private_key_pkcs8_pem: str) -> None:
+        self.private_key_pkcs8_pem = private_key_pkcs8_pem
+        self._signer = None
+
+    def sign(self, message):
+        if not self._signer:
+            from oauth2client import crypt
+            self._signer = crypt.Signer.from_string(self.private_key_pkcs8_pem)
+        return self._signer.sign(message)
+
+
 def _google_analytics_credentials_from_user_credentials(
     client_id: str,
     client_secret: str,
-    refresh_token: str
+    refresh_token: str,
+    token_uri: str = None
 ):
     '''Returns the credentials from user authenticated client_id, client_secret, refresh_token
 
@@ -302,7 +1441,7 @@ def _google_analytics_credentials_from_user_credentials(
         client_secret=client_secret,
         refresh_token=refresh_token,
         token_expiry=None,
-        token_uri=oauth2client.GOOGLE_TOKEN_URI,
+        token_uri=token_uri or oauth2client.GOOGLE_TOKEN_URI,
         user_agent=None,
         revoke_uri=oauth2client.GOOGLE_REVOKE_URI,
         scopes=SCOPES)
@@ -313,7 +1452,8 @@ def write_ga_response_as_csv_to_stream(response,
                                        stream: t.TextIO,
                                        delimiter_char: str = '\t',
                                        view_id: str = None,
-                                       write_header: bool = True):
+                                       write_header: bool = True,
+                                       date_range_layout: str = None):
     """Writes the Analytics Reporting API V4 response into a CSV stream.
 
     Header is written by default, see arg. write_header.
@@ -324,54 +1464,81 @@ def write_ga_response_as_csv_to_stream(response,
     delimiter_char: str (default: '\t'), A character that delimits the output fields.
     view_id: str (default: None), If given the view id will be added as a first column. Column name: 'vid'
     write_header: bool (default: True), If a CSV header should be added at the start
+    date_range_layout: str (default: None), for responses of two date ranges: 'rows' writes one row per date range
+                       with the index of the date range as first column (after 'vid'), column name: 'date_range'.
+                       'columns' writes the metrics of the second date range after the metrics of the first one,
+                       with the suffix '_compare' in the header. If None, only the first date range is written.
     """
-
-    import csv
-
-    dialect = csv.excel
-    dialect.delimiter = delimiter_char
-
-    csv_writer = csv.writer(stream,dialect=dialect)
+    csv_writer = _csv_writer(stream, delimiter_char)
 
     n_rows = 0
     for report in response.get('reports', []):
         columnHeader = report.get('columnHeader', {})
         dimensionHeaders = columnHeader.get('dimensions', [])
         metricHeaders = columnHeader.get('metricHeader', {}).get('metricHeaderEntries', [])
+        _set_columns(stream, lambda: ga_columns(columnHeader, add_view_id_column=view_id != None,
+                                                date_range_layout=date_range_layout))
+
+        # write header
+        if write_header:
+            headerRow = []
+            if view_id != None:
+                headerRow.append('vid')
+            if date_range_layout == 'rows':
+                headerRow.append('date_range')
+            for header in dimensionHeaders:
+                headerRow.append(header)
+            for metricHeader in metricHeaders:
+                headerRow.append(metricHeader.get('name'))
+            if date_range_layout == 'columns':
+                for metricHeader in metricHeaders:
+                    headerRow.append(metricHeader.get('name') + COMPARE_COLUMN_SUFFIX)
+            csv_writer.writerow(headerRow)
+
+        # write rows
+        rows = report.get('data', {}).get('rows', [])
+        csv_writer.writerows(_ga_rows_projection(view_id, date_range_layout)(rows))
+        n_rows += _ga_csv_row_count(rows, date_range_layout)
 
-    # write header
-    if write_header:
-        headerRow = []
-        if view_id != None:
-            headerRow.append('vid')
-        for header in dimensionHeaders:
-            headerRow.append(header)
-        for metricHeader in metricHeaders:
-            headerRow.append(metricHeader.get('name'))
-        csv_writer.writerow(headerRow)
-
-    # write rows
-    for row in report.get('data', {}).get('rows', []):
-        dimensions = row.get('dimensions', [])
-        dateRangeValues = row.get('metrics', [])
+    return n_rows
 
-        row = []
 
-        if view_id != None:
-            row.append(str(view_id))
-
-        for header, dimension in zip(dimensionHeaders, dimensions):
-            row.append(dimension)
+def _ga_row_projection(view_id: str = None) -> t.Callable[[dict], list]:
+    """Returns a function which maps a Reporting API V4 row to a CSV row with the metrics of the first date range"""
+    if view_id != None:
+        prefix = [str(view_id)]
+        return lambda row: prefix + row.get('dimensions', []) + row['metrics'][0]['values']
+    else:
+        return lambda row: row.get('dimensions', []) + row['metrics'][0]['values']
+
+
+def _ga_rows_projection(view_id: str = None,
+                        date_range_layout: str = None) -> t.Callable[[t.Iterable[dict]], t.Iterable[list]]:
+    """Returns a function which maps Reporting API V4 rows to CSV rows, see write_ga_response_as_csv_to_stream"""
+    prefix = [str(view_id)] if view_id != None else []
+    if date_range_layout == 'rows':
+        def project(row: dict) -> t.List[list]:
+            dimensions = row.get('dimensions', [])
+            return [prefix + [str(index)] + dimensions + date_range_values['values']
+                    for index, date_range_values in enumerate(row['metrics'])]
+
+        return lambda rows: itertools.chain.from_iterable(map(project, rows))
+    elif date_range_layout == 'columns':
+        return lambda rows: (prefix + row.get('dimensions', []) + [value for date_range_values in row['metrics']
+                                                                   for value in date_range_values['values']]
+                             for row in rows)
+    else:
+        row_projection = _ga_row_projection(view_id)
+        return lambda rows: map(row_projection, rows)
 
-        for i, values in enumerate(dateRangeValues):
-            if i == 0: # note: we only support here one date range TODO maybe something to consider as a future feature
-                for metricHeader, value in zip(metricHeaders, values.get('values')):
-                    row.append(value)
 
-        csv_writer.writerow(row)
-        n_rows += 1
+def _ga_csv_row_count(rows: t.List[dict], date_range_layout: str = None) -> int:
+    """The number of CSV rows written for rows of a Reporting API V4 response, see _ga_rows_projection"""
+    if date_range_layout == 'rows':
+        # one for each date range
+        return sum(len(row['metrics']) for row in rows)
+    return len(rows)
 
-    return n_rows
 
 def write_mcf_response_as_csv_to_stream(response,
                                         stream: t.TextIO,
@@ -389,17 +1556,10 @@ def write_mcf_response_as_csv_to_stream(response,
     view_id: str (default: None), If given the view id will be added as a first column. Column name: 'vid'
     write_header: bool (default: True), If a CSV header should be added at the start
     """
+    csv_writer = _csv_writer(stream, delimiter_char)
 
-    import csv
-    import json
-
-    dialect = csv.excel
-    dialect.delimiter = delimiter_char
-
-    csv_writer = csv.writer(stream,dialect=dialect)
-
-    n_rows = 0
     columnHeaders = response.get('columnHeaders', [])
+    _set_columns(stream, lambda: mcf_columns(columnHeaders, add_view_id_column=view_id != None))
 
     # write header
     if write_header:
@@ -407,31 +1567,61 @@ def write_mcf_response_as_csv_to_stream(response,
         if view_id != None:
             headerRow.append('vid')
         for column_header in columnHeaders:
-            headerRow.append(column_header.name)
+            headerRow.append(column_header['name'])
         csv_writer.writerow(headerRow)
 
     # write rows
-    for raw_row in response.get('rows', []):
-        row = []
+    rows = response.get('rows', [])
+    csv_writer.writerows(map(_mcf_row_projection(columnHeaders, view_id), rows))
+
+    return len(rows)
 
-        if view_id != None:
-            row.append(str(view_id))
 
-        column_index = 0
-        for cell in raw_row:
-            column = columnHeaders[column_index]
+def _mcf_row_projection(column_headers: t.List[dict], view_id: str = None) -> t.Callable[[list], list]:
+    """Returns a function which maps a Multi-Channel Funnels API row to a CSV row"""
+    import json
 
-            if column['dataType'] == 'MCF_SEQUENCE':
-                row.append(json.dumps(cell['conversionPathValue']))
-            else:
-                row.append(cell['primitiveValue'])
+    prefix = [str(view_id)] if view_id != None else []
+    sequence_columns = [len(prefix) + index for index, column in enumerate(column_headers)
+                        if column['dataType'] == 'MCF_SEQUENCE']
+    if not sequence_columns:
+        return lambda raw_row: prefix + [cell['primitiveValue'] for cell in raw_row]
 
-            column_index += 1
+    def project(raw_row: list) -> list:
+        row = prefix + raw_row
+        for index in sequence_columns:
+            row[index] = json.dumps(row[index]['conversionPathValue'])
+        for index in range(len(prefix), len(row)):
+            if type(row[index]) is dict:
+                row[index] = row[index]['primitiveValue']
+        return row
 
-        csv_writer.writerow(row)
-        n_rows += 1
+    return project
+
+
+def _async_engine_is_available() -> bool:
+    """If the asyncio engine can be used, without importing asyncio at startup"""
+    from mara_google_analytics_downloader.async_engine import is_available
+    return is_available()
+
+
+def _set_columns(stream, columns: t.Callable[[], t.List[t.Tuple[str, str]]]):
+    """Passes the names and API types of the columns to a stream which needs them, e.g. a ColumnarWriter"""
+    if hasattr(stream, 'set_columns'):
+        stream.set_columns(columns())
+
+
+def _csv_writer(stream: t.TextIO, delimiter_char: str):
+    """A csv writer in the csv.excel dialect with a custom delimiter, without changing csv.excel itself
+
+    A row sink (see `download`) is returned as is.
+    """
+    import csv
+
+    if _is_row_sink(stream):
+        return stream
+    return csv.writer(stream, dialect=csv.excel, delimiter=delimiter_char)
 
-    return n_rows
 
 if __name__ == '__main__':
     ga_download_to_csv(prog_name='mara_google_analytics_downloader')
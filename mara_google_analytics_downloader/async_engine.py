@@ -0,0 +1,314 @@
+"""An asyncio engine for the Reporting API V4 and the Multi-Channel Funnels API
+
+The default engine sends each request from a thread with google-api-python-client, so the number of requests in
+flight is the number of threads. Here the requests are sent with the asyncio HTTP client aiohttp from one thread,
+so that hundreds of view/date range requests can be in flight with little overhead:
+
+    async with AsyncClient(credentials, max_concurrency=100) as client:
+        async for index, report in client.report_pages(report_requests):
+            ...
+        async for response in client.mcf_pages(view_id, '30daysAgo', 'today', metrics='mcf:totalConversions'):
+            ...
+
+Requests pass the same rate limiter, retry policy and response cache as in the default engine, their SQLite
+transactions run in threads. Access tokens are refreshed without blocking the event loop, only once for all
+requests waiting for a token.
+
+Needs the optional package aiohttp (`pip install aiohttp`).
+"""
+
+import asyncio
+import collections
+import datetime
+import json
+import sys
+import time
+import typing as t
+import urllib.parse
+
+from mara_google_analytics_downloader.date_ranges import resolve_date
+from mara_google_analytics_downloader.rate_limiting import rate_limiter
+from mara_google_analytics_downloader.reporting import batch_report_requests
+from mara_google_analytics_downloader.response_cache import cache_key, ga_cache_key, response_cache
+from mara_google_analytics_downloader.retry import RetryPolicy, is_rate_limit_error
+from mara_google_analytics_downloader.telemetry import telemetry
+
+REPORTING_API_ROOT_URL = 'https://analyticsreporting.googleapis.com/'
+"""The root url of the Reporting API V4"""
+
+ANALYTICS_API_ROOT_URL = 'https://www.googleapis.com/'
+"""The root url of the Analytics API V3 which contains the Multi-Channel Funnels API"""
+
+
+def is_available() -> bool:
+    """If aiohttp is installed"""
+    try:
+        import aiohttp
+        return True
+    except ImportError:
+        return False
+
+
+class AsyncClient:
+    def __init__(self, credentials,
+                 max_concurrency: int = 100,
+                 retry_policy: RetryPolicy = None,
+                 timeout: float = 600,
+                 reporting_api_root_url: str = REPORTING_API_ROOT_URL,
+                 analytics_api_root_url: str = ANALYTICS_API_ROOT_URL) -> None:
+        """
+        Sends requests to the Google Analytics APIs from an event loop, use it as async context manager
+
+        Args:
+            credentials: the oauth2client credentials
+            max_concurrency: the maximum number of requests in flight (and of open connections)
+            retry_policy: the retry policy for transient errors (default: `RetryPolicy()`)
+            timeout: the timeout of a request in seconds
+            reporting_api_root_url: the root url of the Reporting API V4, e.g. of a local fake server
+            analytics_api_root_url: the root url of the Analytics API V3
+        """
+        self.credentials = credentials
+        self.max_concurrency = max_concurrency
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.timeout = timeout
+        self.reporting_api_root_url = reporting_api_root_url
+        self.analytics_api_root_url = analytics_api_root_url
+        self._session = None
+        self._semaphore = None
+        self._token_lock = None
+
+    async def __aenter__(self) -> 'AsyncClient':
+        import aiohttp
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._token_lock = asyncio.Lock()
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def report_pages(self, report_requests: t.List[dict],
+                           max_pages_in_flight: int = 10) -> t.AsyncIterator[t.Tuple[int, dict]]:
+        """
+        Sends report requests in as few batchGet calls as possible and follows the pages of each report
+
+        The asynchronous version of `reporting.iter_report_pages`: yields (index of the report request, report)
+        tuples, one per received page. The batches of the report requests are requested concurrently. At most
+        `max_pages_in_flight` received pages wait to be yielded, a batch requests its next page only when its
+        pages are taken.
+        """
+        batches = batch_report_requests(report_requests)
+        queue = asyncio.Queue(maxsize=max_pages_in_flight)
+
+        async def follow_batch(batch: t.List[int]):
+            page_tokens = {index: None for index in batch}
+            while page_tokens:
+                indexes = list(page_tokens.keys())
+                body = {'reportRequests': [dict(report_requests[index], pageToken=page_tokens[index])
+                                           if page_tokens[index] else report_requests[index]
+                                           for index in indexes]}
+                response = await self.batch_get(body)
+                reports = response.get('reports', [])
+                if len(reports) != len(indexes):
+                    raise RuntimeError(f'Expected {len(indexes)} reports in the batchGet response, got {len(reports)}')
+                for index, report in zip(indexes, reports):
+                    await queue.put((index, report))
+                    if report.get('nextPageToken'):
+                        page_tokens[index] = report['nextPageToken']
+                    else:
+                        del page_tokens[index]
+
+        async def follow_batches():
+            try:
+                await asyncio.gather(*map(follow_batch, batches))
+                await queue.put(None)
+            except BaseException as e:
+                await queue.put(e)
+
+        task = asyncio.ensure_future(follow_batches())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            task.cancel()
+
+    async def mcf_pages(self, view_id: t.Union[int, str], start_date: str, end_date: str, metrics: str,
+                        dimensions: str = None, filters: str = None,
+                        max_pages_in_flight: int = 10) -> t.AsyncIterator[dict]:
+        """
+        Yields the responses of all pages of a Multi-Channel Funnels API query, in the order of the pages
+
+        The pages after the first one are computed from its 'totalResults' and requested concurrently. At most
+        `max_pages_in_flight` pages are requested or received but not yet yielded at any time, like in
+        `parallel.ordered_map`.
+        """
+        query = {'ids': f'ga:{view_id}', 'start-date': start_date, 'end-date': end_date, 'metrics': metrics}
+        if dimensions:
+            query['dimensions'] = dimensions
+        if filters:
+            query['filters'] = filters
+
+        response = await self.mcf_get(query, view_id)
+        yield response
+        if 'nextLink' not in response:
+            return
+        items_per_page = response.get('itemsPerPage', 1000)
+        pending = collections.deque()
+        try:
+            for start_index in range(1 + items_per_page, response.get('totalResults', 0) + 1, items_per_page):
+                pending.append(asyncio.ensure_future(self.mcf_get(dict(query, **{'start-index': start_index}),
+                                                                  view_id)))
+                if len(pending) >= max_pages_in_flight:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for page in pending:
+                page.cancel()
+
+    async def batch_get(self, body: dict) -> dict:
+        """Sends a batchGet request of the Reporting API V4, see `reporting`"""
+        view_id = body['reportRequests'][0].get('viewId')
+        url = self.reporting_api_root_url + 'v4/reports:batchGet'
+        if not response_cache():
+            return await self._execute('POST', url, view_id, body)
+
+        key, end_date = ga_cache_key(body)
+        response = await _in_thread(response_cache().get, key)
+        if response is None:
+            response = await self._execute('POST', url, view_id, body)
+            await _in_thread(response_cache().put, key, response, end_date, all(
+                report.get('data', {}).get('isDataGolden') is not False for report in response.get('reports', [])))
+        return response
+
+    async def mcf_get(self, query: dict, view_id: t.Union[int, str]) -> dict:
+        """Sends a request of the Multi-Channel Funnels API with the query parameters"""
+        url = self.analytics_api_root_url + 'analytics/v3/data/mcf?' + urllib.parse.urlencode(query)
+        if not response_cache():
+            return await self._execute('GET', url, view_id)
+
+        end_date = resolve_date(query['end-date'])
+        # the same key as in the default engine
+        key = cache_key(api='mcf', view_id=str(view_id), start_date=resolve_date(query['start-date']),
+                        end_date=end_date, metrics=query['metrics'], dimensions=query.get('dimensions'),
+                        filters=query.get('filters'), start_index=query.get('start-index', 1))
+        response = await _in_thread(response_cache().get, key)
+        if response is None:
+            response = await self._execute('GET', url, view_id)
+            await _in_thread(response_cache().put, key, response, end_date)
+        return response
+
+    async def _execute(self, method: str, url: str, view_id: t.Union[int, str], body: dict = None) -> dict:
+        """Sends a request, retries it with exponential backoff when it fails with a transient error"""
+        import aiohttp
+
+        limiter = rate_limiter()
+        api = 'ga' if 'batchGet' in url else 'mcf'
+        retry, backoff_seconds, rate_limited_errors = 0, 0.0, 0
+        refreshed_token = False
+        while True:
+            await limiter.acquire_async(view_id)
+            start = time.monotonic()
+            try:
+                async with self._semaphore:
+                    response, bytes_received = await self._send(method, url, body)
+                await _in_thread(limiter.report_success, view_id)
+                telemetry().record_request(api, view_id, time.monotonic() - start, response,
+                                           bytes_received=bytes_received, retries=retry,
+                                           backoff_seconds=backoff_seconds, rate_limited_errors=rate_limited_errors)
+                return response
+            except Exception as e:
+                if getattr(getattr(e, 'resp', None), 'status', None) == 401 and not refreshed_token:
+                    # the access token was revoked or expired early
+                    self.credentials.access_token = None
+                    refreshed_token = True
+                    continue
+                if is_rate_limit_error(e):
+                    await _in_thread(limiter.report_rate_limited, view_id)
+                    rate_limited_errors += 1
+                retryable = isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)) \
+                            or self.retry_policy.is_retryable(e)
+                if retry >= self.retry_policy.max_retries or not retryable:
+                    telemetry().record_request(api, view_id, time.monotonic() - start, retries=retry,
+                                               backoff_seconds=backoff_seconds,
+                                               rate_limited_errors=rate_limited_errors, error=e)
+                    raise e
+                sleep_seconds = self.retry_policy.backoff_seconds(retry, e)
+                print(f'Got exception, but will retry again in {sleep_seconds:.1f} seconds: {e!r}',
+                      file=sys.stderr, flush=True)
+                await asyncio.sleep(sleep_seconds)
+                backoff_seconds += sleep_seconds
+                retry += 1
+
+    async def _send(self, method: str, url: str, body: dict = None) -> t.Tuple[dict, int]:
+        """Sends one try of a request, returns the response and the number of bytes of its body"""
+        from googleapiclient.errors import HttpError
+        import httplib2
+
+        headers = {'authorization': f'Bearer {await self._access_token()}', 'accept-encoding': 'gzip'}
+        async with self._session.request(method, url, json=body, headers=headers) as response:
+            content = await response.read()
+            if response.status >= 300:
+                # raise the same exception as google-api-python-client, so that errors are classified the same way
+                resp = httplib2.Response({'status': response.status,
+                                          **{key.lower(): value for key, value in response.headers.items()}})
+                resp.reason = response.reason
+                raise HttpError(resp, content, uri=url)
+            return json.loads(content.decode('utf-8')), len(content)
+
+    async def _access_token(self) -> str:
+        """A valid access token, refreshed once for all waiting requests when it is expired"""
+        credentials = self.credentials
+        if credentials.access_token and not credentials.access_token_expired:
+            return credentials.access_token
+        async with self._token_lock:
+            if credentials.access_token and not credentials.access_token_expired:
+                return credentials.access_token
+            if getattr(credentials, 'store', None):
+                # the token cache locks a file, see the module `token_cache`
+                await _in_thread(credentials.get_access_token)
+            else:
+                await self._refresh_access_token()
+            return credentials.access_token
+
+    async def _refresh_access_token(self):
+        """Requests a new access token like `oauth2client.client.OAuth2Credentials.refresh`, without blocking"""
+        import oauth2client.client
+
+        credentials = self.credentials
+        async with self._session.post(credentials.token_uri, data=credentials._generate_refresh_request_body(),
+                                      headers=credentials._generate_refresh_request_headers()) as response:
+            content = await response.read()
+            status = response.status
+        token_response = json.loads(content.decode('utf-8')) if content else {}
+        if status != 200 or 'access_token' not in token_response:
+            raise oauth2client.client.HttpAccessTokenRefreshError(
+                f'{token_response.get("error", "Invalid response")}: {token_response.get("error_description", "")}',
+                status=status)
+        credentials.token_response = token_response
+        credentials.access_token = token_response['access_token']
+        credentials.refresh_token = token_response.get('refresh_token', credentials.refresh_token)
+        credentials.token_expiry = (datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=int(token_response['expires_in'])) if 'expires_in' in token_response else None)
+        credentials.invalid = False
+
+
+async def _in_thread(function: t.Callable, *args):
+    """Calls a blocking function (e.g. a SQLite transaction of the rate limiter or the cache) in a thread"""
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+def run(coroutine):
+    """Runs a coroutine in a new event loop (`asyncio.run` is not available in Python 3.6)"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
@@ -0,0 +1,91 @@
+"""Checkpoints for resuming paged downloads
+
+The rows of a download are appended page by page to a spool file. After each page the spool file is synced and
+the position of the next page is recorded. A download which fails can then be resumed from the last recorded
+page. The spool file is written to the output stream only when the download is complete, so a consumer like
+COPY never sees a partial download.
+
+Checkpoints are identified by a fingerprint of the query, see `query_fingerprint`.
+"""
+
+import json
+import os
+import typing as t
+
+
+def query_fingerprint(**query) -> str:
+    """A stable hash of the query arguments, e.g. view id, absolute dates, metrics, dimensions and filters"""
+    import hashlib
+
+    return hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Checkpoint:
+    def __init__(self, directory: str, fingerprint: str) -> None:
+        """
+        The checkpoint of a single paged download
+
+        Args:
+            directory: the directory where checkpoint and spool files are kept
+            fingerprint: the fingerprint of the query, see `query_fingerprint`
+        """
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.state_path = os.path.join(directory, f'{fingerprint}.json')
+        self.spool_path = os.path.join(directory, f'{fingerprint}.csv')
+        self.spool: t.Optional[t.TextIO] = None
+
+    def start(self, resume: bool = True) -> t.Tuple[t.Any, int]:
+        """
+        Opens the spool file for appending the next pages
+
+        Args:
+            resume: if the download should continue from the last recorded page. If False, or if there is no
+                    checkpoint yet, the download starts from the beginning.
+
+        Returns:
+            The position of the next page (None for the first page) and the number of rows already downloaded
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        state = None
+        if resume and os.path.exists(self.state_path) and os.path.exists(self.spool_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+
+        # newline='' as recommended for csv writers
+        self.spool = open(self.spool_path, 'a+' if state else 'w+', newline='', encoding='utf-8')
+        if state:
+            # drop rows written after the last recorded page
+            self.spool.truncate(state['spool_size'])
+            self.spool.seek(state['spool_size'])
+            return state['next_page'], state['nrows']
+        self._remove(self.state_path)
+        return None, 0
+
+    def commit(self, next_page, nrows: int):
+        """Records that all pages before `next_page` are completely written to the spool file"""
+        self.spool.flush()
+        os.fsync(self.spool.fileno())
+
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'next_page': next_page, 'nrows': nrows, 'spool_size': self.spool.tell()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def finish(self, stream: t.TextIO):
+        """Writes the complete download to the stream and removes the checkpoint"""
+        import shutil
+
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, stream)
+        stream.flush()
+        self.spool.close()
+        self._remove(self.state_path)
+        self._remove(self.spool_path)
+
+    def _remove(self, path: str):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,163 @@
+"""Columnar output of downloads as Parquet or Arrow IPC files
+
+The rows of the pages are buffered and written as record batches (Parquet row groups) of at least
+`min_rows_per_batch` rows, so that small pages do not lead to many small row groups. The column types are derived from the types in the
+responses: `metricHeaderEntries[].type` of the Reporting API V4 and `columnHeaders[].dataType` of the
+Multi-Channel Funnels API. Dimensions and unknown types are written as strings, Multi-Channel Funnels paths as
+JSON strings.
+
+The file is written to a temporary path first and renamed when the download is complete, so that readers never
+see a partial download.
+
+Needs the optional package pyarrow (`pip install pyarrow`).
+"""
+
+import os
+import typing as t
+
+from mara_google_analytics_downloader.date_ranges import COMPARE_COLUMN_SUFFIX
+
+OUTPUT_FORMATS = ('parquet', 'arrow-ipc')
+
+_ARROW_TYPES = {
+    'INTEGER': 'int64',
+    'FLOAT': 'float64',
+    'CURRENCY': 'float64',
+    'PERCENT': 'float64',
+    'TIME': 'float64',
+}
+"""The arrow types of the metric types of the APIs, all other types are written as strings"""
+
+
+def is_available() -> bool:
+    """If pyarrow is installed"""
+    try:
+        import pyarrow
+        return True
+    except ImportError:
+        return False
+
+
+def ga_columns(column_header: dict, add_view_id_column: bool = False,
+               date_range_layout: str = None) -> t.List[t.Tuple[str, str]]:
+    """The names and API types of the columns of a Reporting API V4 report, see `ColumnarWriter.set_columns`
+
+    With a `date_range_layout` (see `mara_google_analytics_downloader.date_ranges.DATE_RANGE_LAYOUTS`), the columns
+    of a report with two date ranges.
+    """
+    metric_columns = [(metric['name'], metric.get('type', 'STRING'))
+                      for metric in column_header.get('metricHeader', {}).get('metricHeaderEntries', [])]
+    columns = [('vid', 'STRING')] if add_view_id_column else []
+    if date_range_layout == 'rows':
+        columns.append(('date_range', 'INTEGER'))
+    columns += [(dimension, 'STRING') for dimension in column_header.get('dimensions', [])]
+    columns += metric_columns
+    if date_range_layout == 'columns':
+        columns += [(name + COMPARE_COLUMN_SUFFIX, api_type) for name, api_type in metric_columns]
+    return columns
+
+
+def mcf_columns(column_headers: t.List[dict], add_view_id_column: bool = False) -> t.List[t.Tuple[str, str]]:
+    """The names and API types of the columns of a Multi-Channel Funnels API response"""
+    columns = [('vid', 'STRING')] if add_view_id_column else []
+    columns += [(column['name'], column.get('dataType', 'STRING')) for column in column_headers]
+    return columns
+
+
+class ColumnarWriter:
+    def __init__(self, path: str, output_format: str = 'parquet', min_rows_per_batch: int = 65536) -> None:
+        """
+        Writes rows as Parquet or Arrow IPC file
+
+        The writer is used as stream of `mara_google_analytics_downloader.__main__.download`: it gets the columns
+        with `set_columns`, the rows with `writerows` and `flush` is called after each page.
+
+        Args:
+            path: the path of the file
+            output_format: 'parquet' or 'arrow-ipc'
+            min_rows_per_batch: the rows are buffered until a record batch of at least this many rows can be
+                                written, only the last batch can be smaller
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unsupported output format "{output_format}", use one of {", ".join(OUTPUT_FORMATS)}')
+        self.path = path
+        self.output_format = output_format
+        self.min_rows_per_batch = min_rows_per_batch
+        self.columns: t.Optional[t.List[t.Tuple[str, str]]] = None
+        self._tmp_path = path + '.tmp'
+        self._schema = None
+        self._writer = None
+        self._rows = []
+
+    def set_columns(self, columns: t.List[t.Tuple[str, str]]):
+        """Sets the names and API types of the columns, see `ga_columns` and `mcf_columns`"""
+        if self.columns is None:
+            self.columns = list(columns)
+        elif [name for name, _ in columns] != [name for name, _ in self.columns]:
+            raise ValueError(f'Got the columns {[name for name, _ in columns]} after the columns '
+                             f'{[name for name, _ in self.columns]}, all pages need to have the same columns')
+
+    def writerow(self, row: list):
+        self._rows.append(row)
+
+    def writerows(self, rows: t.Iterable[list]):
+        self._rows.extend(rows)
+
+    def flush(self):
+        """Writes the buffered rows as a record batch when there are at least `min_rows_per_batch` of them"""
+        if len(self._rows) >= self.min_rows_per_batch:
+            self._write_batch()
+
+    def close(self):
+        """Writes the remaining rows and moves the file to its path"""
+        self._write_batch()
+        self._open()
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Removes the partially written file"""
+        if self._writer:
+            self._writer.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def _write_batch(self):
+        """Writes the buffered rows as a record batch"""
+        if not self._rows:
+            return
+        import pyarrow
+
+        if self.columns is None:
+            raise ValueError('Got rows before the columns')
+        self._open()
+        columns = list(zip(*self._rows))
+        if len(columns) != len(self.columns):
+            raise ValueError(f'Got rows with {len(columns)} values for {len(self.columns)} columns')
+        arrays = []
+        for values, field in zip(columns, self._schema):
+            if pyarrow.types.is_string(field.type):
+                arrays.append(pyarrow.array(values, pyarrow.string()))
+            else:
+                # the APIs return all values as strings, empty strings become nulls
+                arrays.append(pyarrow.array([value or None for value in values], pyarrow.string()).cast(field.type))
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self._schema)
+        if self.output_format == 'parquet':
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self._rows = []
+
+    def _open(self):
+        if self._writer:
+            return
+        import pyarrow
+
+        self._schema = pyarrow.schema(
+            [(name, getattr(pyarrow, _ARROW_TYPES.get(api_type, 'string'))()) for name, api_type in self.columns or []])
+        if self.output_format == 'parquet':
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(self._tmp_path, self._schema)
+        else:
+            import pyarrow.ipc
+            self._writer = pyarrow.ipc.new_file(self._tmp_path, self._schema)
@@ -31,3 +31,82 @@ def ga_user_account_client_secret()-> t.Optional[str]:
 def ga_user_account_refresh_token()-> t.Optional[str]:
     """Google User Account refresh_token used to download the Google Analytics Data"""
     return None
+
+def ga_use_static_discovery_document()-> bool:
+    """If the discovery documents are taken from the copy bundled with google-api-python-client (>= 2.0)
+    instead of being downloaded on each run"""
+    return True
+
+def ga_api_root_url()-> t.Optional[str]:
+    """The root url of the Reporting API V4 and of the Analytics API V3, e.g. of the local fake server in
+    `benchmarks/fake_api.py`. If None, the Google APIs are used."""
+    return None
+
+def ga_token_uri()-> t.Optional[str]:
+    """The url from which access tokens are requested. If None, the Google OAuth 2.0 token endpoint is used."""
+    return None
+
+def ga_requests_per_second_limit()-> t.Optional[float]:
+    """The maximum number of requests per second for all views, None for no limit (the default).
+    E.g. 20 for the Reporting API V4 limit of 2000 requests per 100 seconds per project."""
+    return None
+
+def ga_requests_per_second_per_view_limit()-> t.Optional[float]:
+    """The maximum number of requests per second for a single view, None for no limit (the default).
+    Google Analytics limits the concurrent requests of a view (10), not its requests per second; the concurrency
+    is bounded by the number of workers, see `--max-workers` and `--page-workers`."""
+    return None
+
+def ga_requests_per_day_limit()-> t.Optional[int]:
+    """The maximum number of requests per day for all views, None for no limit (the default), e.g. 50000 for the
+    Reporting API V4 quota per project. Only counted over processes when a rate limit state file is configured."""
+    return None
+
+def ga_requests_per_day_per_view_limit()-> t.Optional[int]:
+    """The maximum number of requests per day for a single view, None for no limit (the default), e.g. 10000 for
+    the Reporting API V4 quota per view. Only counted over processes when a rate limit state file is configured."""
+    return None
+
+def ga_rate_limit_state_file()-> t.Optional[str]:
+    """A SQLite file in which the rate limits are shared between downloader processes on the same host.
+    If None, the rate limits are only shared within a process."""
+    return None
+
+def ga_response_cache_file()-> t.Optional[str]:
+    """A SQLite file in which the received pages are cached, so that reruns do not download historical data again.
+    If None, no pages are cached."""
+    return None
+
+def ga_response_cache_max_size()-> int:
+    """The maximum size of the response cache in bytes, the least recently used pages are removed first"""
+    return 1024 ** 3
+
+def ga_response_cache_freshness_days()-> int:
+    """Pages of queries which end within the last days can still change and are cached only for
+    `ga_response_cache_ttl_seconds`. Older pages never expire."""
+    return 3
+
+def ga_response_cache_ttl_seconds()-> float:
+    """How long pages with recent dates are cached"""
+    return 3600
+
+def ga_token_cache_file()-> t.Optional[str]:
+    """A file in which the access tokens are shared between downloader processes on the same host, so that not every
+    process requests its own token. If None, each process requests a token."""
+    return None
+
+def ga_worker_socket()-> t.Optional[str]:
+    """The Unix socket of a running downloader worker (see `mara-google-analytics-downloader-worker`) which runs the
+    downloads of the pipelines. If None, each download runs in its own process."""
+    return None
+
+def ga_telemetry_json_lines()-> bool:
+    """If a JSON line with the latency, bytes, rows, retries and backoff time of each request and the totals of each
+    download is written to stderr, see the module `telemetry`"""
+    return False
+
+def ga_telemetry_prometheus_dir()-> t.Optional[str]:
+    """A directory in which each `DownloadGoogleAnalyticsFlatTable` writes the totals of its last download to
+    `<target table name>.prom` in the Prometheus text format, e.g. the directory of the textfile collector of
+    node_exporter. If None, no files are written."""
+    return None
@@ -0,0 +1,355 @@
+"""Loading of downloads into PostgreSQL with COPY, in the process of the download
+
+Instead of piping the output of the downloader into `psql`, the rows are passed through a bounded queue to a
+`COPY ... FROM STDIN` of psycopg2 while the download is running. The COPY uses either the CSV format (the same as
+the shell pipe) or the binary format of PostgreSQL, see
+    https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+
+For the binary format, the values are encoded according to the column types of the target table. Empty strings
+are loaded as NULL in both formats.
+"""
+
+import csv
+import datetime
+import decimal
+import io
+import queue
+import struct
+import threading
+import typing as t
+
+MAX_BUFFER_SIZE = 1024 * 1024
+"""The maximum number of bytes kept in a sink before they are passed to the COPY"""
+
+
+def copy_to_table(db_alias: str, target_table: str, download: t.Callable[[t.Any], int],
+                  delimiter_char: str = '\t', copy_format: str = 'csv',
+                  on_progress: t.Callable[[int, int], None] = None,
+                  sql_before: t.List[str] = None, sql_after: t.List[str] = None) -> int:
+    """
+    Runs a download and loads its rows with a COPY into a PostgreSQL table
+
+    Args:
+        db_alias: the mara db alias of the target database
+        target_table: the schema qualified name of the target table, it needs to exist
+        download: a function which writes rows into the sink that it gets passed (an object with the methods
+                  `writerow`, `writerows` and `flush`) and returns the number of rows, e.g. a call of
+                  `mara_google_analytics_downloader.__main__.download` with the sink as stream
+        delimiter_char: the delimiter of the CSV format
+        copy_format: 'csv' or 'binary'
+        on_progress: called after each page with the number of rows and of bytes loaded so far
+        sql_before: statements which are executed before the COPY in the same transaction, e.g. a DELETE
+        sql_after: statements which are executed after the COPY in the same transaction
+
+    Returns:
+        The number of rows loaded
+    """
+    from mara_db.postgresql import postgres_cursor_context
+
+    if copy_format not in ('csv', 'binary'):
+        raise ValueError(f'Unsupported copy format "{copy_format}", use "csv" or "binary"')
+
+    with postgres_cursor_context(db_alias) as cursor:
+        for statement in sql_before or []:
+            cursor.execute(statement)
+
+        if copy_format == 'binary':
+            sink = _BinarySink(_column_encoders(cursor, target_table), on_progress)
+            sql = f'COPY {target_table} FROM STDIN WITH (FORMAT binary)'
+        else:
+            sink = _CsvSink(delimiter_char, on_progress)
+            sql = (f'COPY {target_table} FROM STDIN WITH (FORMAT csv, '
+                   f"DELIMITER {_quote_literal(delimiter_char)}, NULL '')")
+
+        result = {}
+
+        def produce():
+            try:
+                result['nrows'] = download(sink)
+                sink.close()
+            except BaseException as e:
+                result['exception'] = e
+                sink.abort()
+
+        producer = threading.Thread(target=produce, name='copy-producer', daemon=True)
+        producer.start()
+        try:
+            cursor.copy_expert(sql, sink.reader, size=64 * 1024)
+        except BaseException:
+            # unblock the producer. When the download failed, its exception is the more helpful one
+            sink.reader.abort()
+            producer.join()
+            if 'exception' in result and not isinstance(result['exception'], _CopyFailed):
+                raise result['exception']
+            raise
+        producer.join()
+        if 'exception' in result:
+            # the cursor context rolls back the COPY
+            raise result['exception']
+
+        for statement in sql_after or []:
+            cursor.execute(statement)
+        return result['nrows']
+
+
+class _CopyFailed(RuntimeError):
+    pass
+
+
+class _QueueReader:
+    """A file-like object for `copy_expert` which reads the chunks that a sink puts into a bounded queue"""
+
+    def __init__(self, maxsize: int = 16) -> None:
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._buffer = bytearray()
+        self._done = False
+        self._aborted = threading.Event()
+
+    def put(self, chunk: t.Optional[bytes]):
+        """Passes a chunk to the reader (None for the end), blocks while the queue is full"""
+        while True:
+            if self._aborted.is_set():
+                raise _CopyFailed('The COPY into the target table failed')
+            try:
+                self._queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def abort(self):
+        """Called by the consumer when the COPY failed, the next `put` of the producer raises"""
+        self._aborted.set()
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            chunk = self._queue.get()
+            if chunk is None:
+                self._done = True
+            elif isinstance(chunk, BaseException):
+                # makes copy_expert fail, so that the COPY is not committed
+                raise chunk
+            else:
+                self._buffer += chunk
+        # bytearray grows and shrinks in place, so that small reads of large chunks are not quadratic
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+
+class _Sink:
+    """Receives the rows of a download, encodes them and passes them to the reader of the COPY"""
+
+    def __init__(self, on_progress: t.Callable[[int, int], None] = None) -> None:
+        self.reader = _QueueReader()
+        self.on_progress = on_progress
+        self.nrows = 0
+        self.nbytes = 0
+
+    def writerow(self, row: list):
+        self.writerows([row])
+
+    def writerows(self, rows: t.Iterable[list]):
+        for row in rows:
+            self._encode(row)
+            self.nrows += 1
+        if self._buffer_size() >= MAX_BUFFER_SIZE:
+            self._pass_buffer()
+
+    def flush(self):
+        """Passes the buffered rows to the COPY and reports the progress, called after each page"""
+        self._pass_buffer()
+        if self.on_progress:
+            self.on_progress(self.nrows, self.nbytes)
+
+    def close(self):
+        self._pass_buffer()
+        self.reader.put(self._trailer())
+        self.reader.put(None)
+
+    def abort(self):
+        """Makes the COPY fail, called by the producer after the download failed"""
+        try:
+            self.reader.put(RuntimeError('The download failed'))
+        except _CopyFailed:
+            # the COPY failed already
+            pass
+
+    def _pass_buffer(self):
+        chunk = self._take_buffer()
+        if chunk:
+            self.nbytes += len(chunk)
+            self.reader.put(chunk)
+
+    def _encode(self, row: list):
+        raise NotImplementedError()
+
+    def _buffer_size(self) -> int:
+        raise NotImplementedError()
+
+    def _take_buffer(self) -> bytes:
+        raise NotImplementedError()
+
+    def _trailer(self) -> bytes:
+        return b''
+
+
+class _CsvSink(_Sink):
+    """Encodes the rows in the csv.excel dialect, like the output of the downloader"""
+
+    def __init__(self, delimiter_char: str, on_progress: t.Callable[[int, int], None] = None) -> None:
+        super().__init__(on_progress)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, dialect=csv.excel, delimiter=delimiter_char)
+
+    def writerows(self, rows: t.Iterable[list]):
+        rows = rows if isinstance(rows, list) else list(rows)
+        self._writer.writerows(rows)
+        self.nrows += len(rows)
+        if self._buffer_size() >= MAX_BUFFER_SIZE:
+            self._pass_buffer()
+
+    def _encode(self, row: list):
+        self._writer.writerow(row)
+
+    def _buffer_size(self) -> int:
+        return self._buffer.tell()
+
+    def _take_buffer(self) -> bytes:
+        chunk = self._buffer.getvalue().encode('utf-8')
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return chunk
+
+
+_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_BINARY_TRAILER = struct.pack('!h', -1)
+_NULL = struct.pack('!i', -1)
+
+
+class _BinarySink(_Sink):
+    """Encodes the rows in the binary COPY format of PostgreSQL"""
+
+    def __init__(self, encoders: t.List[t.Callable[[str], bytes]],
+                 on_progress: t.Callable[[int, int], None] = None) -> None:
+        super().__init__(on_progress)
+        self.encoders = encoders
+        self._field_count = struct.pack('!h', len(encoders))
+        self._buffer = bytearray(_BINARY_HEADER)
+
+    def _encode(self, row: list):
+        if len(row) != len(self.encoders):
+            raise ValueError(f'Got a row with {len(row)} values for a table with {len(self.encoders)} columns')
+        buffer = self._buffer
+        buffer += self._field_count
+        for encode, value in zip(self.encoders, row):
+            if value is None or value == '':
+                buffer += _NULL
+            else:
+                data = encode(str(value))
+                buffer += struct.pack('!i', len(data))
+                buffer += data
+
+    def _buffer_size(self) -> int:
+        return len(self._buffer)
+
+    def _take_buffer(self) -> bytes:
+        chunk, self._buffer = bytes(self._buffer), bytearray()
+        return chunk
+
+    def _trailer(self) -> bytes:
+        return _BINARY_TRAILER
+
+
+def _column_encoders(cursor, target_table: str) -> t.List[t.Callable[[str], bytes]]:
+    """The binary encoders for the columns of the target table"""
+    cursor.execute('''
+SELECT attname, format_type(atttypid, NULL), typname
+FROM pg_attribute
+  JOIN pg_type ON pg_type.oid = atttypid
+WHERE attrelid = %s::REGCLASS AND attnum > 0 AND NOT attisdropped
+ORDER BY attnum''', (target_table,))
+    encoders = []
+    for column_name, column_type, type_name in cursor.fetchall():
+        if type_name not in _ENCODERS:
+            raise ValueError(f'The column "{column_name}" of {target_table} has the type {column_type} '
+                             f'which is not supported by the binary COPY, use the csv format instead')
+        encoders.append(_ENCODERS[type_name])
+    return encoders
+
+
+def _encode_numeric(value: str) -> bytes:
+    """The binary representation of a numeric: base 10000 digits with weight, sign and display scale"""
+    number = decimal.Decimal(value)
+    if number.is_nan():
+        return struct.pack('!hhHh', 0, 0, 0xC000, 0)
+    if not number.is_finite():
+        raise ValueError(f'Can not load "{value}" into a numeric column')
+
+    sign, digits, exponent = number.as_tuple()
+    digits = ''.join(map(str, digits))
+    if exponent >= 0:
+        integer_part, fraction_part = digits + '0' * exponent, ''
+    else:
+        digits = digits.rjust(-exponent, '0')
+        integer_part, fraction_part = digits[:exponent], digits[exponent:]
+    integer_part = integer_part.rjust((len(integer_part) + 3) // 4 * 4, '0')
+    fraction_part = fraction_part.ljust((len(fraction_part) + 3) // 4 * 4, '0')
+
+    groups = [int(part[i:i + 4]) for part in (integer_part, fraction_part) for i in range(0, len(part), 4)]
+    weight = len(integer_part) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+
+    return struct.pack(f'!hhHh{len(groups)}h', len(groups), weight, 0x4000 if sign else 0,
+                       max(0, -exponent), *groups)
+
+
+_POSTGRES_EPOCH = datetime.date(2000, 1, 1)
+
+
+def _encode_date(value: str) -> bytes:
+    """The days since 2000-01-01, from YYYYMMDD (like ga:date) or YYYY-MM-DD"""
+    date = datetime.datetime.strptime(value, '%Y-%m-%d' if '-' in value else '%Y%m%d').date()
+    return struct.pack('!i', (date - _POSTGRES_EPOCH).days)
+
+
+def _encode_bool(value: str) -> bytes:
+    if value.lower() in ('t', 'true', 'y', 'yes', '1'):
+        return b'\x01'
+    if value.lower() in ('f', 'false', 'n', 'no', '0'):
+        return b'\x00'
+    raise ValueError(f'Can not load "{value}" into a boolean column')
+
+
+def _encode_text(value: str) -> bytes:
+    return value.encode('utf-8')
+
+
+_ENCODERS = {
+    'text': _encode_text,
+    'varchar': _encode_text,
+    'bpchar': _encode_text,
+    'json': _encode_text,
+    'jsonb': lambda value: b'\x01' + value.encode('utf-8'),
+    'int2': lambda value: struct.pack('!h', int(value)),
+    'int4': lambda value: struct.pack('!i', int(value)),
+    'int8': lambda value: struct.pack('!q', int(value)),
+    'float4': lambda value: struct.pack('!f', float(value)),
+    'float8': lambda value: struct.pack('!d', float(value)),
+    'numeric': _encode_numeric,
+    'date': _encode_date,
+    'bool': _encode_bool,
+}
+
+
+def _quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
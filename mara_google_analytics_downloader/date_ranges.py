@@ -0,0 +1,95 @@
+"""Resolving and splitting of Google Analytics date ranges"""
+
+import datetime
+import re
+import typing as t
+
+DATE_RANGE_LAYOUTS = ['rows', 'columns']
+"""How the metrics of two date ranges of a Reporting API V4 request are written, see
+`mara_google_analytics_downloader.__main__.write_ga_response_as_csv_to_stream`"""
+
+COMPARE_COLUMN_SUFFIX = '_compare'
+"""The suffix of the metric columns of the second date range with the date range layout 'columns'"""
+
+
+def resolve_date(value: str, today: datetime.date = None) -> datetime.date:
+    """
+    Resolves a Google Analytics date to an absolute date
+
+    Supports the formats of the Reporting API: `YYYY-MM-DD`, `today`, `yesterday` and `NdaysAgo`.
+
+    Note: The Google Analytics API resolves relative dates in the time zone of the view. Here the local date is used.
+
+    Args:
+        value: the date as given to the API, e.g. 2020-12-01 or 30daysAgo
+        today: the date to resolve relative dates against (default: the local date)
+    """
+    today = today or datetime.date.today()
+    if value == 'today':
+        return today
+    if value == 'yesterday':
+        return today - datetime.timedelta(days=1)
+    match = re.fullmatch(r'(\d+)daysAgo', value)
+    if match:
+        return today - datetime.timedelta(days=int(match.group(1)))
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f'Could not resolve date {value!r}. Use YYYY-MM-DD, today, yesterday or NdaysAgo.')
+
+
+def split_date_range(start_date: datetime.date, end_date: datetime.date,
+                     shard_by: str) -> t.List[t.Tuple[datetime.date, datetime.date]]:
+    """
+    Splits a date range into consecutive shards aligned to calendar days, ISO weeks or months
+
+    The first and the last shard are cut to the date range.
+
+    Args:
+        start_date: the first date of the range
+        end_date: the last date of the range (inclusive)
+        shard_by: the shard size, either 'day', 'week' or 'month'
+
+    Returns:
+        A list of (start date, end date) tuples, ordered by date
+    """
+    if end_date < start_date:
+        raise ValueError(f'The end date {end_date} is before the start date {start_date}')
+
+    shards = []
+    shard_start = start_date
+    while shard_start <= end_date:
+        if shard_by == 'day':
+            next_start = shard_start + datetime.timedelta(days=1)
+        elif shard_by == 'week':
+            next_start = shard_start + datetime.timedelta(days=7 - shard_start.weekday())
+        elif shard_by == 'month':
+            next_start = (shard_start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        else:
+            raise ValueError(f'Unknown shard size {shard_by!r}, must be one of day, week or month')
+
+        shards.append((shard_start, min(next_start - datetime.timedelta(days=1), end_date)))
+        shard_start = next_start
+    return shards
+
+
+def incremental_date_range(start_date: datetime.date, end_date: datetime.date,
+                           last_loaded_date: t.Optional[datetime.date],
+                           late_data_days: int) -> t.Optional[t.Tuple[datetime.date, datetime.date]]:
+    """
+    The date range of an incremental load
+
+    Args:
+        start_date: the start date of the first load
+        end_date: the last date to load (inclusive)
+        last_loaded_date: the last date which is loaded already, None if nothing is loaded yet
+        late_data_days: how many days before the last loaded date are loaded again
+
+    Returns:
+        A (start date, end date) tuple, None if all dates until the end date are loaded already
+    """
+    if last_loaded_date:
+        start_date = max(start_date, last_loaded_date - datetime.timedelta(days=late_data_days))
+    if start_date > end_date:
+        return None
+    return start_date, end_date
@@ -1,4 +1,53 @@
-from mara_google_analytics_downloader.static import METRICS, DIMENSIONS
+"""Compiles filters in the URL filter syntax (v3) to the filter clauses of the Reporting API V4
+
+Syntax (v3, see https://developers.google.com/analytics/devguides/reporting/core/v3/reference#filters):
+    - a filter is `<name><operator><expression>`, e.g. `ga:pagePath=~^/shop`
+    - `,` combines filters with OR, `;` with AND. OR binds tighter than AND: `a,b;c` is `(a OR b) AND c`
+    - parentheses group filters: `(a;b),c`. A `(` in an expression is part of the expression, a `)` only when
+      it closes a `(` of the same expression, e.g. `ga:pagePath=~^/(de|en)/`
+    - a backslash escapes the next character: `\\,` and `\\;` are a literal `,` and `;`, other escapes are kept
+      as they are (they have a meaning in regular expressions)
+
+The filter is compiled to a conjunction of disjunctions, one filter clause per disjunction. The Reporting API V4
+can not combine metric and dimension filters with OR, see
+    https://developers.google.com/analytics/devguides/reporting/core/v4/basics#filtering
+    https://developers.google.com/analytics/devguides/reporting/core/v4/basics#filtering_2
+"""
+
+import functools
+import itertools
+import re
+import typing as t
+
+MAX_FILTER_CLAUSES = 100
+"""The maximum number of filter clauses a filter may compile to (ORs of ANDs are multiplied out)"""
+
+# v3 operator -> (metric operator, dimension operator, not)
+_OPERATORS = {
+    '==': ('EQUAL', 'EXACT', False),
+    '!=': ('EQUAL', 'EXACT', True),
+    '>': ('GREATER_THAN', 'NUMERIC_GREATER_THAN', False),
+    '<': ('LESS_THAN', 'NUMERIC_LESS_THAN', False),
+    '>=': ('LESS_THAN', 'NUMERIC_LESS_THAN', True),
+    '<=': ('GREATER_THAN', 'NUMERIC_GREATER_THAN', True),
+    '=@': (None, 'PARTIAL', False),
+    '!@': (None, 'PARTIAL', True),
+    '=~': (None, 'REGEXP', False),
+    '!~': (None, 'REGEXP', True),
+}
+
+_NAME_RE = re.compile(r'[a-z]+:[A-Za-z0-9_]+')
+# two character operators first, so that `>=` is not read as `>`
+_OPERATOR_RE = re.compile('|'.join(re.escape(operator) for operator in sorted(_OPERATORS, key=len, reverse=True)))
+
+
+class Condition(t.NamedTuple):
+    """One compiled filter: `kind` is 'metric' or 'dimension'"""
+    kind: str
+    name: str
+    operator: str
+    not_: bool
+    expression: str
 
 
 def ga_parse_filter(report_request: dict, filters: str):
@@ -13,100 +62,32 @@ def ga_parse_filter(report_request: dict, filters: str):
     Args:
         report_request: the dict with the report request
         filter: the filter string
+
+    Raises:
+        ValueError when the filter can not be parsed or not be expressed in the Reporting API V4
     """
     metric_filter_clauses = []
     dimension_filter_clauses = []
 
-    # Reference: https://developers.google.com/analytics/devguides/reporting/core/v3/reference#filters
-    if filters.find('(') >= 0 or filters.find(')') >= 0:
-        raise Exception('Breakets in paramter --filters are not yet supported')
-
-
-    for or_filter in filters.split(','):
-        for and_filter in or_filter.split(';'):
-            filter = and_filter
-
-            # parse one filter (metric/dimension operator expression)
-            metric_name = None
-            dimension_name = None
-            operator = None
-            operator_not = False
-            field_left = None
-            field_right = None
-            if filter.find('==') >= 0:
-                field_left = filter[:filter.find('==')]
-                field_right = filter[filter.find('==')+2:]
-                operator = 'EXACT'
-            elif filter.find('!=') > 0:
-                field_left = filter[:filter.find('!=')]
-                field_right = filter[filter.find('!=')+2:]
-                operator = 'EXACT'
-                operator_not = True
-            elif filter.find('>') >= 0:
-                field_left = filter[:filter.find('>')]
-                field_right = filter[filter.find('>')+1:]
-                operator = 'GREATER_THAN'
-            elif filter.find('<') >= 0:
-                field_left = filter[:filter.find('<')]
-                field_right = filter[filter.find('<')+1:]
-                operator = 'LESS_THAN'
-            elif filter.find('>=') >= 0:
-                field_left = filter[:filter.find('>=')]
-                field_right = filter[filter.find('>=')+2:]
-                operator = 'LESS_THAN'
-                operator_not = True
-            elif filter.find('<=') >= 0:
-                field_left = filter[:filter.find('<=')]
-                field_right = filter[filter.find('<=')+2:]
-                operator = 'GREATER_THAN'
-                operator_not = True
-            elif filter.find('=@') >= 0:
-                field_left = filter[:filter.find('=@')]
-                field_right = filter[filter.find('=@')+2:]
-                operator = 'PARTIAL'
-            elif filter.find('!@') >= 0:
-                field_left = filter[:filter.find('!@')]
-                field_right = filter[filter.find('!@')+2:]
-                operator = 'PARTIAL'
-                operator_not = True
-            elif filter.find('=~') >= 0:
-                field_left = filter[:filter.find('=~')]
-                field_right = filter[filter.find('=~')+2:]
-                operator = 'REGEXP'
-            elif filter.find('!~') >= 0:
-                field_left = filter[:filter.find('!~')]
-                field_right = filter[filter.find('!~')+2:]
-                operator = 'REGEXP'
-                operator_not = True
-            else:
-                raise Exception(f'Filter contains no or unknown operator: {filter}')
-
-            if field_left in METRICS:
-                # Reference: https://developers.google.com/analytics/devguides/reporting/core/v4/basics#filtering
-                metric_filter_clauses.append({
-                    'filters': [
-                        {
-                            'metricName': field_left,
-                            'not': operator_not,
-                            'operator': operator,
-                            'comparisonValue': field_right
-                        }
-                    ]
-                })
-            elif field_left in DIMENSIONS:
-                # Reference: https://developers.google.com/analytics/devguides/reporting/core/v4/basics#filtering_2
-                dimension_filter_clauses.append({
-                    'filters': [
-                        {
-                            'dimensionName': field_left,
-                            'not': operator_not,
-                            'operator': operator,
-                            'expressions': [field_right]
-                        }
-                    ]
-                })
+    for disjunction in compile_filter(filters):
+        filter_clause = {'filters': []}
+        if len(disjunction) > 1:
+            filter_clause['operator'] = 'OR'
+        for condition in disjunction:
+            if condition.kind == 'metric':
+                filter_clause['filters'].append({'metricName': condition.name,
+                                                 'not': condition.not_,
+                                                 'operator': condition.operator,
+                                                 'comparisonValue': condition.expression})
             else:
-                raise Exception(f'Unknown dimension/metric: {field_left}')
+                filter_clause['filters'].append({'dimensionName': condition.name,
+                                                 'not': condition.not_,
+                                                 'operator': condition.operator,
+                                                 'expressions': [condition.expression]})
+        if disjunction[0].kind == 'metric':
+            metric_filter_clauses.append(filter_clause)
+        else:
+            dimension_filter_clauses.append(filter_clause)
 
     if metric_filter_clauses:
         report_request.update({
@@ -116,3 +97,153 @@ def ga_parse_filter(report_request: dict, filters: str):
         report_request.update({
             'dimensionFilterClauses': dimension_filter_clauses
         })
+
+
+@functools.lru_cache(maxsize=256)
+def compile_filter(filters: str) -> t.Tuple[t.Tuple[Condition, ...], ...]:
+    """
+    Compiles a filter string to a conjunction of disjunctions of conditions
+
+    Each disjunction contains either only metric or only dimension conditions. The result is cached, so that the
+    same filter of many report requests is compiled only once.
+    """
+    parser = _Parser(filters)
+    tree = parser.parse()
+    conjunction = _conjunctive_normal_form(tree, filters)
+    for disjunction in conjunction:
+        if len({condition.kind for condition in disjunction}) > 1:
+            raise ValueError(f'Metric and dimension filters can not be combined with OR (","): '
+                             f'{",".join(condition.name for condition in disjunction)} in filter "{filters}"')
+    return conjunction
+
+
+def field_kind(name: str) -> t.Optional[str]:
+    """'metric' or 'dimension' for a metric or dimension name, None when the name is unknown"""
+    index = _catalogue_index()
+    kind = index.get(name)
+    if kind is None:
+        # numbered names like ga:goal3Completions or ga:dimension12 are in the catalogue as ga:goalXXCompletions
+        kind = index.get(re.sub(r'\d+', 'XX', name))
+    if kind is None and name.startswith('ga:calcMetric_'):
+        kind = 'metric'
+    return kind
+
+
+@functools.lru_cache(maxsize=None)
+def _catalogue_index() -> t.Dict[str, str]:
+    from mara_google_analytics_downloader.static import METRIC_NAMES, DIMENSION_NAMES
+
+    index = {name: 'dimension' for name in DIMENSION_NAMES}
+    index.update({name: 'metric' for name in METRIC_NAMES})
+    # custom metrics and dimensions, they are commented out in the catalogue
+    index.update({'ga:metricXX': 'metric', 'ga:dimensionXX': 'dimension'})
+    return index
+
+
+def _conjunctive_normal_form(tree, filters: str) -> t.Tuple[t.Tuple[Condition, ...], ...]:
+    if isinstance(tree, Condition):
+        return ((tree,),)
+    operator, operands = tree
+    operands = [_conjunctive_normal_form(operand, filters) for operand in operands]
+    if operator == 'AND':
+        return tuple(itertools.chain.from_iterable(operands))
+    # (a AND b) OR (c AND d) = (a OR c) AND (a OR d) AND (b OR c) AND (b OR d)
+    n_clauses = 1
+    for operand in operands:
+        n_clauses *= len(operand)
+    if n_clauses > MAX_FILTER_CLAUSES:
+        raise ValueError(f'The filter "{filters}" results in {n_clauses} filter clauses, '
+                         f'the maximum is {MAX_FILTER_CLAUSES}')
+    return tuple(tuple(itertools.chain.from_iterable(disjunctions)) for disjunctions in itertools.product(*operands))
+
+
+class _Parser:
+    """A recursive descent parser of v3 filters
+
+    and   := or (';' or)*
+    or    := group (',' group)*
+    group := '(' and ')' | condition
+    """
+
+    def __init__(self, filters: str) -> None:
+        self.filters = filters
+        self.position = 0
+
+    def parse(self):
+        tree = self._and()
+        if self.position < len(self.filters):
+            self._fail(f'unexpected "{self.filters[self.position]}"')
+        return tree
+
+    def _and(self):
+        operands = [self._or()]
+        while self._peek() == ';':
+            self.position += 1
+            operands.append(self._or())
+        return operands[0] if len(operands) == 1 else ('AND', operands)
+
+    def _or(self):
+        operands = [self._group()]
+        while self._peek() == ',':
+            self.position += 1
+            operands.append(self._group())
+        return operands[0] if len(operands) == 1 else ('OR', operands)
+
+    def _group(self):
+        if self._peek() == '(':
+            self.position += 1
+            tree = self._and()
+            if self._peek() != ')':
+                self._fail('missing ")"')
+            self.position += 1
+            return tree
+        return self._condition()
+
+    def _condition(self) -> Condition:
+        name_match = _NAME_RE.match(self.filters, self.position)
+        if not name_match:
+            self._fail('expected a metric or dimension name')
+        name = name_match.group()
+        self.position = name_match.end()
+
+        operator_match = _OPERATOR_RE.match(self.filters, self.position)
+        if not operator_match:
+            self._fail(f'no or unknown operator after {name}')
+        self.position = operator_match.end()
+
+        kind = field_kind(name)
+        if kind is None:
+            raise ValueError(f'Unknown dimension/metric: {name} in filter "{self.filters}"')
+        metric_operator, dimension_operator, not_ = _OPERATORS[operator_match.group()]
+        operator = metric_operator if kind == 'metric' else dimension_operator
+        if operator is None:
+            raise ValueError(f'The operator {operator_match.group()} can not be used with the metric {name} '
+                             f'in filter "{self.filters}"')
+        return Condition(kind, name, operator, not_, self._expression())
+
+    def _expression(self) -> str:
+        """Reads the expression up to the next unescaped `,` `;` or unbalanced `)`"""
+        characters = []
+        depth = 0
+        while self.position < len(self.filters):
+            character = self.filters[self.position]
+            if character == '\\' and self.position + 1 < len(self.filters):
+                escaped = self.filters[self.position + 1]
+                characters.append(escaped if escaped in ',;' else character + escaped)
+                self.position += 2
+                continue
+            if character in ',;' or (character == ')' and depth == 0):
+                break
+            if character == '(':
+                depth += 1
+            elif character == ')':
+                depth -= 1
+            characters.append(character)
+            self.position += 1
+        return ''.join(characters)
+
+    def _peek(self) -> t.Optional[str]:
+        return self.filters[self.position] if self.position < len(self.filters) else None
+
+    def _fail(self, message: str):
+        raise ValueError(f'Could not parse filter "{self.filters}" at position {self.position}: {message}')
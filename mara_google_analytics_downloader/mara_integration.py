@@ -1,12 +1,17 @@
+import datetime
+import os
 import shlex
-from mara_pipelines import pipelines
+import shutil
+import tempfile
+import time
+from mara_pipelines import pipelines, shell
 from mara_pipelines.logging import logger
 import mara_db.shell
 import typing as t
 
 from mara_google_analytics_downloader import config as c
 
-__all__ = ['DownloadGoogleAnalyticsFlatTable']
+__all__ = ['DownloadGoogleAnalyticsFlatTable', 'DownloadGoogleAnalyticsMultiViewFlatTable']
 
 
 class DownloadGoogleAnalyticsFlatTable(pipelines.Command):
@@ -21,7 +26,25 @@ class DownloadGoogleAnalyticsFlatTable(pipelines.Command):
                  filters: str = None,
                  add_view_id_column: bool = False,
                  use_flask_command: bool = False,
-                 fail_on_no_data: bool = False
+                 fail_on_no_data: bool = False,
+                 page_size: int = None,
+                 shard_by: str = None,
+                 max_workers: int = None,
+                 checkpoint_dir: str = None,
+                 page_workers: int = None,
+                 streaming: bool = False,
+                 load_in_process: bool = False,
+                 copy_format: str = 'csv',
+                 incremental: bool = False,
+                 date_column: str = None,
+                 late_data_days: int = 3,
+                 watermark_table_name: str = None,
+                 view_id_column: str = None,
+                 split_sampled: bool = False,
+                 compare_start_date: str = None,
+                 compare_end_date: str = None,
+                 date_range_layout: str = 'rows',
+                 engine: str = None
                  ) -> None:
         """
         Executes a google analytics query and writes the result to a table
@@ -44,6 +67,49 @@ class DownloadGoogleAnalyticsFlatTable(pipelines.Command):
                                will fail the download). If True, the credentials needed in the downloader itself are
                                directly taken from the config, not passed in via commandline arguments.
             fail_on_no_data: bool=True, if true fail on no data rows received
+            page_size: int=None, the maximum number of rows per page requested from the Reporting API V4 (max. 100000).
+                       If not given, the default of the downloader is used.
+            shard_by: str=None, if set to 'day', 'week' or 'month', the date range is split into shards which are
+                      downloaded concurrently. Only use this when the metrics can be summed up over the shards.
+            max_workers: int=None, the maximum number of shards downloaded concurrently
+            checkpoint_dir: str=None, Multi-Channel Funnels API only: a directory where the downloader records a
+                            checkpoint after each page. A failed download continues from its checkpoint in the
+                            next run.
+            page_workers: int=None, Multi-Channel Funnels API only: the maximum number of pages downloaded
+                          concurrently
+            streaming: bool=False, if the downloader decodes the responses incrementally so that its memory does
+                       not grow with the page size. Needs the package ijson.
+            load_in_process: bool=False, if true the download runs in the pipeline process and the rows are loaded
+                             with a COPY of psycopg2 while the download is running, instead of piping the output of
+                             a downloader process into psql. The progress is logged after each page. PostgreSQL only.
+            copy_format: str='csv', with load_in_process: 'csv' or 'binary'. For 'binary', the values are encoded
+                         according to the column types of the target table.
+            incremental: bool=False, if true only the dates after the last loaded date (minus `late_data_days`) up to
+                         `end_date` are downloaded, `start_date` is then the start for the first load. The rows of
+                         these dates are deleted from the target table before they are loaded again.
+            date_column: str=None, with incremental: the date column of the target table (a DATE column or a text
+                         column with the values of ga:date)
+            late_data_days: int=3, with incremental: how many days before the last loaded date are loaded again,
+                            because Google Analytics still processes data for them
+            watermark_table_name: str=None, with incremental: a table which keeps the last loaded date of each target
+                                  table and view, with the columns `table_name TEXT`, `view_id TEXT` and
+                                  `max_date DATE` and the primary key `(table_name, view_id)`. If not given, the last
+                                  loaded date is the maximum of `date_column` in the target table.
+            view_id_column: str=None, with incremental and add_view_id_column: the view id column of the target table.
+                            Only the rows of the loaded views are deleted and their last loaded date is determined
+                            per view, so that several views can be loaded into the same table.
+            split_sampled: bool=False, Reporting API V4 only: if sampled date ranges are split into halves until they
+                           are not sampled anymore or are single days. Only use this when the metrics can be summed
+                           up over the date ranges.
+            compare_start_date: str=None, Reporting API V4 only: the start date of a second date range which is
+                                requested together with the first one, e.g. for period-over-period comparisons
+            compare_end_date: str=None, the end date of the second date range
+            date_range_layout: str='rows', with a second date range: 'rows' for one row per date range with the
+                               index of the date range (0 or 1) as first column (after the view id), 'columns' for
+                               the metrics of the second date range as additional columns after the metrics
+            engine: str=None, 'asyncio' to send the requests from an asyncio event loop instead of threads, so that
+                    many views and shards can be downloaded concurrently (see `max_workers`). Needs the package
+                    aiohttp.
 
         """
         self.view_id = view_id
@@ -58,28 +124,226 @@ class DownloadGoogleAnalyticsFlatTable(pipelines.Command):
         self.add_view_id_column = add_view_id_column
         self.use_flask_command = use_flask_command
         self.fail_on_no_data = fail_on_no_data
+        self.page_size = page_size
+        self.shard_by = shard_by
+        self.max_workers = max_workers
+        self.checkpoint_dir = checkpoint_dir
+        self.page_workers = page_workers
+        self.streaming = streaming
+        self.load_in_process = load_in_process
+        self.copy_format = copy_format
+        if load_in_process and checkpoint_dir:
+            raise ValueError('A checkpoint dir can not be combined with load_in_process')
+        self.incremental = incremental
+        self.date_column = date_column
+        self.late_data_days = late_data_days
+        self.watermark_table_name = watermark_table_name
+        self.view_id_column = view_id_column
+        if incremental and not date_column:
+            raise ValueError('An incremental load needs a date_column')
+        if incremental and add_view_id_column and not view_id_column:
+            raise ValueError('An incremental load into a table with a view id column needs the view_id_column')
+        self.split_sampled = split_sampled
+        self.compare_start_date = compare_start_date
+        self.compare_end_date = compare_end_date
+        self.date_range_layout = date_range_layout
+        self.engine = engine
+        if incremental and compare_start_date:
+            raise ValueError('An incremental load can not be combined with a second date range')
 
     def run(self) -> bool:
         logger.log(
             f'Loading google analytics data {self.view_id} ({self.dimensions} {self.metrics}) into {self.target_db_alias}.{self.target_table_name}...')
-        if not super().run():
+        start_date, sql_before, sql_after = self.start_date, [], []
+        if self.incremental:
+            try:
+                start_date, sql_before, sql_after = self._incremental_load()
+            except Exception as e:
+                logger.log(f'Error while determining the last loaded date: {e}', is_error=True)
+                return False
+            if not start_date:
+                logger.log(f'All dates until {self.end_date} are loaded already.')
+                return True
+
+        if self.load_in_process:
+            return self._load_in_process(start_date, sql_before, sql_after)
+
+        from mara_google_analytics_downloader.telemetry import read_prometheus_textfile
+
+        # the totals of the download are read from the Prometheus textfile which the downloader process writes
+        prometheus_textfile = self._prometheus_textfile()
+        tmp_dir = None if prometheus_textfile else tempfile.mkdtemp()
+        prometheus_textfile = prometheus_textfile or os.path.join(tmp_dir, 'telemetry.prom')
+        start_time = time.time()
+        try:
+            succeeded = shell.run_shell_command(self.shell_command(start_date, sql_before, sql_after,
+                                                                   prometheus_textfile=prometheus_textfile))
+            # not written when the download runs in a downloader worker
+            if os.path.exists(prometheus_textfile) and os.path.getmtime(prometheus_textfile) >= start_time:
+                _log_telemetry(read_prometheus_textfile(prometheus_textfile))
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not succeeded:
             logger.log(f'Error while loading google analytics data.')
             return False
         logger.log(f'Finished loading google analytics data.')
         return True
 
-    def shell_command(self):
-        return (ga_downloader_shell_command(self.view_id, self.start_date, self.end_date,
-                                            self.metrics,dimensions=self.dimensions,
-                                            filters=self.filters,
-                                            delimiter_char=self.delimiter_char,
-                                            add_view_id_column=self.add_view_id_column,
-                                            use_flask_command=self.use_flask_command,
-                                            fail_on_no_data=self.fail_on_no_data)
+    def _incremental_load(self) -> t.Tuple[t.Optional[str], t.List[str], t.List[str]]:
+        """Returns the start date of an incremental load (None if there is nothing to load), the statements
+        before the load which delete the dates to be loaded again and the statements after the load"""
+        from mara_db.postgresql import postgres_cursor_context
+        from mara_google_analytics_downloader.date_ranges import incremental_date_range, resolve_date
+
+        view_ids = str(self.view_id).split(',')
+        # restricts the statements to the rows of the loaded views in a table which is shared with other views
+        view_condition = (f' AND {self.view_id_column}::TEXT IN ({", ".join(map(_sql_literal, view_ids))})'
+                          if self.view_id_column else '')
+
+        with postgres_cursor_context(self.target_db_alias) as cursor:
+            # text columns with the values of ga:date are compared in their own format
+            cursor.execute(f'SELECT {self.date_column}::TEXT FROM {self.target_table_name} '
+                           f'WHERE {self.date_column} IS NOT NULL LIMIT 1')
+            row = cursor.fetchone()
+            date_format = '%Y%m%d' if row and '-' not in row[0] else '%Y-%m-%d'
+
+            if self.watermark_table_name:
+                cursor.execute(f'SELECT view_id, max_date FROM {self.watermark_table_name} '
+                               f'WHERE table_name = %s AND view_id IN %s', (self.target_table_name, tuple(view_ids)))
+                max_dates = dict(cursor.fetchall())
+            elif self.view_id_column:
+                cursor.execute(f'SELECT {self.view_id_column}::TEXT, max({self.date_column})::TEXT '
+                               f'FROM {self.target_table_name} WHERE TRUE{view_condition} GROUP BY 1')
+                max_dates = {view_id: datetime.datetime.strptime(max_date, date_format).date()
+                             for view_id, max_date in cursor.fetchall() if max_date}
+            else:
+                cursor.execute(f'SELECT max({self.date_column})::TEXT FROM {self.target_table_name}')
+                max_date = cursor.fetchone()[0]
+                max_dates = {view_ids[0]: datetime.datetime.strptime(max_date, date_format).date()} if max_date else {}
+
+        # the views are loaded together, so the earliest last loaded date counts and a view without
+        # loaded dates is loaded from the start date
+        last_loaded_date = (min(max_dates[view_id] for view_id in view_ids)
+                            if all(view_id in max_dates for view_id in view_ids) else None)
+        date_range = incremental_date_range(resolve_date(self.start_date), resolve_date(self.end_date),
+                                            last_loaded_date, self.late_data_days)
+        if not date_range:
+            return None, [], []
+        start_date, end_date = date_range
+        if last_loaded_date:
+            logger.log(f'Last loaded date: {last_loaded_date}, loading from {start_date}', format=logger.Format.ITALICS)
+
+        sql_before = [f"DELETE FROM {self.target_table_name} "
+                      f"WHERE {self.date_column} >= {_sql_literal(start_date.strftime(date_format))} "
+                      f"AND {self.date_column} <= {_sql_literal(end_date.strftime(date_format))}{view_condition}"]
+        sql_after = []
+        if self.watermark_table_name:
+            sql_after.append(f"INSERT INTO {self.watermark_table_name} (table_name, view_id, max_date) VALUES "
+                             + ', '.join(f"({_sql_literal(self.target_table_name)}, {_sql_literal(view_id)}, "
+                                         f"{_sql_literal(end_date.isoformat())})" for view_id in view_ids)
+                             + " ON CONFLICT (table_name, view_id) DO UPDATE SET max_date = EXCLUDED.max_date")
+        return start_date.isoformat(), sql_before, sql_after
+
+    def _load_in_process(self, start_date: str, sql_before: t.List[str] = None, sql_after: t.List[str] = None) -> bool:
+        from mara_google_analytics_downloader.__main__ import download
+        from mara_google_analytics_downloader.copy_loader import copy_to_table
+        from mara_google_analytics_downloader.telemetry import configure_telemetry, telemetry
+
+        def log_progress(nrows: int, nbytes: int):
+            logger.log(f'{nrows} rows ({nbytes / 1024 / 1024:.1f} MB) loaded', format=logger.Format.ITALICS)
+
+        download_kwargs = {
+            'dimensions': ','.join(self.dimensions) if self.dimensions else None,
+            'filters': self.filters,
+            'delimiter_char': self.delimiter_char,
+            'add_view_id_column': self.add_view_id_column,
+            'fail_on_no_data': self.fail_on_no_data,
+            'shard_by': self.shard_by,
+            'streaming': self.streaming,
+            'split_sampled': self.split_sampled,
+            'compare_start_date': self.compare_start_date,
+            'compare_end_date': self.compare_end_date,
+            'date_range_layout': self.date_range_layout,
+        }
+        for name in ('page_size', 'max_workers', 'page_workers', 'engine'):
+            if getattr(self, name):
+                download_kwargs[name] = getattr(self, name)
+
+        configure_telemetry(json_lines=c.ga_telemetry_json_lines(), prometheus_textfile=self._prometheus_textfile())
+        try:
+            nrows = copy_to_table(self.target_db_alias, self.target_table_name,
+                                  lambda sink: download(str(self.view_id), start_date, self.end_date,
+                                                        ','.join(self.metrics), stream=sink, **download_kwargs),
+                                  delimiter_char=self.delimiter_char, copy_format=self.copy_format,
+                                  on_progress=log_progress, sql_before=sql_before, sql_after=sql_after)
+        except Exception as e:
+            if telemetry().last_download:
+                _log_telemetry(telemetry().last_download)
+            logger.log(f'Error while loading google analytics data: {e}', is_error=True)
+            return False
+        if telemetry().last_download:
+            _log_telemetry(telemetry().last_download)
+        logger.log(f'Finished loading {nrows} rows of google analytics data.')
+        return True
+
+    def _prometheus_textfile(self) -> t.Optional[str]:
+        """The file to which the totals of the download are written, see `config.ga_telemetry_prometheus_dir`"""
+        if not c.ga_telemetry_prometheus_dir():
+            return None
+        return os.path.join(c.ga_telemetry_prometheus_dir(), f'{self.target_table_name}.prom')
+
+    def shell_command(self, start_date: str = None, sql_before: t.List[str] = None, sql_after: t.List[str] = None,
+                      prometheus_textfile: str = None):
+        """
+        The command which pipes the output of the downloader into psql
+
+        Args:
+            start_date: str=None, overrides the start date, e.g. for an incremental load
+            sql_before: t.List[str]=None, statements which are executed before the COPY in the same transaction
+            sql_after: t.List[str]=None, statements which are executed after the COPY in the same transaction
+            prometheus_textfile: str=None, overrides the file to which the downloader writes the totals of the
+                                 download, see `config.ga_telemetry_prometheus_dir`
+        """
+        download_command = ga_downloader_shell_command(self.view_id, start_date or self.start_date, self.end_date,
+                                                       self.metrics,dimensions=self.dimensions,
+                                                       filters=self.filters,
+                                                       delimiter_char=self.delimiter_char,
+                                                       add_view_id_column=self.add_view_id_column,
+                                                       use_flask_command=self.use_flask_command,
+                                                       fail_on_no_data=self.fail_on_no_data,
+                                                       page_size=self.page_size,
+                                                       shard_by=self.shard_by,
+                                                       max_workers=self.max_workers,
+                                                       checkpoint_dir=self.checkpoint_dir,
+                                                       page_workers=self.page_workers,
+                                                       streaming=self.streaming,
+                                                       split_sampled=self.split_sampled,
+                                                       compare_start_date=self.compare_start_date,
+                                                       compare_end_date=self.compare_end_date,
+                                                       date_range_layout=self.date_range_layout,
+                                                       engine=self.engine,
+                                                       prometheus_textfile=(prometheus_textfile
+                                                                            or self._prometheus_textfile()))
+        if not sql_before and not sql_after:
+            return (download_command
+                    + f'{_shell_linebreak_escape}| '
+                    + mara_db.shell.copy_from_stdin_command(self.target_db_alias, target_table=self.target_table_name,
+                                                            null_value_string='', csv_format=True,
+                                                            delimiter_char=self.delimiter_char))
+
+        # When the download fails, the COPY would still see a regular end of its input and the transaction would be
+        # committed. A NUL byte is rejected by PostgreSQL in any position, so that the COPY fails and the
+        # statements before it are rolled back.
+        statements = ['BEGIN'] + list(sql_before or []) \
+                     + [f"COPY {self.target_table_name} FROM STDIN WITH CSV "
+                        f"DELIMITER AS '{self.delimiter_char}' NULL AS ''"] \
+                     + list(sql_after or []) + ['COMMIT']
+        return ('{ ' + download_command + " || { printf '\\0'; exit 1; }; }"
                 + f'{_shell_linebreak_escape}| '
-                + mara_db.shell.copy_from_stdin_command(self.target_db_alias, target_table=self.target_table_name,
-                                                        null_value_string='', csv_format=True,
-                                                        delimiter_char=self.delimiter_char))
+                + mara_db.shell.query_command(self.target_db_alias)
+                + ''.join(f'{_shell_linebreak_escape}{_indentions} --command={shlex.quote(statement)}'
+                          for statement in statements))
 
     def html_doc_items(self) -> [(str, str)]:
         from mara_page import _
@@ -96,9 +360,76 @@ class DownloadGoogleAnalyticsFlatTable(pipelines.Command):
             ('target db', _.pre[escape(self.target_db_alias)]),
             ('Invocation', _.pre[_invocation(self.use_flask_command)]),
             ('Fail on no data', _.pre[str(self.fail_on_no_data)]),
+            ('Page size', _.pre[str(self.page_size)] if self.page_size else None),
+            ('Shard by', _.pre[escape(self.shard_by)] if self.shard_by else None),
+            ('Max workers', _.pre[str(self.max_workers)] if self.max_workers else None),
+            ('Checkpoint dir', _.pre[escape(self.checkpoint_dir)] if self.checkpoint_dir else None),
+            ('Page workers', _.pre[str(self.page_workers)] if self.page_workers else None),
+            ('Streaming', _.pre[str(self.streaming)] if self.streaming else None),
+            ('Split sampled', _.pre[str(self.split_sampled)] if self.split_sampled else None),
+            ('Engine', _.pre[escape(self.engine)] if self.engine else None),
+            ('Compare date range', _.pre[escape(f'{self.compare_start_date} - {self.compare_end_date} '
+                                                f'({self.date_range_layout})')]
+                                   if self.compare_start_date else None),
+            ('Load in process', _.pre[str(self.load_in_process)] if self.load_in_process else None),
+            ('Copy format', _.pre[escape(self.copy_format)] if self.load_in_process else None),
+            ('Incremental', _.pre[escape(f'{self.date_column}, {self.late_data_days} late data days'
+                                         + (f', view id column {self.view_id_column}'
+                                            if self.view_id_column else '')
+                                         + (f', watermark in {self.watermark_table_name}'
+                                            if self.watermark_table_name else ''))]
+                            if self.incremental else None),
         ]
 
 
+class DownloadGoogleAnalyticsMultiViewFlatTable(DownloadGoogleAnalyticsFlatTable):
+    def __init__(self,
+                 view_ids: t.Iterable[int],
+                 start_date: str,
+                 metrics: t.Iterable[str],
+                 target_table_name: str,
+                 max_workers: int = None,
+                 **kwargs) -> None:
+        """
+        Executes the same google analytics query for several views and writes the results to one table
+
+        All views are downloaded concurrently in a single downloader process and loaded with a single COPY. The
+        view id is always added as the first column.
+
+        Args:
+            view_ids: t.Iterable[int], the Google Analytics view ids
+            start_date: str, the start date of data to receive
+            metrics: t.Iterable[str], the metrics to receive
+            target_table_name: str, the schema qualified table name on the db_alias where the data should be inserted.
+                               The table needs to exist and to have the view id as first column.
+            max_workers: int=None, the maximum number of views (and shards) downloaded concurrently
+            **kwargs: further arguments, see DownloadGoogleAnalyticsFlatTable
+        """
+        self.view_ids = list(view_ids)
+        if not self.view_ids:
+            raise ValueError('Need at least one view id')
+        super().__init__(view_id=','.join(map(str, self.view_ids)), start_date=start_date, metrics=metrics,
+                         target_table_name=target_table_name, add_view_id_column=True, max_workers=max_workers,
+                         **kwargs)
+
+
+def _log_telemetry(summary: dict):
+    """Logs the totals of the requests of a download, see the module `telemetry`"""
+    logger.log(f'{summary["requests"]} requests in {summary["request_seconds"]:.1f} s, '
+               f'{summary["retries"]} retries ({summary["backoff_seconds"]:.1f} s backoff), '
+               f'{summary["rate_limited_errors"]} rate limit errors, '
+               f'{summary["bytes_received"] / 1024 / 1024:.1f} MB received, '
+               f'{summary["rows"]} rows in {summary["seconds"]:.1f} s ({summary.get("rows_per_second") or 0:.0f} rows/s)',
+               format=logger.Format.ITALICS)
+    if summary['sampled_responses']:
+        logger.log(f'{summary["sampled_responses"]} responses contain sampled data', format=logger.Format.ITALICS)
+
+
+def _sql_literal(value: str) -> str:
+    """Quotes a value as a SQL string literal"""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
 def _invocation(use_flask):
     # import mara_google_analytics_downloader
     import mara_google_analytics_downloader.__main__
@@ -112,7 +443,7 @@ _shell_linebreak_escape = ' \\\n'
 _indentions = ' ' * 5  # similar to what copy_from_stdin_command() does after a linebreak within the command
 
 
-def ga_downloader_shell_command(view_id: int,
+def ga_downloader_shell_command(view_id: t.Union[int, str],
                                 start_date: str,
                                 end_date: str,
                                 metrics: t.Iterable[str],
@@ -122,12 +453,25 @@ def ga_downloader_shell_command(view_id: int,
                                 add_view_id_column: bool = False,
                                 use_flask_command: bool = True,
                                 fail_on_no_data: bool = True,
+                                page_size: int = None,
+                                shard_by: str = None,
+                                max_workers: int = None,
+                                checkpoint_dir: str = None,
+                                page_workers: int = None,
+                                streaming: bool = False,
+                                split_sampled: bool = False,
+                                compare_start_date: str = None,
+                                compare_end_date: str = None,
+                                date_range_layout: str = 'rows',
+                                engine: str = None,
+                                prometheus_textfile: str = None,
                                 ):
     """
     Downloads google analytics data to a table
 
     Args:
-        view_id: int, the Google Analytics view id, see https://ga-dev-tools.appspot.com/query-explorer/
+        view_id: int, the Google Analytics view id, see https://ga-dev-tools.appspot.com/query-explorer/,
+                 or a comma-separated list of view ids
         start_date: str, the start date of data to receive
         end_date: str, the end date of data to receive
         metrics: t.Iterable[str], the metrics to receive
@@ -140,6 +484,21 @@ def ga_downloader_shell_command(view_id: int,
                            the import fail. If True, the credentials are directly taken from the config,
                            not passed in via commandline arguments.
         fail_on_no_data: bool=True, if true fail on no data rows received
+        page_size: int=None, the maximum number of rows per page requested from the Reporting API V4 (max. 100000)
+        shard_by: str=None, if set to 'day', 'week' or 'month', the date range is split into shards which are
+                  downloaded concurrently
+        max_workers: int=None, the maximum number of views and shards downloaded concurrently
+        checkpoint_dir: str=None, Multi-Channel Funnels API only: a directory for the checkpoints of the download,
+                        a failed download is resumed from its checkpoint
+        page_workers: int=None, Multi-Channel Funnels API only: the maximum number of pages downloaded concurrently
+        streaming: bool=False, if the responses are decoded incrementally, needs the package ijson
+        split_sampled: bool=False, Reporting API V4 only: if sampled date ranges are split until they are not sampled
+        compare_start_date: str=None, Reporting API V4 only: the start date of a second date range
+        compare_end_date: str=None, the end date of the second date range
+        date_range_layout: str='rows', how the metrics of the second date range are written, 'rows' or 'columns'
+        engine: str=None, 'threads' or 'asyncio', how the downloader sends the requests
+        prometheus_textfile: str=None, a file to which the totals of the download are written in the Prometheus
+                             text format
     """
 
     metrics_param = ','.join(metrics) if metrics else None
@@ -161,7 +520,47 @@ def ga_downloader_shell_command(view_id: int,
     ])
     if filters:
         command.append(f" --filters='{filters}'")
+    if page_size:
+        command.append(f' --page-size={page_size}')
+    if shard_by:
+        command.append(f" --shard-by='{shard_by}'")
+    if max_workers:
+        command.append(f' --max-workers={max_workers}')
+    if checkpoint_dir:
+        command.append(f" --checkpoint-dir='{checkpoint_dir}' --resume")
+    if page_workers:
+        command.append(f' --page-workers={page_workers}')
+    if streaming:
+        command.append(' --streaming')
+    if split_sampled:
+        command.append(' --split-sampled')
+    if compare_start_date:
+        command.append(f" --compare-start-date='{compare_start_date}' --compare-end-date='{compare_end_date}'"
+                       f" --date-range-layout='{date_range_layout}'")
+    if engine:
+        command.append(f" --engine='{engine}'")
+    if prometheus_textfile:
+        command.append(f" --prometheus-textfile='{prometheus_textfile}'")
+    if c.ga_worker_socket():
+        command.append(f" --worker-socket='{c.ga_worker_socket()}'")
     if not use_flask_command:
+        # the rate limits, the caches and the api urls of the config are not available in the downloader process
+        if c.ga_requests_per_second_limit():
+            command.append(f' --requests-per-second={c.ga_requests_per_second_limit()}')
+        if c.ga_requests_per_second_per_view_limit():
+            command.append(f' --requests-per-second-per-view={c.ga_requests_per_second_per_view_limit()}')
+        if c.ga_rate_limit_state_file():
+            command.append(f" --rate-limit-state-file='{c.ga_rate_limit_state_file()}'")
+        if c.ga_response_cache_file():
+            command.append(f" --response-cache-file='{c.ga_response_cache_file()}'")
+        if c.ga_token_cache_file():
+            command.append(f" --token-cache-file='{c.ga_token_cache_file()}'")
+        if c.ga_telemetry_json_lines():
+            command.append(' --telemetry-json-lines')
+        if c.ga_api_root_url():
+            command.append(f" --api-root-url='{c.ga_api_root_url()}'")
+        if c.ga_token_uri():
+            command.append(f" --token-uri='{c.ga_token_uri()}'")
         if c.ga_service_account_client_id():
             command.extend([
                 _shell_linebreak_escape,
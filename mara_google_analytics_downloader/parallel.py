@@ -0,0 +1,44 @@
+"""Helpers for running downloads concurrently"""
+
+import collections
+import contextvars
+import typing as t
+
+
+def ordered_map(function: t.Callable, items: t.Iterable, max_workers: int = 4) -> t.Iterator:
+    """
+    Applies a function concurrently to items and yields the results in the order of the items
+
+    At most `max_workers` results are pending at any time, so a slow item holds back only a bounded number of
+    finished results. If a call raises an exception, it is re-raised when its result is due.
+
+    Args:
+        function: the function to be called with each item
+        items: the items to be processed
+        max_workers: the maximum number of concurrent calls
+    """
+    import concurrent.futures
+
+    items = iter(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(submit_in_context(executor, function, item))
+                if len(pending) >= max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def submit_in_context(executor, function: t.Callable, *args):
+    """
+    Submits a call to an executor which runs in a copy of the current context
+
+    Context variables, e.g. the API root url of a job of a downloader worker (see `services.api_root_url_context`),
+    are then also set in the threads of the executor.
+    """
+    return executor.submit(contextvars.copy_context().run, function, *args)
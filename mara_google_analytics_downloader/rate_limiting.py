@@ -0,0 +1,195 @@
+"""Client side rate limiting of the requests to the Google Analytics APIs
+
+All requests of a process pass one `RateLimiter` which keeps a token bucket for the project (the credentials)
+and one for each view, see
+    https://developers.google.com/analytics/devguides/reporting/core/v4/limits-quotas
+
+All limits are off unless configured (see the config functions `ga_*_limit`). Google Analytics also limits the
+number of concurrent requests of a view to 10, which is not a rate: it is bounded by the number of workers.
+
+The buckets slow down when the API answers with a rate limit error and recover slowly on success (additive
+increase, multiplicative decrease). When a state file is given, the buckets are kept in a SQLite database so that
+several downloader processes on the same host share them.
+"""
+
+import contextlib
+import datetime
+import json
+import threading
+import time
+import typing as t
+
+from mara_google_analytics_downloader import config as c
+
+
+class RateLimiter:
+    def __init__(self,
+                 requests_per_second: float = None,
+                 requests_per_second_per_view: float = None,
+                 requests_per_day: int = None,
+                 requests_per_day_per_view: int = None,
+                 state_file: str = None) -> None:
+        """
+        A token bucket rate limiter for the project and for each view
+
+        Args:
+            requests_per_second: the maximum requests per second for the project, None for no limit
+            requests_per_second_per_view: the maximum requests per second for a view, None for no limit
+            requests_per_day: the maximum requests per day for the project, None for no limit
+            requests_per_day_per_view: the maximum requests per day for a view, None for no limit
+            state_file: a SQLite file to share the buckets between processes. When None, the buckets are only
+                        shared by the threads of this process.
+        """
+        self.requests_per_second = requests_per_second
+        self.requests_per_second_per_view = requests_per_second_per_view
+        self.requests_per_day = requests_per_day
+        self.requests_per_day_per_view = requests_per_day_per_view
+        self.state_file = state_file
+        self._store = _SQLiteStore(state_file) if state_file else _MemoryStore()
+
+    def acquire(self, view_id: t.Union[int, str] = None):
+        """Blocks until a request for the view may be sent"""
+        for key, requests_per_second, requests_per_day in self._buckets(view_id):
+            while True:
+                wait_seconds = self._take_token(key, requests_per_second, requests_per_day)
+                if not wait_seconds:
+                    break
+                time.sleep(wait_seconds)
+
+    async def acquire_async(self, view_id: t.Union[int, str] = None):
+        """Like `acquire`, but waits without blocking the event loop, see the module `async_engine`"""
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        for key, requests_per_second, requests_per_day in self._buckets(view_id):
+            while True:
+                if self.state_file:
+                    # the transaction waits for the lock of the state file
+                    wait_seconds = await loop.run_in_executor(None, self._take_token, key, requests_per_second,
+                                                              requests_per_day)
+                else:
+                    wait_seconds = self._take_token(key, requests_per_second, requests_per_day)
+                if not wait_seconds:
+                    break
+                await asyncio.sleep(wait_seconds)
+
+    def _take_token(self, key: str, requests_per_second: t.Optional[float], requests_per_day: t.Optional[int]) \
+            -> float:
+        with self._store.transaction(key) as state:
+            return _take_token(state, key, time.time(), requests_per_second, requests_per_day)
+
+    def report_success(self, view_id: t.Union[int, str] = None):
+        """Increases the rate of the buckets of the view again after a successful request"""
+        for key, requests_per_second, _ in self._buckets(view_id):
+            if requests_per_second:
+                with self._store.transaction(key) as state:
+                    state['rate'] = min(requests_per_second,
+                                        state.get('rate', requests_per_second) + requests_per_second / 20)
+
+    def report_rate_limited(self, view_id: t.Union[int, str] = None):
+        """Halves the rate of the buckets of the view after the API answered with a rate limit error"""
+        for key, requests_per_second, _ in self._buckets(view_id):
+            if requests_per_second:
+                with self._store.transaction(key) as state:
+                    state['rate'] = max(requests_per_second / 100, state.get('rate', requests_per_second) / 2)
+                    state['tokens'] = 0
+
+    def _buckets(self, view_id) -> t.List[t.Tuple[str, t.Optional[float], t.Optional[int]]]:
+        buckets = [('project', self.requests_per_second, self.requests_per_day)]
+        if view_id is not None:
+            buckets.append((f'view:{view_id}', self.requests_per_second_per_view, self.requests_per_day_per_view))
+        return buckets
+
+
+def _take_token(state: dict, key: str, now: float,
+                requests_per_second: t.Optional[float], requests_per_day: t.Optional[int]) -> float:
+    """Takes a token from the bucket state, returns 0 on success or the seconds to wait for the next token"""
+    today = datetime.date.today().isoformat()
+    if state.get('day') != today:
+        state['day'] = today
+        state['requests'] = 0
+    if requests_per_day and state['requests'] >= requests_per_day:
+        raise RuntimeError(f'The daily limit of {requests_per_day} requests for {key} is exhausted')
+
+    if requests_per_second:
+        rate = state.get('rate', requests_per_second)
+        # allow bursts of up to one second
+        capacity = max(1.0, requests_per_second)
+        tokens = min(capacity, state.get('tokens', capacity) + (now - state.get('updated', now)) * rate)
+        state['updated'] = now
+        if tokens < 1:
+            state['tokens'] = tokens
+            return (1 - tokens) / rate
+        state['tokens'] = tokens - 1
+
+    state['requests'] += 1
+    return 0
+
+
+class _MemoryStore:
+    """Keeps the bucket states in memory, shared by all threads"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._states = {}
+
+    @contextlib.contextmanager
+    def transaction(self, key: str):
+        with self._lock:
+            yield self._states.setdefault(key, {})
+
+
+class _SQLiteStore:
+    """Keeps the bucket states in a SQLite file, shared by all processes using the same file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def transaction(self, key: str):
+        if not hasattr(self._local, 'connection'):
+            import sqlite3
+
+            # autocommit mode, the transaction is controlled explicitly below
+            self._local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.connection.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limit_bucket (key TEXT PRIMARY KEY, state TEXT NOT NULL)')
+        connection = self._local.connection
+
+        # BEGIN IMMEDIATE takes the write lock of the database, other processes wait for it
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT state FROM rate_limit_bucket WHERE key = ?', (key,)).fetchone()
+            state = json.loads(row[0]) if row else {}
+            yield state
+            connection.execute('INSERT OR REPLACE INTO rate_limit_bucket (key, state) VALUES (?, ?)',
+                               (key, json.dumps(state)))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+
+_rate_limiter: t.Optional[RateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def rate_limiter() -> RateLimiter:
+    """Returns the rate limiter of this process, created from the config on first use"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if not _rate_limiter:
+            _rate_limiter = RateLimiter(requests_per_second=c.ga_requests_per_second_limit(),
+                                        requests_per_second_per_view=c.ga_requests_per_second_per_view_limit(),
+                                        requests_per_day=c.ga_requests_per_day_limit(),
+                                        requests_per_day_per_view=c.ga_requests_per_day_per_view_limit(),
+                                        state_file=c.ga_rate_limit_state_file())
+        return _rate_limiter
+
+
+def configure_rate_limiter(**kwargs):
+    """Replaces the rate limiter of this process, see `RateLimiter` for the arguments"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = RateLimiter(**kwargs)
@@ -0,0 +1,138 @@
+"""Paged and batched requests to the Analytics Reporting API V4
+
+A `reports().batchGet` call takes up to five report requests. All requests of one call must have the same
+viewId, dateRanges, segments, samplingLevel and cohortGroup, see
+    https://developers.google.com/analytics/devguides/reporting/core/v4/rest/v4/reports/batchGet
+"""
+
+import json
+import typing as t
+
+MAX_REPORT_REQUESTS_PER_BATCH = 5
+
+MAX_METRICS_PER_REQUEST = 10
+"""The maximum number of metrics of a report request, more metrics are split into groups, see `metric_groups`"""
+
+MAX_DIMENSIONS_PER_REQUEST = 7
+"""The maximum number of dimensions of a report request"""
+
+
+def batch_report_requests(report_requests: t.List[dict]) -> t.List[t.List[int]]:
+    """
+    Packs report requests into batches which can be sent in one batchGet call
+
+    Args:
+        report_requests: the report requests
+
+    Returns:
+        A list of batches, each a list of indexes into `report_requests`, in the order of the report requests
+    """
+    batches_by_key = {}
+    for index, report_request in enumerate(report_requests):
+        key = json.dumps([report_request.get(field) for field in
+                          ('viewId', 'dateRanges', 'segments', 'samplingLevel', 'cohortGroup')], sort_keys=True)
+        batches = batches_by_key.setdefault(key, [[]])
+        if len(batches[-1]) == MAX_REPORT_REQUESTS_PER_BATCH:
+            batches.append([])
+        batches[-1].append(index)
+    return sorted((batch for batches in batches_by_key.values() for batch in batches), key=lambda batch: batch[0])
+
+
+def iter_report_pages(analytics, report_requests: t.List[dict],
+                      execute: t.Callable = None) -> t.Iterator[t.Tuple[int, dict]]:
+    """
+    Sends report requests in as few batchGet calls as possible and follows the pages of each report
+
+    Each call carries up to five report requests. When a report has more pages, its request is sent again with
+    the `pageToken` of the next page in the following call, together with the other reports which are not yet
+    complete.
+
+    Args:
+        analytics: the Analytics Reporting API V4 service object
+        report_requests: the report requests, they are not modified
+        execute: a function which executes a request and returns the response, it is called with the request and
+                 the view id of the request (default: `request.execute()`)
+
+    Returns:
+        An iterator of (index of the report request, report) tuples, one per received page, in the order in
+        which they are received
+    """
+    execute = execute or (lambda request, view_id: request.execute())
+
+    for batch in batch_report_requests(report_requests):
+        page_tokens = {index: None for index in batch}
+        while page_tokens:
+            indexes = list(page_tokens.keys())
+            body = {'reportRequests': []}
+            for index in indexes:
+                report_request = dict(report_requests[index])
+                if page_tokens[index]:
+                    report_request['pageToken'] = page_tokens[index]
+                body['reportRequests'].append(report_request)
+
+            response = execute(analytics.reports().batchGet(body=body), report_requests[batch[0]].get('viewId'))
+            reports = response.get('reports', [])
+            if len(reports) != len(indexes):
+                raise RuntimeError(f'Expected {len(indexes)} reports in the batchGet response, got {len(reports)}')
+
+            for index, report in zip(indexes, reports):
+                yield index, report
+
+                if report.get('nextPageToken'):
+                    page_tokens[index] = report['nextPageToken']
+                else:
+                    del page_tokens[index]
+
+
+def metric_groups(metrics: t.List[str]) -> t.List[t.List[str]]:
+    """Splits metrics into groups of at most MAX_METRICS_PER_REQUEST metrics, in the order of the metrics"""
+    return [metrics[start:start + MAX_METRICS_PER_REQUEST]
+            for start in range(0, len(metrics), MAX_METRICS_PER_REQUEST)] or [[]]
+
+
+def join_reports(reports: t.List[dict]) -> dict:
+    """
+    Joins the complete reports of report requests with the same dimensions and different metrics into one report
+
+    The rows are joined by their dimension values. Report requests do not return rows in which all metrics are 0,
+    so a dimension tuple can be missing in some reports, its metrics are then filled with '0'. The rows are in the
+    order of the first report, followed by the rows which are missing there.
+
+    Args:
+        reports: the reports with all rows of all pages, in the order of the metric groups
+
+    Returns:
+        A report with the dimensions and the metrics of all reports
+    """
+    metric_header_entries = [report.get('columnHeader', {}).get('metricHeader', {}).get('metricHeaderEntries', [])
+                             for report in reports]
+    n_date_ranges = max((len(row['metrics']) for report in reports
+                         for row in report.get('data', {}).get('rows', [])), default=1)
+
+    # dimension values -> per date range -> per report -> metric values
+    joined = {}
+    for report_index, report in enumerate(reports):
+        for row in report.get('data', {}).get('rows', []):
+            key = tuple(row.get('dimensions', []))
+            values = joined.get(key)
+            if values is None:
+                values = joined[key] = [[None] * len(reports) for _ in range(n_date_ranges)]
+            for date_range_index, date_range_values in enumerate(row['metrics']):
+                values[date_range_index][report_index] = date_range_values['values']
+
+    missing_values = [['0'] * len(entries) for entries in metric_header_entries]
+    rows = [{'dimensions': list(key),
+             'metrics': [{'values': [value for report_index, report_values in enumerate(date_range_values)
+                                     for value in (report_values if report_values is not None
+                                                   else missing_values[report_index])]}
+                         for date_range_values in values]}
+            for key, values in joined.items()]
+
+    column_header = dict(reports[0].get('columnHeader', {}))
+    column_header['metricHeader'] = {'metricHeaderEntries': [entry for entries in metric_header_entries
+                                                             for entry in entries]}
+    data = {key: value for key, value in reports[0].get('data', {}).items() if key not in ('rows', 'totals')}
+    data.update({'rows': rows, 'rowCount': len(rows)})
+    if any('isDataGolden' in report.get('data', {}) for report in reports):
+        data['isDataGolden'] = all(report.get('data', {}).get('isDataGolden') is not False for report in reports)
+    return {'columnHeader': column_header, 'data': data}
@@ -0,0 +1,161 @@
+"""A local cache of the pages received from the Google Analytics APIs
+
+Google Analytics data of past dates does not change anymore once it is processed, usually after one or two days.
+Pages whose date range ends before a freshness window are therefore cached without expiry, all other pages only
+for a short time. Reruns of a pipeline get the historical pages from the cache and use no API quota for them.
+
+The pages are kept compressed in a SQLite file, so that several downloader processes on the same host can share
+the cache. When the cache grows beyond its maximum size, the least recently used pages are removed.
+
+Cache keys are built from the query with absolute dates, see `cache_key`.
+"""
+
+import datetime
+import json
+import threading
+import time
+import typing as t
+import zlib
+
+from mara_google_analytics_downloader import config as c
+from mara_google_analytics_downloader.checkpoint import query_fingerprint
+from mara_google_analytics_downloader.date_ranges import resolve_date
+
+if t.TYPE_CHECKING:
+    import sqlite3
+
+
+def cache_key(**query) -> str:
+    """The key of a page, from the view, the absolute dates, metrics, dimensions, filters and the page position"""
+    return query_fingerprint(**query)
+
+
+def ga_cache_key(body: dict) -> t.Tuple[str, datetime.date]:
+    """The cache key of a batchGet request body with absolute dates, and the last end date of its report requests"""
+    body = json.loads(json.dumps(body))
+    end_dates = []
+    for report_request in body.get('reportRequests', []):
+        for date_range in report_request.get('dateRanges', []):
+            date_range['startDate'] = resolve_date(date_range['startDate']).isoformat()
+            date_range['endDate'] = resolve_date(date_range['endDate']).isoformat()
+            end_dates.append(resolve_date(date_range['endDate']))
+    return cache_key(api='ga', body=body), max(end_dates, default=datetime.date.today())
+
+
+class ResponseCache:
+    def __init__(self, path: str,
+                 max_size: int = 1024 ** 3,
+                 freshness_days: int = 3,
+                 ttl_seconds: float = 3600) -> None:
+        """
+        A cache of API responses in a SQLite file
+
+        Args:
+            path: the SQLite file
+            max_size: the maximum size of all cached responses in bytes (compressed)
+            freshness_days: pages with an end date within the last `freshness_days` days can still change and are
+                            cached only for `ttl_seconds`. Older pages never expire.
+            ttl_seconds: how long pages with recent dates are cached
+        """
+        self.path = path
+        self.max_size = max_size
+        self.freshness_days = freshness_days
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+    def get(self, key: str) -> t.Optional[dict]:
+        """The cached response for the key, None when it is not cached or expired"""
+        connection = self._connection()
+        row = connection.execute('SELECT response, expires FROM response_cache WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        response, expires = row
+        if expires is not None and expires < time.time():
+            connection.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+            return None
+        connection.execute('UPDATE response_cache SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(zlib.decompress(response).decode('utf-8'))
+
+    def put(self, key: str, response: dict, end_date: datetime.date, final: bool = True):
+        """
+        Caches a response
+
+        Args:
+            key: the key of the page, see `cache_key`
+            response: the response
+            end_date: the absolute end date of the query, decides if the response expires
+            final: False if the API reported that the data may still change (e.g. `isDataGolden` false)
+        """
+        data = zlib.compress(json.dumps(response).encode('utf-8'))
+        if final and end_date < datetime.date.today() - datetime.timedelta(days=self.freshness_days):
+            expires = None
+        else:
+            expires = time.time() + self.ttl_seconds
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR REPLACE INTO response_cache (key, response, size, expires, accessed) '
+                               'VALUES (?, ?, ?, ?, ?)', (key, data, len(data), expires, time.time()))
+            self._evict(connection)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _evict(self, connection: 'sqlite3.Connection'):
+        """Removes expired responses and then the least recently used ones until the cache fits its size"""
+        connection.execute('DELETE FROM response_cache WHERE expires < ?', (time.time(),))
+        size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+        if size <= self.max_size:
+            return
+        for key, key_size in connection.execute('SELECT key, size FROM response_cache ORDER BY accessed').fetchall():
+            connection.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+            size -= key_size
+            if size <= self.max_size:
+                break
+
+    def _connection(self) -> 'sqlite3.Connection':
+        if not hasattr(self._local, 'connection'):
+            import sqlite3
+
+            # autocommit mode, transactions are controlled explicitly
+            self._local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.connection.execute('''
+CREATE TABLE IF NOT EXISTS response_cache (
+  key      TEXT PRIMARY KEY,
+  response BLOB NOT NULL,
+  size     INTEGER NOT NULL,
+  expires  REAL,
+  accessed REAL NOT NULL
+)''')
+            self._local.connection.execute(
+                'CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed)')
+        return self._local.connection
+
+
+_response_cache: t.Optional[ResponseCache] = None
+_response_cache_configured = False
+_response_cache_lock = threading.Lock()
+
+
+def response_cache() -> t.Optional[ResponseCache]:
+    """Returns the response cache of this process, created from the config on first use. None if not configured"""
+    global _response_cache, _response_cache_configured
+    with _response_cache_lock:
+        if not _response_cache_configured:
+            if c.ga_response_cache_file():
+                _response_cache = ResponseCache(path=c.ga_response_cache_file(),
+                                                max_size=c.ga_response_cache_max_size(),
+                                                freshness_days=c.ga_response_cache_freshness_days(),
+                                                ttl_seconds=c.ga_response_cache_ttl_seconds())
+            _response_cache_configured = True
+        return _response_cache
+
+
+def configure_response_cache(path: t.Optional[str], **kwargs):
+    """Replaces the response cache of this process, None for no cache. See `ResponseCache` for the arguments"""
+    global _response_cache, _response_cache_configured
+    with _response_cache_lock:
+        _response_cache = ResponseCache(path, **kwargs) if path else None
+        _response_cache_configured = True
@@ -0,0 +1,85 @@
+"""Retrying of failed requests to the Google Analytics APIs
+
+Only transient errors are retried: server errors (5xx), rate limit errors (429 and 403 with the reason
+rateLimitExceeded, userRateLimitExceeded or quotaExceeded) and network errors. All other errors, e.g. invalid
+metric names or failed authentication, fail immediately. See
+    https://developers.google.com/analytics/devguides/reporting/core/v4/errors
+"""
+
+import random
+import time
+import typing as t
+
+RETRYABLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded', 'backendError',
+                     'internalServerError')
+
+
+class RetryPolicy:
+    def __init__(self,
+                 max_retries: int = 5,
+                 initial_backoff_seconds: float = 1.0,
+                 max_backoff_seconds: float = 64.0) -> None:
+        """
+        Exponential backoff with jitter for transient errors
+
+        Args:
+            max_retries: how often a failed request is retried
+            initial_backoff_seconds: the pause before the first retry, doubled for each following retry
+            max_backoff_seconds: the maximum pause between two retries (a Retry-After header may exceed it)
+        """
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    def is_retryable(self, exception: Exception) -> bool:
+        """If the request which raised the exception should be retried"""
+        from googleapiclient.errors import HttpError
+        import http.client
+        import httplib2
+        import oauth2client.client
+
+        if isinstance(exception, HttpError):
+            status = exception.resp.status
+            if status == 429 or status >= 500:
+                return True
+            return status == 403 and any(reason in str(exception.content) for reason in RETRYABLE_REASONS)
+        if isinstance(exception, oauth2client.client.HttpAccessTokenRefreshError):
+            return (exception.status or 0) >= 500
+        return isinstance(exception, (OSError, http.client.HTTPException, httplib2.HttpLib2Error))
+
+    def backoff_seconds(self, retry: int, exception: Exception = None) -> float:
+        """The pause before the given retry (starting with 0), at least as long as a Retry-After header asks for"""
+        backoff = min(self.max_backoff_seconds, self.initial_backoff_seconds * 2 ** retry)
+        backoff = backoff / 2 + random.uniform(0, backoff / 2)
+        retry_after = _retry_after_seconds(exception)
+        return max(backoff, retry_after) if retry_after is not None else backoff
+
+
+def is_rate_limit_error(exception: Exception) -> bool:
+    """If the exception is a 429 or 403 rateLimitExceeded/userRateLimitExceeded error of the API"""
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    return exception.resp.status == 403 and any(
+        reason in str(exception.content) for reason in ('rateLimitExceeded', 'userRateLimitExceeded'))
+
+
+def _retry_after_seconds(exception: t.Optional[Exception]) -> t.Optional[float]:
+    """The seconds of the Retry-After header of an HttpError (as seconds or as HTTP date), if any"""
+    resp = getattr(exception, 'resp', None)
+    value = resp.get('retry-after') if resp is not None and hasattr(resp, 'get') else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
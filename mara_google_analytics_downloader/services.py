@@ -0,0 +1,84 @@
+"""Google Analytics API service objects which are built once and reused
+
+Building a service object parses the discovery document and creates a new HTTP client. The service objects are
+therefore cached and reused for all pages and retries. The underlying httplib2 client keeps its connections alive.
+
+httplib2 is not thread safe, so each thread gets its own service objects.
+
+The requests can be sent to another root url than the one of the Google APIs, e.g. to the local fake server in
+`benchmarks/fake_api.py`, see `config.ga_api_root_url` and `configure_api_root_url`.
+"""
+
+import contextlib
+import contextvars
+import inspect
+import threading
+import typing as t
+
+from mara_google_analytics_downloader import config as c
+
+_local = threading.local()
+
+_api_root_url: t.Optional[str] = None
+
+_context_api_root_url = contextvars.ContextVar('api_root_url', default=None)
+
+
+def analytics_reporting_service(credentials):
+    """Returns the service object for the Analytics Reporting API V4 (`ga:` metrics and dimensions)"""
+    return _service('analyticsreporting', 'v4', credentials)
+
+
+def analytics_service(credentials):
+    """Returns the service object for the Analytics API V3 incl. the Multi-Channel Funnels API (`mcf:` metrics)"""
+    return _service('analytics', 'v3', credentials)
+
+
+def api_root_url() -> t.Optional[str]:
+    """The root url to which the requests are sent, None for the Google APIs"""
+    return _context_api_root_url.get() or _api_root_url or c.ga_api_root_url()
+
+
+def configure_api_root_url(root_url: str):
+    """Sends the requests of this process to another root url than the one from the config"""
+    global _api_root_url
+    _api_root_url = root_url
+
+
+@contextlib.contextmanager
+def api_root_url_context(root_url: t.Optional[str]):
+    """Sends the requests of the current context to another root url, e.g. for a job of a downloader worker
+
+    Threads started with `parallel.ordered_map` or `parallel.submit_in_context` inherit the root url.
+    """
+    token = _context_api_root_url.set(root_url)
+    try:
+        yield
+    finally:
+        _context_api_root_url.reset(token)
+
+
+def _service(service_name: str, version: str, credentials):
+    if not hasattr(_local, 'services'):
+        _local.services = {}
+
+    key = (service_name, version, credentials, api_root_url())
+    if key not in _local.services:
+        _local.services[key] = _build(service_name, version, credentials, api_root_url())
+    return _local.services[key]
+
+
+def _build(service_name: str, version: str, credentials, root_url: str = None):
+    from apiclient import discovery
+
+    kwargs = {}
+    if 'static_discovery' in inspect.signature(discovery.build).parameters:
+        # google-api-python-client >= 2.0 ships the discovery documents with the library
+        kwargs['static_discovery'] = c.ga_use_static_discovery_document()
+    if root_url:
+        if 'client_options' not in inspect.signature(discovery.build).parameters:
+            raise RuntimeError('Another API root url needs google-api-python-client >= 1.8')
+        # the Analytics API V3 has its version in the service path, the Reporting API V4 in the method paths
+        kwargs['client_options'] = {'api_endpoint': root_url + ('analytics/v3/' if service_name == 'analytics' else '')}
+
+    return discovery.build(service_name, version, credentials=credentials, cache_discovery=False, **kwargs)
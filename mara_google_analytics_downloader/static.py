@@ -622,3 +622,8 @@ DIMENSIONS = [
     'ga:dsKeyword',
     'ga:dsKeywordId',
 ]
+
+# Frozen lookup structures of the lists above, for membership tests.
+# This module is only imported when a filter is parsed.
+METRIC_NAMES = frozenset(METRICS)
+DIMENSION_NAMES = frozenset(DIMENSIONS)
@@ -0,0 +1,113 @@
+"""Incremental decoding of large API responses
+
+`request.execute()` of google-api-python-client reads the whole response body and decodes it into nested dicts
+before the first row can be written. Here the response body is read from the socket and decoded row by row with
+ijson, so that the memory needed does not grow with the page size.
+
+Needs the optional package ijson (`pip install ijson`).
+"""
+
+import typing as t
+
+GA_ROWS_PREFIX = 'reports.item.data.rows'
+"""The ijson prefix of the rows in a Reporting API V4 response"""
+
+MCF_ROWS_PREFIX = 'rows'
+"""The ijson prefix of the rows in a Multi-Channel Funnels API response"""
+
+
+def is_available() -> bool:
+    """If ijson is installed"""
+    try:
+        import ijson
+        return True
+    except ImportError:
+        return False
+
+
+def execute_streaming(request, credentials, rows_prefix: str,
+                      on_rows: t.Callable[[int, t.List, dict], None],
+                      batch_size: int = 1000, timeout: float = 300) -> dict:
+    """
+    Executes a request of google-api-python-client and passes the rows of the response to a callback while the
+    response is being received
+
+    Args:
+        request: a `googleapiclient.http.HttpRequest`, e.g. from `analytics.reports().batchGet(body=...)`
+        credentials: the oauth2 credentials used for the request
+        rows_prefix: the ijson prefix of the rows, see GA_ROWS_PREFIX and MCF_ROWS_PREFIX
+        on_rows: called with the index of the report (always 0 for MCF), a batch of rows and the part of the
+                 response decoded so far (the rows excluded)
+        batch_size: the maximum number of rows per call of `on_rows`
+        timeout: the socket timeout in seconds
+
+    Returns:
+        The response without the rows
+    """
+    response = _open(request, credentials, timeout)
+    try:
+        return _parse(response, rows_prefix, on_rows, batch_size)
+    finally:
+        response.close()
+
+
+def _open(request, credentials, timeout: float):
+    from googleapiclient.errors import HttpError
+    import gzip
+    import httplib2
+    import urllib.error
+    import urllib.request
+
+    headers = dict(request.headers)
+    headers['accept-encoding'] = 'gzip'
+    headers['authorization'] = f'Bearer {credentials.get_access_token().access_token}'
+    body = request.body.encode('utf-8') if isinstance(request.body, str) else request.body
+
+    try:
+        response = urllib.request.urlopen(
+            urllib.request.Request(request.uri, data=body, headers=headers, method=request.method), timeout=timeout)
+    except urllib.error.HTTPError as e:
+        # raise the same exception as google-api-python-client, so that errors are classified the same way
+        resp = httplib2.Response({'status': e.code, **{key.lower(): value for key, value in e.headers.items()}})
+        resp.reason = e.reason
+        content = e.read()
+        if e.headers.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        raise HttpError(resp, content, uri=request.uri)
+
+    if response.headers.get('Content-Encoding') == 'gzip':
+        return gzip.GzipFile(fileobj=response, mode='rb')
+    return response
+
+
+def _parse(fileobj, rows_prefix: str, on_rows: t.Callable[[int, t.List, dict], None], batch_size: int) -> dict:
+    import ijson
+
+    row_prefix = rows_prefix + '.item'
+    report_prefix = rows_prefix.split('.data.')[0] if '.data.' in rows_prefix else None
+
+    document = ijson.ObjectBuilder()
+    row = None
+    rows = []
+    report_index = -1
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if prefix == row_prefix or prefix.startswith(row_prefix + '.'):
+            if row is None:
+                row = ijson.ObjectBuilder()
+            row.event(event, value)
+            if prefix == row_prefix and event in ('end_map', 'end_array'):
+                rows.append(row.value)
+                row = None
+                if len(rows) >= batch_size:
+                    on_rows(max(report_index, 0), rows, document.value)
+                    rows = []
+            continue
+
+        if prefix == report_prefix and event == 'start_map':
+            report_index += 1
+        if prefix == rows_prefix and event == 'end_array' and rows:
+            on_rows(max(report_index, 0), rows, document.value)
+            rows = []
+        document.event(event, value)
+
+    return document.value
@@ -0,0 +1,188 @@
+"""Performance telemetry of the requests and downloads
+
+For each request (including its retries), the latency of the successful try, the bytes and rows received, the
+number of retries, the time spent in backoff, the rate limit (quota) errors and whether the response is sampled are
+recorded. For each download, the totals of its requests, the rows written, the duration and the rows per second.
+
+The records can be written as JSON lines to stderr (`{"event": "request", ...}` and `{"event": "download", ...}`)
+and the totals of the last download to a Prometheus textfile (e.g. for the textfile collector of node_exporter).
+The totals are also available as `Telemetry.last_download`, e.g. for logging, and can be read back from a
+Prometheus textfile with `read_prometheus_textfile`.
+
+The totals are kept per process: in a downloader worker, which runs several downloads at the same time, the totals
+of concurrent downloads are mixed. The request records are not affected.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import typing as t
+
+from mara_google_analytics_downloader import config as c
+
+_TOTALS = ['requests', 'retries', 'backoff_seconds', 'rate_limited_errors', 'request_seconds', 'bytes_received',
+           'rows_received', 'sampled_responses', 'failed_requests']
+
+_PROMETHEUS_HELP = {
+    'requests': 'Requests sent (without retries)',
+    'retries': 'Retries of failed requests',
+    'backoff_seconds': 'Time spent waiting before retries',
+    'rate_limited_errors': 'Rate limit and quota errors of the API',
+    'request_seconds': 'Sum of the latencies of the successful tries of the requests',
+    'bytes_received': 'Bytes of the response bodies received',
+    'rows_received': 'Rows in the received responses',
+    'sampled_responses': 'Responses which contain sampled data',
+    'failed_requests': 'Requests which failed after all retries',
+    'rows': 'Rows written',
+    'seconds': 'Duration of the download',
+    'rows_per_second': 'Rows written per second',
+    'success': '1 if the download succeeded, 0 if it failed',
+    'timestamp_seconds': 'Unix time of the end of the download',
+}
+
+
+class Telemetry:
+    def __init__(self, json_lines: bool = False, prometheus_textfile: str = None) -> None:
+        """
+        Records the performance of requests and downloads
+
+        Args:
+            json_lines: if request and download records are written as JSON lines to stderr
+            prometheus_textfile: a file to which the totals of the last download are written in the Prometheus text
+                                 format. It is replaced atomically after each download.
+        """
+        self.json_lines = json_lines
+        self.prometheus_textfile = prometheus_textfile
+        self.last_download: t.Optional[dict] = None
+        self._lock = threading.Lock()
+        self._totals = dict.fromkeys(_TOTALS, 0)
+        self._start = time.monotonic()
+
+    def start_download(self):
+        """Resets the totals at the start of a download"""
+        with self._lock:
+            self._totals = dict.fromkeys(_TOTALS, 0)
+            self._start = time.monotonic()
+
+    def record_request(self, api: str, view_id: t.Union[int, str], seconds: float, response: dict = None,
+                       bytes_received: int = None, rows: int = None, retries: int = 0,
+                       backoff_seconds: float = 0.0,
+                       rate_limited_errors: int = 0, error: Exception = None):
+        """
+        Records a request after its last try
+
+        Args:
+            api: 'ga' or 'mcf'
+            view_id: the view of the request
+            seconds: the latency of the last try
+            response: the response, None if the request failed
+            bytes_received: the size of the response body, if known
+            rows: the number of rows received, if not in the response (e.g. when streaming)
+            retries: how often the request was retried
+            backoff_seconds: the time waited before the retries
+            rate_limited_errors: the number of tries which failed with a rate limit or quota error
+            error: the exception if the request failed after all retries
+        """
+        response_rows, sampled = _rows_and_sampling(response) if response is not None else (0, False)
+        rows = response_rows if rows is None else rows
+        with self._lock:
+            totals = self._totals
+            totals['requests'] += 1
+            totals['retries'] += retries
+            totals['backoff_seconds'] += backoff_seconds
+            totals['rate_limited_errors'] += rate_limited_errors
+            totals['request_seconds'] += seconds
+            totals['bytes_received'] += bytes_received or 0
+            totals['rows_received'] += rows
+            totals['sampled_responses'] += int(sampled)
+            totals['failed_requests'] += int(error is not None)
+        if self.json_lines:
+            record = {'event': 'request', 'api': api, 'view_id': str(view_id), 'seconds': round(seconds, 3),
+                      'bytes_received': bytes_received, 'rows': rows, 'retries': retries,
+                      'backoff_seconds': round(backoff_seconds, 3), 'rate_limited_errors': rate_limited_errors,
+                      'sampled': sampled}
+            if error is not None:
+                record['error'] = f'{error.__class__.__name__}: {error}'
+            self._emit(record)
+
+    def finish_download(self, api: str, view_id: t.Union[int, str], nrows: int, error: Exception = None) -> dict:
+        """Records the end of a download, writes its totals and returns them"""
+        with self._lock:
+            seconds = time.monotonic() - self._start
+            summary = {'event': 'download', 'api': api, 'view_id': str(view_id), 'success': int(error is None),
+                       'rows': nrows, 'seconds': round(seconds, 3),
+                       'rows_per_second': round(nrows / seconds, 1) if seconds else None,
+                       **{key: round(value, 3) if isinstance(value, float) else value
+                          for key, value in self._totals.items()}}
+            if error is not None:
+                summary['error'] = f'{error.__class__.__name__}: {error}'
+            self.last_download = summary
+        if self.json_lines:
+            self._emit(summary)
+        if self.prometheus_textfile:
+            self._write_prometheus_textfile(summary)
+        return summary
+
+    def _emit(self, record: dict):
+        print(json.dumps(record), file=sys.stderr, flush=True)
+
+    def _write_prometheus_textfile(self, summary: dict):
+        labels = f'api="{summary["api"]}",view_id="{summary["view_id"]}"'
+        lines = []
+        for key, value in dict(summary, timestamp_seconds=round(time.time())).items():
+            if key not in _PROMETHEUS_HELP or value is None:
+                continue
+            name = f'ga_downloader_last_download_{key}'
+            lines += [f'# HELP {name} {_PROMETHEUS_HELP[key]}', f'# TYPE {name} gauge', f'{name}{{{labels}}} {value}']
+        tmp_path = f'{self.prometheus_textfile}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_textfile)
+
+
+def read_prometheus_textfile(path: str) -> dict:
+    """Reads the totals of a download from a Prometheus textfile written by `Telemetry`"""
+    prefix = 'ga_downloader_last_download_'
+    summary = {}
+    with open(path) as f:
+        for line in f:
+            if not line.startswith(prefix):
+                continue
+            name, value = line.rstrip('\n').rsplit(' ', 1)
+            key = name[len(prefix):name.index('{')]
+            try:
+                summary[key] = int(value)
+            except ValueError:
+                summary[key] = float(value)
+    return summary
+
+
+def _rows_and_sampling(response: dict) -> t.Tuple[int, bool]:
+    """The number of rows of a Reporting API V4 or Multi-Channel Funnels API response and if it is sampled"""
+    if 'reports' in response:
+        data = [report.get('data', {}) for report in response['reports']]
+        return (sum(len(report_data.get('rows', [])) for report_data in data),
+                any(report_data.get('samplesReadCounts') for report_data in data))
+    return len(response.get('rows', [])), bool(response.get('containsSampledData'))
+
+
+_telemetry: t.Optional[Telemetry] = None
+_telemetry_lock = threading.Lock()
+
+
+def telemetry() -> Telemetry:
+    """Returns the telemetry of this process, created from the config on first use"""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(json_lines=c.ga_telemetry_json_lines())
+        return _telemetry
+
+
+def configure_telemetry(json_lines: bool = False, prometheus_textfile: str = None):
+    """Replaces the telemetry of this process, see `Telemetry` for the arguments"""
+    global _telemetry
+    with _telemetry_lock:
+        _telemetry = Telemetry(json_lines=json_lines, prometheus_textfile=prometheus_textfile)
@@ -0,0 +1,124 @@
+"""A cache of OAuth2 access tokens shared by the downloader processes on a host
+
+Without the cache, each downloader process requests a new access token from the token endpoint. With the cache,
+the access token is kept in a file and used by all processes with the same credentials until shortly before it
+expires. The file is locked while a token is refreshed, so that only one process refreshes it while the others
+wait and then use the new token.
+
+The cache implements the storage interface of oauth2client, see `oauth2client.client.Storage`.
+"""
+
+import copy
+import datetime
+import fcntl
+import json
+import os
+import threading
+import typing as t
+
+
+def cache_credentials(credentials, path: str):
+    """Makes oauth2client credentials use the token cache in `path`, keyed by their identity and scopes"""
+    scopes = getattr(credentials, 'scopes', None) or getattr(credentials, '_scopes', '')
+    scopes = ' '.join(sorted(scopes)) if isinstance(scopes, (set, list, tuple)) else str(scopes)
+    credentials.set_store(TokenCache(path, f'{credentials.client_id} {credentials_identity(credentials)} {scopes}',
+                                     credentials))
+    return credentials
+
+
+def credentials_identity(credentials) -> str:
+    """
+    A hash of the account the credentials act for
+
+    User accounts often share the client id of one OAuth client, so the client id alone would give one account
+    the access token of another. User credentials are identified by their refresh token, service account
+    credentials by their client email and private key id.
+    """
+    import hashlib
+
+    if getattr(credentials, 'refresh_token', None):
+        identity = ['user', credentials.refresh_token]
+    else:
+        identity = ['service_account', getattr(credentials, '_service_account_email', None),
+                    getattr(credentials, '_private_key_id', None)]
+    return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    def __init__(self, path: str, key: str, credentials, min_remaining_seconds: float = 300) -> None:
+        """
+        The cached access token of one set of credentials
+
+        Args:
+            path: the cache file. It contains access tokens and is created readable only for the owner.
+            key: the key of the credentials in the cache, e.g. the client id
+            credentials: the oauth2client credentials
+            min_remaining_seconds: cached tokens which expire within this time are not used anymore
+        """
+        self.path = path
+        self.key = key
+        self.credentials = credentials
+        self.min_remaining_seconds = min_remaining_seconds
+        self._thread_lock = threading.Lock()
+        self._lock_file = None
+
+    def acquire_lock(self):
+        self._thread_lock.acquire()
+        try:
+            self._lock_file = open(self.path + '.lock', 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release_lock(self):
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        finally:
+            self._thread_lock.release()
+
+    def locked_get(self):
+        """Returns a copy of the credentials with the cached access token, None if there is no valid token"""
+        entry = self._read().get(self.key)
+        if not entry:
+            return None
+        # oauth2client compares naive UTC datetimes
+        token_expiry = (datetime.datetime.strptime(entry['token_expiry'], '%Y-%m-%dT%H:%M:%S')
+                        - datetime.timedelta(seconds=self.min_remaining_seconds))
+        if token_expiry <= datetime.datetime.utcnow():
+            return None
+        credentials = copy.copy(self.credentials)
+        credentials.access_token = entry['access_token']
+        credentials.token_expiry = token_expiry
+        credentials.invalid = False
+        return credentials
+
+    def locked_put(self, credentials):
+        """Stores the access token of refreshed credentials"""
+        entries = self._read()
+        if credentials.invalid or not credentials.access_token or not credentials.token_expiry:
+            entries.pop(self.key, None)
+        else:
+            entries[self.key] = {'access_token': credentials.access_token,
+                                 'token_expiry': credentials.token_expiry.strftime('%Y-%m-%dT%H:%M:%S')}
+        self._write(entries)
+
+    def locked_delete(self):
+        entries = self._read()
+        if entries.pop(self.key, None):
+            self._write(entries)
+
+    def _write(self, entries: t.Dict[str, dict]):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def _read(self) -> t.Dict[str, dict]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
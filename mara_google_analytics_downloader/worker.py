@@ -0,0 +1,199 @@
+"""A long-lived downloader process which runs downloads for other processes
+
+Starting a downloader process imports the Google API client, authenticates and builds the service objects before
+the first request is sent. The worker does this once: it listens on a Unix socket and runs each download job
+that it receives in one of its threads, with the credentials, service objects and HTTP connections of earlier
+jobs. The CSV is streamed back to the client page by page.
+
+Start the worker with `mara-google-analytics-downloader-worker --socket-path=/path/to/socket` and pass
+`--worker-socket=/path/to/socket` to the downloader. Log messages of the downloads, e.g. about retries, are written
+to the stderr of the worker.
+
+Protocol: the client sends the job as one line of JSON (the arguments of `download`, the credential
+arguments and the API root url). The worker answers with frames of one type byte and a 4 byte length: b'D' frames with CSV data and
+a final b'E' frame with the number of rows or the error as JSON.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+MAX_FRAME_SIZE = 1024 * 1024
+"""The maximum number of bytes of CSV data in a frame"""
+
+
+@click.command()
+@click.option('--socket-path', help='The Unix socket on which the worker accepts download jobs.',
+              required=True)
+@click.option('--max-jobs', help='The maximum number of downloads which run concurrently.',
+              type=click.IntRange(1, 64),
+              default=8,
+              show_default=True,
+              required=False)
+def ga_download_worker(socket_path: str, max_jobs: int = 8):
+    """Runs downloads of other downloader processes, see the module `worker`"""
+    serve(socket_path, max_jobs)
+
+
+def serve(socket_path: str, max_jobs: int = 8):
+    """Accepts download jobs on a Unix socket until the process is terminated
+
+    Args:
+        socket_path: the Unix socket, it is only accessible by the user of the worker
+        max_jobs: the maximum number of downloads which run concurrently. The threads are reused for the following
+                  jobs, so that their service objects stay warm.
+    """
+    with _WorkerServer(socket_path, max_jobs) as server:
+        server.serve_forever()
+
+
+def submit(socket_path: str, job: dict, stream: t.TextIO) -> int:
+    """Runs a download job in the worker and writes the CSV into the stream
+
+    Args:
+        socket_path: the Unix socket of the worker
+        job: the arguments of `mara_google_analytics_downloader.__main__.download`, with a dict of the arguments of
+             `_google_analytics_credentials` as 'credentials' and optionally the 'api_root_url' to which the
+             requests are sent
+        stream: where the CSV is written to
+
+    Returns:
+        The number of rows written
+
+    Raises:
+        ConnectionError (e.g. ConnectionRefusedError) or FileNotFoundError when the worker is not running
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        frames = connection.makefile('rb')
+        while True:
+            header = frames.read(5)
+            if len(header) < 5:
+                raise RuntimeError('The worker closed the connection before the download was complete')
+            frame_type, length = header[:1], struct.unpack('!I', header[1:])[0]
+            data = frames.read(length)
+            if frame_type == b'D':
+                stream.write(data.decode('utf-8'))
+                stream.flush()
+            else:
+                result = json.loads(data.decode('utf-8'))
+                if 'error' in result:
+                    raise RuntimeError(f'The download failed in the worker: {result["error"]}')
+                return result['nrows']
+    finally:
+        connection.close()
+
+
+class _WorkerServer(socketserver.UnixStreamServer):
+    """Runs each connection in a fixed pool of threads instead of a new thread per connection"""
+
+    def __init__(self, socket_path: str, max_jobs: int) -> None:
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                # the socket of a worker which is not running anymore
+                os.remove(socket_path)
+            else:
+                raise RuntimeError(f'A downloader worker is already running at {socket_path}')
+            finally:
+                probe.close()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='ga-download-worker')
+        super().__init__(socket_path, _JobHandler)
+
+    def server_bind(self):
+        # the jobs contain credentials: the socket is created accessible only by the user of the worker, a chmod
+        # after bind() would leave it open to other users for a moment
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request_in_thread, request, client_address)
+
+    def _process_request_in_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        from mara_google_analytics_downloader.__main__ import download
+        from mara_google_analytics_downloader.services import api_root_url_context
+
+        frames = _FrameWriter(self.wfile)
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            credentials = _credentials(job.pop('credentials', {}))
+            with api_root_url_context(job.pop('api_root_url', None)):
+                nrows = download(stream=frames, credentials=credentials, **job)
+            frames.flush()
+            frames.send(b'E', json.dumps({'nrows': nrows}).encode('utf-8'))
+        except Exception as e:
+            frames.send(b'E', json.dumps({'error': f'{e.__class__.__name__}: {e}'}).encode('utf-8'))
+
+
+class _FrameWriter:
+    """A text stream which sends the written CSV as data frames, one frame per page"""
+
+    def __init__(self, wfile) -> None:
+        self.wfile = wfile
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text: str):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= MAX_FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            data = ''.join(self._buffer).encode('utf-8')
+            self._buffer, self._size = [], 0
+            self.send(b'D', data)
+
+    def send(self, frame_type: bytes, data: bytes):
+        self.wfile.write(frame_type + struct.pack('!I', len(data)) + data)
+        self.wfile.flush()
+
+
+_credentials_cache = {}
+_credentials_lock = threading.Lock()
+
+
+def _credentials(arguments: dict):
+    """The credentials for the credential arguments of a job, reused for all jobs with the same arguments"""
+    from mara_google_analytics_downloader.__main__ import _google_analytics_credentials
+
+    key = json.dumps(arguments, sort_keys=True)
+    with _credentials_lock:
+        if key not in _credentials_cache:
+            _credentials_cache[key] = _google_analytics_credentials(**arguments)
+        return _credentials_cache[key]
+
+
+if __name__ == '__main__':
+    ga_download_worker(prog_name='mara_google_analytics_downloader.worker')
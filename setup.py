@@ -27,7 +27,10 @@ setup(
         'google_auth_oauthlib' # new, already used in the user credential helper
     ],
     extras_require={
-        'test': ['pytest']
+        'test': ['pytest'],
+        'streaming': ['ijson>=3.1'],
+        'columnar': ['pyarrow>=1.0'],
+        'async': ['aiohttp>=3.0']
     },
 
     python_requires='>=3.6',
@@ -40,5 +43,6 @@ setup(
     entry_points='''
         [console_scripts]
         mara-google-analytics-downloader=mara_google_analytics_downloader.__main__:ga_download_to_csv
+        mara-google-analytics-downloader-worker=mara_google_analytics_downloader.worker:ga_download_worker
     ''',
 )
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from benchmarks.fake_api import FakeApiServer
+from mara_google_analytics_downloader.async_engine import AsyncClient, run
+from mara_google_analytics_downloader.rate_limiting import RateLimiter, configure_rate_limiter
+from mara_google_analytics_downloader.retry import RetryPolicy
+
+
+class Credentials:
+    """oauth2client credentials with a valid access token"""
+    access_token = 'fake'
+    access_token_expired = False
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limits():
+    configure_rate_limiter()
+
+
+def client(server: FakeApiServer, **kwargs) -> AsyncClient:
+    return AsyncClient(Credentials(), reporting_api_root_url=server.url, analytics_api_root_url=server.url,
+                       retry_policy=RetryPolicy(initial_backoff_seconds=0.01), **kwargs)
+
+
+def test_mcf_pages_in_order_with_bounded_window():
+    async def download(server: FakeApiServer):
+        async with client(server) as async_client:
+            mcf_get, started = async_client.mcf_get, []
+
+            async def counting_mcf_get(query, view_id):
+                started.append(query.get('start-index', 1))
+                return await mcf_get(query, view_id)
+
+            async_client.mcf_get = counting_mcf_get
+            responses = []
+            async for response in async_client.mcf_pages(1, '2020-01-01', '2020-01-31', 'mcf:totalConversions',
+                                                         max_pages_in_flight=2):
+                responses.append(response)
+                # the first page, the pages yielded so far and at most 2 further pages
+                assert len(started) <= len(responses) + 2
+            return responses
+
+    with FakeApiServer(rows=10000, latency=0.01) as server:
+        responses = run(download(server))
+    values = [int(row[0]['primitiveValue']) for response in responses for row in response['rows']]
+    assert values == list(range(10000))
+
+
+def test_report_pages_with_retries():
+    report_requests = [{'viewId': '1', 'dateRanges': [{'startDate': '2020-01-01', 'endDate': '2020-01-31'}],
+                        'metrics': [{'expression': metric}], 'dimensions': [{'name': 'ga:date'}], 'pageSize': 300}
+                       for metric in ['ga:sessions', 'ga:users']]
+
+    async def download(server: FakeApiServer):
+        async with client(server) as async_client:
+            return [item async for item in async_client.report_pages(report_requests)]
+
+    with FakeApiServer(rows=1000, error_rate=0.2, seed=1) as server:
+        pages = run(download(server))
+        assert server.failed_requests > 0
+    for index in range(len(report_requests)):
+        assert sum(len(report['data']['rows']) for page_index, report in pages if page_index == index) == 1000
+
+
+def test_report_pages_with_bounded_queue():
+    report_request = {'viewId': '1', 'dateRanges': [{'startDate': '2020-01-01', 'endDate': '2020-01-31'}],
+                      'metrics': [{'expression': 'ga:sessions'}], 'dimensions': [{'name': 'ga:date'}],
+                      'pageSize': 100}
+
+    async def download(server: FakeApiServer):
+        async with client(server) as async_client:
+            batch_get, started = async_client.batch_get, []
+
+            async def counting_batch_get(body):
+                started.append(1)
+                return await batch_get(body)
+
+            async_client.batch_get = counting_batch_get
+            pages = []
+            async for _, report in async_client.report_pages([report_request], max_pages_in_flight=2):
+                pages.append(report)
+                await asyncio.sleep(0.1)
+                # the pages yielded so far, at most 2 waiting ones and the one being requested
+                assert len(started) <= len(pages) + 3
+            return pages
+
+    with FakeApiServer(rows=1000, latency=0) as server:
+        pages = run(download(server))
+    assert len(pages) == 10
+    assert sum(len(report['data']['rows']) for report in pages) == 1000
+
+
+def test_acquire_async_with_state_file(tmp_path):
+    limiter = RateLimiter(requests_per_second=1000, state_file=str(tmp_path / 'rate_limit.sqlite'))
+
+    async def acquire():
+        await asyncio.gather(*[limiter.acquire_async(1) for _ in range(10)])
+
+    run(acquire())
+    with limiter._store.transaction('view:1') as state:
+        assert state['requests'] == 10
@@ -0,0 +1,50 @@
+import io
+
+from mara_google_analytics_downloader.checkpoint import Checkpoint, query_fingerprint
+
+
+def test_finish_fresh_download(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path), query_fingerprint(view_id=1))
+    assert checkpoint.start() == (None, 0)
+    checkpoint.spool.write('a,b\r\n1,2\r\n')
+    checkpoint.commit(next_page=1001, nrows=1)
+
+    stream = io.StringIO()
+    checkpoint.finish(stream)
+    assert stream.getvalue() == 'a,b\r\n1,2\r\n'
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resume_from_last_commit(tmp_path):
+    fingerprint = query_fingerprint(view_id=1)
+    checkpoint = Checkpoint(str(tmp_path), fingerprint)
+    checkpoint.start()
+    checkpoint.spool.write('a,b\r\n1,2\r\n')
+    checkpoint.commit(next_page=1001, nrows=1)
+    # rows of a page that was not committed before the download failed
+    checkpoint.spool.write('3,4\r\n')
+    checkpoint.spool.close()
+
+    checkpoint = Checkpoint(str(tmp_path), fingerprint)
+    assert checkpoint.start() == (1001, 1)
+    checkpoint.spool.write('5,6\r\n')
+    checkpoint.commit(next_page=None, nrows=2)
+
+    stream = io.StringIO()
+    checkpoint.finish(stream)
+    assert stream.getvalue() == 'a,b\r\n1,2\r\n5,6\r\n'
+
+
+def test_start_without_resume(tmp_path):
+    fingerprint = query_fingerprint(view_id=1)
+    checkpoint = Checkpoint(str(tmp_path), fingerprint)
+    checkpoint.start()
+    checkpoint.spool.write('1,2\r\n')
+    checkpoint.commit(next_page=1001, nrows=1)
+    checkpoint.spool.close()
+
+    checkpoint = Checkpoint(str(tmp_path), fingerprint)
+    assert checkpoint.start(resume=False) == (None, 0)
+    stream = io.StringIO()
+    checkpoint.finish(stream)
+    assert stream.getvalue() == ''
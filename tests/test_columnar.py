@@ -0,0 +1,93 @@
+import pytest
+
+pyarrow = pytest.importorskip('pyarrow')
+
+import pyarrow.ipc
+import pyarrow.parquet
+
+from mara_google_analytics_downloader.columnar import ColumnarWriter, ga_columns, mcf_columns
+
+COLUMN_HEADER = {'dimensions': ['ga:date'],
+                 'metricHeader': {'metricHeaderEntries': [{'name': 'ga:sessions', 'type': 'INTEGER'},
+                                                          {'name': 'ga:avgSessionDuration', 'type': 'TIME'},
+                                                          {'name': 'ga:revenue', 'type': 'CURRENCY'},
+                                                          {'name': 'ga:bounceRate', 'type': 'PERCENT'},
+                                                          {'name': 'ga:pageValue', 'type': 'FLOAT'}]}}
+
+
+def read(path: str, output_format: str) -> 'pyarrow.Table':
+    if output_format == 'parquet':
+        return pyarrow.parquet.read_table(path)
+    return pyarrow.ipc.open_file(path).read_all()
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'arrow-ipc'])
+def test_column_types(tmp_path, output_format):
+    path = str(tmp_path / 'ga')
+    writer = ColumnarWriter(path, output_format)
+    writer.set_columns(ga_columns(COLUMN_HEADER, add_view_id_column=True, date_range_layout='columns'))
+    writer.writerows([['1', '20200101', '10', '12.5', '1.25', '50.0', '0.5', '11', '13.5', '2.5', '40.0', '1.5'],
+                      ['1', '20200102', '', '', '', '', '', '0', '0', '0', '0', '0']])
+    writer.flush()
+    writer.close()
+
+    table = read(path, output_format)
+    assert [(field.name, str(field.type)) for field in table.schema] == [
+        ('vid', 'string'), ('ga:date', 'string'),
+        ('ga:sessions', 'int64'), ('ga:avgSessionDuration', 'double'), ('ga:revenue', 'double'),
+        ('ga:bounceRate', 'double'), ('ga:pageValue', 'double'),
+        ('ga:sessions_compare', 'int64'), ('ga:avgSessionDuration_compare', 'double'),
+        ('ga:revenue_compare', 'double'), ('ga:bounceRate_compare', 'double'), ('ga:pageValue_compare', 'double')]
+    assert table.column('ga:sessions').to_pylist() == [10, None]
+    assert table.column('ga:sessions_compare').to_pylist() == [11, 0]
+    assert table.column('ga:avgSessionDuration').to_pylist() == [12.5, None]
+
+
+def test_mcf_column_types(tmp_path):
+    path = str(tmp_path / 'mcf.parquet')
+    writer = ColumnarWriter(path)
+    writer.set_columns(mcf_columns([{'name': 'mcf:sourcePath', 'dataType': 'MCF_SEQUENCE'},
+                                    {'name': 'mcf:totalConversions', 'dataType': 'INTEGER'},
+                                    {'name': 'mcf:totalConversionValue', 'dataType': 'CURRENCY'}]))
+    writer.writerow(['[{"nodeValue": "google"}]', '3', '9.99'])
+    writer.close()
+
+    assert read(path, 'parquet').to_pylist() == [{'mcf:sourcePath': '[{"nodeValue": "google"}]',
+                                                  'mcf:totalConversions': 3, 'mcf:totalConversionValue': 9.99}]
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'arrow-ipc'])
+def test_empty_result(tmp_path, output_format):
+    path = str(tmp_path / 'ga')
+    writer = ColumnarWriter(path, output_format)
+    writer.flush()
+    writer.close()
+
+    table = read(path, output_format)
+    assert (table.num_columns, table.num_rows) == (0, 0)
+
+
+def test_small_pages_are_combined(tmp_path):
+    path = str(tmp_path / 'ga.parquet')
+    writer = ColumnarWriter(path, min_rows_per_batch=10)
+    writer.set_columns(ga_columns(COLUMN_HEADER))
+    # pages of one row, like with --page-size 1
+    for day in range(1, 26):
+        writer.writerow([f'202001{day:02}', str(day), '1', '1', '1', '1'])
+        writer.flush()
+    writer.close()
+
+    metadata = pyarrow.parquet.ParquetFile(path).metadata
+    assert [metadata.row_group(index).num_rows for index in range(metadata.num_row_groups)] == [10, 10, 5]
+    assert pyarrow.parquet.read_table(path).column('ga:sessions').to_pylist() == list(range(1, 26))
+
+
+def test_abort_removes_the_file(tmp_path):
+    path = tmp_path / 'ga.parquet'
+    writer = ColumnarWriter(str(path), min_rows_per_batch=1)
+    writer.set_columns(ga_columns(COLUMN_HEADER))
+    writer.writerow(['20200101', '1', '1', '1', '1', '1'])
+    writer.flush()
+    writer.abort()
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,98 @@
+import pytest
+
+from mara_google_analytics_downloader.copy_loader import _BinarySink, _CopyFailed, _CsvSink, _ENCODERS, \
+    _encode_date, _encode_numeric
+
+
+def test_encode_numeric():
+    # ndigits, weight, sign, dscale, then the base 10000 digits
+    assert _encode_numeric('123.45') == bytes.fromhex('0002 0000 0000 0002 007b 1194')
+    assert _encode_numeric('-0.001') == bytes.fromhex('0001 ffff 4000 0003 000a')
+    assert _encode_numeric('10000') == bytes.fromhex('0001 0001 0000 0000 0001')
+    assert _encode_numeric('12345678.9') == bytes.fromhex('0003 0001 0000 0001 04d2 162e 2328')
+    assert _encode_numeric('0') == bytes.fromhex('0000 0000 0000 0000')
+    assert _encode_numeric('0.00') == bytes.fromhex('0000 0000 0000 0002')
+    assert _encode_numeric('NaN') == bytes.fromhex('0000 0000 c000 0000')
+    with pytest.raises(ValueError):
+        _encode_numeric('Infinity')
+
+
+def test_encode_numbers_and_dates():
+    assert _ENCODERS['int2']('-2') == bytes.fromhex('fffe')
+    assert _ENCODERS['int4']('42') == bytes.fromhex('0000002a')
+    assert _ENCODERS['int8']('-1') == bytes.fromhex('ffffffffffffffff')
+    assert _ENCODERS['float4']('1.5') == bytes.fromhex('3fc00000')
+    assert _ENCODERS['float8']('1.5') == bytes.fromhex('3ff8000000000000')
+    assert _ENCODERS['bool']('true') == b'\x01'
+    assert _ENCODERS['jsonb']('{}') == b'\x01{}'
+
+    # days since 2000-01-01
+    assert _encode_date('20000102') == bytes.fromhex('00000001')
+    assert _encode_date('1999-12-31') == bytes.fromhex('ffffffff')
+    assert _encode_date('2020-01-01') == (7305).to_bytes(4, 'big')
+
+
+def test_binary_stream():
+    sink = _BinarySink([_ENCODERS['int4'], _ENCODERS['text']])
+    sink.writerows([['1', 'a'], ['', 'b']])
+    sink.close()
+
+    assert sink.reader.read() == (b'PGCOPY\n\xff\r\n\x00' + bytes.fromhex('00000000 00000000')
+                                  + bytes.fromhex('0002 00000004 00000001 00000001') + b'a'
+                                  + bytes.fromhex('0002 ffffffff 00000001') + b'b'
+                                  + bytes.fromhex('ffff'))
+    assert sink.nrows == 2
+
+
+def test_binary_row_with_wrong_number_of_values():
+    sink = _BinarySink([_ENCODERS['int4'], _ENCODERS['text']])
+    with pytest.raises(ValueError):
+        sink.writerow(['1'])
+
+
+def test_csv_stream():
+    progress = []
+    sink = _CsvSink('\t', on_progress=lambda nrows, nbytes: progress.append((nrows, nbytes)))
+    sink.writerows([['1', 'a "b"'], ['', 'c']])
+    sink.flush()
+    sink.close()
+
+    assert sink.reader.read() == b'1\t"a ""b"""\r\n\tc\r\n'
+    assert progress == [(2, 17)]
+
+
+def test_failed_download_fails_the_copy():
+    sink = _CsvSink('\t')
+    sink.writerow(['1', 'a'])
+    sink.flush()
+    sink.abort()
+
+    assert sink.reader.read(4) == b'1\ta\r'
+    with pytest.raises(RuntimeError, match='download failed'):
+        sink.reader.read()
+
+
+def test_failed_copy_stops_the_download():
+    sink = _CsvSink('\t')
+    sink.reader.abort()
+    sink.writerow(['1', 'a'])
+    with pytest.raises(_CopyFailed):
+        sink.flush()
+    # the download then aborts the sink, which must not raise again
+    sink.abort()
+
+
+def test_reads_of_any_size():
+    sink = _CsvSink('\t')
+    sink.writerows([[str(index), 'a' * index] for index in range(100)])
+    sink.flush()
+    sink.close()
+    expected = b''.join(f'{index}\t{"a" * index}\r\n'.encode('utf-8') for index in range(100))
+
+    data = b''
+    for size in [1, 7, 1000, 3]:
+        data += sink.reader.read(size)
+    assert len(data) == 1 + 7 + 1000 + 3
+    data += sink.reader.read()
+    assert data == expected
+    assert sink.reader.read(10) == b''
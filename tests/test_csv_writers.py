@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from mara_google_analytics_downloader.__main__ import write_ga_response_as_csv_to_stream, \
+    write_mcf_response_as_csv_to_stream
+
+
+def ga_response(date_ranges: int = 1) -> dict:
+    return {'reports': [{
+        'columnHeader': {'dimensions': ['ga:date', 'ga:country'],
+                         'metricHeader': {'metricHeaderEntries': [{'name': 'ga:sessions', 'type': 'INTEGER'},
+                                                                  {'name': 'ga:bounceRate', 'type': 'PERCENT'}]}},
+        'data': {'rows': [{'dimensions': ['20200101', 'Germany'],
+                           'metrics': [{'values': [str(10 + index), f'{index}.5']}
+                                       for index in range(date_ranges)]},
+                          {'dimensions': ['20200102', 'United "States"'],
+                           'metrics': [{'values': [str(20 + index), f'{index}.25']}
+                                       for index in range(date_ranges)]}]}}]}
+
+
+def write_ga(response: dict, **kwargs):
+    stream = io.StringIO()
+    nrows = write_ga_response_as_csv_to_stream(response, stream, **kwargs)
+    return nrows, stream.getvalue()
+
+
+def test_ga_date_range_layout_rows():
+    assert write_ga(ga_response(date_ranges=2), view_id='1', date_range_layout='rows') == (4, (
+        'vid\tdate_range\tga:date\tga:country\tga:sessions\tga:bounceRate\r\n'
+        '1\t0\t20200101\tGermany\t10\t0.5\r\n'
+        '1\t1\t20200101\tGermany\t11\t1.5\r\n'
+        '1\t0\t20200102\t"United ""States"""\t20\t0.25\r\n'
+        '1\t1\t20200102\t"United ""States"""\t21\t1.25\r\n'))
+
+
+def test_ga_date_range_layout_rows_with_one_date_range():
+    nrows, csv = write_ga(ga_response(), write_header=False, date_range_layout='rows')
+    assert nrows == 2
+    assert csv == ('0\t20200101\tGermany\t10\t0.5\r\n'
+                   '0\t20200102\t"United ""States"""\t20\t0.25\r\n')
+
+
+def test_ga_date_range_layout_columns():
+    assert write_ga(ga_response(date_ranges=2), date_range_layout='columns') == (2, (
+        'ga:date\tga:country\tga:sessions\tga:bounceRate\tga:sessions_compare\tga:bounceRate_compare\r\n'
+        '20200101\tGermany\t10\t0.5\t11\t1.5\r\n'
+        '20200102\t"United ""States"""\t20\t0.25\t21\t1.25\r\n'))
+
+
+# The expected output of the tests below was written by the CSV writers before they were optimized
+
+GA_RESPONSE = {'reports': [{
+    'columnHeader': {'dimensions': ['ga:date', 'ga:source'],
+                     'metricHeader': {'metricHeaderEntries': [{'name': 'ga:sessions', 'type': 'INTEGER'},
+                                                              {'name': 'ga:revenue', 'type': 'CURRENCY'}]}},
+    'data': {'rows': [{'dimensions': ['20200101', 'google'], 'metrics': [{'values': ['10', '1.5']}]},
+                      {'dimensions': ['20200102', 'a, "b"\tc'], 'metrics': [{'values': ['20', '0']}]},
+                      {'dimensions': ['20200103', ''], 'metrics': [{'values': ['0', '2.25']}]}]}}]}
+
+MCF_RESPONSE = {
+    'columnHeaders': [{'name': 'mcf:sourcePath', 'columnType': 'DIMENSION', 'dataType': 'MCF_SEQUENCE'},
+                      {'name': 'mcf:conversionDate', 'columnType': 'DIMENSION', 'dataType': 'STRING'},
+                      {'name': 'mcf:totalConversions', 'columnType': 'METRIC', 'dataType': 'INTEGER'}],
+    'rows': [[{'conversionPathValue': [{'interactionType': 'CLICK', 'nodeValue': 'google'},
+                                       {'interactionType': 'CLICK', 'nodeValue': '(direct)'}]},
+              {'primitiveValue': '20200101'}, {'primitiveValue': '3'}],
+             [{'conversionPathValue': [{'interactionType': 'IMPRESSION', 'nodeValue': 'a "b"'}]},
+              {'primitiveValue': '20200102'}, {'primitiveValue': '1'}]]}
+
+
+def write_mcf(response: dict, **kwargs):
+    stream = io.StringIO()
+    nrows = write_mcf_response_as_csv_to_stream(response, stream, **kwargs)
+    return nrows, stream.getvalue()
+
+
+def test_ga_writer_output_is_unchanged():
+    assert write_ga(GA_RESPONSE) == (3, (
+        'ga:date\tga:source\tga:sessions\tga:revenue\r\n'
+        '20200101\tgoogle\t10\t1.5\r\n'
+        '20200102\t"a, ""b""\tc"\t20\t0\r\n'
+        '20200103\t\t0\t2.25\r\n'))
+    assert write_ga(GA_RESPONSE, view_id='12', delimiter_char=',') == (3, (
+        'vid,ga:date,ga:source,ga:sessions,ga:revenue\r\n'
+        '12,20200101,google,10,1.5\r\n'
+        '12,20200102,"a, ""b""\tc",20,0\r\n'
+        '12,20200103,,0,2.25\r\n'))
+
+
+def test_mcf_writer_output_is_unchanged():
+    assert write_mcf(MCF_RESPONSE, write_header=False) == (2, (
+        '"[{""interactionType"": ""CLICK"", ""nodeValue"": ""google""}, '
+        '{""interactionType"": ""CLICK"", ""nodeValue"": ""(direct)""}]"\t20200101\t3\r\n'
+        '"[{""interactionType"": ""IMPRESSION"", ""nodeValue"": ""a \\""b\\""""}]"\t20200102\t1\r\n'))
+    assert write_mcf(MCF_RESPONSE, write_header=False, view_id='12', delimiter_char=',') == (2, (
+        '12,"[{""interactionType"": ""CLICK"", ""nodeValue"": ""google""}, '
+        '{""interactionType"": ""CLICK"", ""nodeValue"": ""(direct)""}]",20200101,3\r\n'
+        '12,"[{""interactionType"": ""IMPRESSION"", ""nodeValue"": ""a \\""b\\""""}]",20200102,1\r\n'))
+    # the header failed before
+    assert write_mcf(MCF_RESPONSE, view_id='12')[1].startswith(
+        'vid\tmcf:sourcePath\tmcf:conversionDate\tmcf:totalConversions\r\n12\t')
+
+
+def test_empty_responses():
+    assert write_ga({'reports': [{'columnHeader': GA_RESPONSE['reports'][0]['columnHeader']}]}) \
+           == (0, 'ga:date\tga:source\tga:sessions\tga:revenue\r\n')
+    assert write_ga({}) == (0, '')
+    assert write_mcf({'columnHeaders': MCF_RESPONSE['columnHeaders']}) \
+           == (0, 'mcf:sourcePath\tmcf:conversionDate\tmcf:totalConversions\r\n')
+    assert write_mcf({'columnHeaders': []}, write_header=False) == (0, '')
+
+
+def test_writers_do_not_change_csv_excel():
+    import csv
+
+    write_ga(GA_RESPONSE, delimiter_char=';')
+    write_mcf(MCF_RESPONSE, delimiter_char=';')
+    assert csv.excel.delimiter == ','
@@ -0,0 +1,61 @@
+import datetime
+
+import pytest
+
+from mara_google_analytics_downloader.date_ranges import resolve_date, split_date_range
+
+
+def d(value: str) -> datetime.date:
+    return datetime.date.fromisoformat(value)
+
+
+def shards(start_date: str, end_date: str, shard_by: str) -> list:
+    return [(start.isoformat(), end.isoformat()) for start, end in split_date_range(d(start_date), d(end_date), shard_by)]
+
+
+def test_split_by_day_across_a_year():
+    assert shards('2019-12-30', '2020-01-02', 'day') == [('2019-12-30', '2019-12-30'), ('2019-12-31', '2019-12-31'),
+                                                         ('2020-01-01', '2020-01-01'), ('2020-01-02', '2020-01-02')]
+
+
+def test_split_by_iso_week():
+    # 2020-01-29 is a Wednesday, the ISO weeks start on Mondays
+    assert shards('2020-01-29', '2020-02-12', 'week') == [('2020-01-29', '2020-02-02'), ('2020-02-03', '2020-02-09'),
+                                                          ('2020-02-10', '2020-02-12')]
+    assert shards('2019-12-25', '2020-01-08', 'week') == [('2019-12-25', '2019-12-29'), ('2019-12-30', '2020-01-05'),
+                                                          ('2020-01-06', '2020-01-08')]
+
+
+def test_split_by_month():
+    assert shards('2019-11-15', '2020-03-10', 'month') == [('2019-11-15', '2019-11-30'), ('2019-12-01', '2019-12-31'),
+                                                           ('2020-01-01', '2020-01-31'), ('2020-02-01', '2020-02-29'),
+                                                           ('2020-03-01', '2020-03-10')]
+    assert shards('2021-01-31', '2021-03-01', 'month') == [('2021-01-31', '2021-01-31'), ('2021-02-01', '2021-02-28'),
+                                                           ('2021-03-01', '2021-03-01')]
+
+
+@pytest.mark.parametrize('shard_by', ['day', 'week', 'month'])
+def test_split_single_day(shard_by):
+    assert shards('2020-02-29', '2020-02-29', shard_by) == [('2020-02-29', '2020-02-29')]
+
+
+def test_split_invalid_ranges():
+    with pytest.raises(ValueError):
+        split_date_range(d('2020-01-02'), d('2020-01-01'), 'day')
+    with pytest.raises(ValueError):
+        split_date_range(d('2020-01-01'), d('2020-01-31'), 'year')
+
+
+def test_resolve_date():
+    today = d('2020-03-01')
+    assert resolve_date('today', today) == today
+    assert resolve_date('yesterday', today) == d('2020-02-29')
+    assert resolve_date('0daysAgo', today) == today
+    assert resolve_date('30daysAgo', today) == d('2020-01-31')
+    assert resolve_date('365daysAgo', today) == d('2019-03-02')
+    assert resolve_date('2019-12-31', today) == d('2019-12-31')
+    assert resolve_date('today') == datetime.date.today()
+
+    for value in ['tomorrow', '2020-13-01', '20200101', '-1daysAgo', '']:
+        with pytest.raises(ValueError):
+            resolve_date(value, today)
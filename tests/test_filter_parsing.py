@@ -0,0 +1,47 @@
+import pytest
+
+from mara_google_analytics_downloader.filter_parsing import ga_parse_filter
+
+
+def parse(filters: str) -> dict:
+    report_request = {}
+    ga_parse_filter(report_request, filters)
+    return report_request
+
+
+def test_metric_operators():
+    assert parse('ga:sessions==3')['metricFilterClauses'][0]['filters'][0]['operator'] == 'EQUAL'
+    assert parse('ga:sessions>=3')['metricFilterClauses'] == [
+        {'filters': [{'metricName': 'ga:sessions', 'not': True, 'operator': 'LESS_THAN', 'comparisonValue': '3'}]}]
+    assert parse('ga:sessions<=3')['metricFilterClauses'] == [
+        {'filters': [{'metricName': 'ga:sessions', 'not': True, 'operator': 'GREATER_THAN', 'comparisonValue': '3'}]}]
+
+
+def test_or_binds_tighter_than_and():
+    report_request = parse('ga:country==Germany,ga:country==France;ga:deviceCategory==mobile')
+    assert report_request['dimensionFilterClauses'] == [
+        {'operator': 'OR',
+         'filters': [{'dimensionName': 'ga:country', 'not': False, 'operator': 'EXACT', 'expressions': ['Germany']},
+                     {'dimensionName': 'ga:country', 'not': False, 'operator': 'EXACT', 'expressions': ['France']}]},
+        {'filters': [{'dimensionName': 'ga:deviceCategory', 'not': False, 'operator': 'EXACT',
+                      'expressions': ['mobile']}]}]
+
+
+def test_parentheses():
+    report_request = parse('(ga:country==Germany;ga:city==Berlin),ga:browser==Chrome')
+    assert [[f['expressions'][0] for f in clause['filters']] for clause in report_request['dimensionFilterClauses']] \
+           == [['Germany', 'Chrome'], ['Berlin', 'Chrome']]
+
+
+def test_expressions():
+    report_request = parse('ga:pagePath=~^/(de|en)/;ga:dimension3!@a\\,b;ga:goal2Completions>0')
+    assert [clause['filters'][0]['expressions'][0] for clause in report_request['dimensionFilterClauses']] \
+           == ['^/(de|en)/', 'a,b']
+    assert report_request['metricFilterClauses'][0]['filters'][0]['metricName'] == 'ga:goal2Completions'
+
+
+@pytest.mark.parametrize('filters', ['ga:unknownMetric==1', 'ga:sessions=@1', 'ga:sessions>1,ga:country==DE',
+                                     '(ga:country==DE', 'ga:country'])
+def test_invalid_filters(filters):
+    with pytest.raises(ValueError):
+        parse(filters)
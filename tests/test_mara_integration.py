@@ -0,0 +1,117 @@
+import contextlib
+import datetime
+
+import pytest
+
+pytest.importorskip('mara_pipelines')
+
+import mara_db.postgresql
+
+from mara_google_analytics_downloader.date_ranges import incremental_date_range
+from mara_google_analytics_downloader.mara_integration import DownloadGoogleAnalyticsFlatTable, \
+    DownloadGoogleAnalyticsMultiViewFlatTable
+
+
+class Cursor:
+    """A cursor which returns the given results for the statements starting with their keys"""
+
+    def __init__(self, results: dict):
+        self.results = results
+        self.statements = []
+        self._rows = []
+
+    def execute(self, statement: str, parameters: tuple = None):
+        self.statements.append((statement, parameters))
+        self._rows = next(rows for prefix, rows in self.results.items() if statement.startswith(prefix))
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+
+@pytest.fixture
+def cursor(monkeypatch):
+    cursor = Cursor({})
+
+    @contextlib.contextmanager
+    def postgres_cursor_context(db_alias: str):
+        yield cursor
+
+    monkeypatch.setattr(mara_db.postgresql, 'postgres_cursor_context', postgres_cursor_context)
+    return cursor
+
+
+def test_incremental_date_range():
+    january_1, january_31 = datetime.date(2020, 1, 1), datetime.date(2020, 1, 31)
+    assert incremental_date_range(january_1, january_31, None, 3) == (january_1, january_31)
+    assert incremental_date_range(january_1, january_31, datetime.date(2020, 1, 20), 3) \
+           == (datetime.date(2020, 1, 17), january_31)
+    assert incremental_date_range(january_1, january_31, datetime.date(2020, 1, 20), 0) \
+           == (datetime.date(2020, 1, 20), january_31)
+    # not before the start date
+    assert incremental_date_range(january_1, january_31, datetime.date(2020, 1, 2), 3) == (january_1, january_31)
+    # all loaded
+    assert incremental_date_range(january_1, january_31, datetime.date(2020, 3, 1), 3) is None
+
+
+def test_incremental_load_from_max_date(cursor):
+    cursor.results = {'SELECT date::TEXT': [('20200110',)], 'SELECT max(date)': [('20200120',)]}
+    command = DownloadGoogleAnalyticsFlatTable(1, '2020-01-01', ['ga:sessions'], "ga.o'sessions",
+                                               end_date='2020-01-31', dimensions=['ga:date'], incremental=True,
+                                               date_column='date', late_data_days=5)
+
+    assert command._incremental_load() == (
+        '2020-01-15',
+        ["DELETE FROM ga.o'sessions WHERE date >= '20200115' AND date <= '20200131'"],
+        [])
+
+
+def test_incremental_load_of_shared_table(cursor):
+    cursor.results = {'SELECT date::TEXT': [('2020-01-10',)],
+                      'SELECT view_id, max_date': [('1', datetime.date(2020, 1, 20)),
+                                                   ('2', datetime.date(2020, 1, 25))]}
+    command = DownloadGoogleAnalyticsMultiViewFlatTable([1, 2], '2020-01-01', ['ga:sessions'], 'ga.sessions',
+                                                        end_date='2020-01-31', dimensions=['ga:date'],
+                                                        incremental=True, date_column='date', late_data_days=3,
+                                                        view_id_column='view_id', watermark_table_name='ga.watermark')
+
+    start_date, sql_before, sql_after = command._incremental_load()
+    # the earliest last loaded date of the views
+    assert start_date == '2020-01-17'
+    assert cursor.statements[1] == ('SELECT view_id, max_date FROM ga.watermark WHERE table_name = %s '
+                                    'AND view_id IN %s', ('ga.sessions', ('1', '2')))
+    assert sql_before == ["DELETE FROM ga.sessions WHERE date >= '2020-01-17' AND date <= '2020-01-31' "
+                          "AND view_id::TEXT IN ('1', '2')"]
+    assert sql_after == ["INSERT INTO ga.watermark (table_name, view_id, max_date) "
+                         "VALUES ('ga.sessions', '1', '2020-01-31'), ('ga.sessions', '2', '2020-01-31') "
+                         "ON CONFLICT (table_name, view_id) DO UPDATE SET max_date = EXCLUDED.max_date"]
+
+
+def test_incremental_load_with_view_without_data(cursor):
+    cursor.results = {'SELECT date::TEXT': [('2020-01-10',)], 'SELECT view_id::TEXT, max': [('1', '2020-01-20')]}
+    command = DownloadGoogleAnalyticsMultiViewFlatTable([1, 2], '2020-01-01', ['ga:sessions'], 'ga.sessions',
+                                                        end_date='2020-01-31', incremental=True, date_column='date',
+                                                        view_id_column='view_id')
+
+    start_date, _, _ = command._incremental_load()
+    assert start_date == '2020-01-01'
+    assert cursor.statements[1][0] == ("SELECT view_id::TEXT, max(date)::TEXT FROM ga.sessions "
+                                       "WHERE TRUE AND view_id::TEXT IN ('1', '2') GROUP BY 1")
+
+
+def test_all_dates_loaded(cursor, monkeypatch):
+    cursor.results = {'SELECT date::TEXT': [], 'SELECT max(date)': [('2020-02-10',)]}
+    command = DownloadGoogleAnalyticsFlatTable(1, '2020-01-01', ['ga:sessions'], 'ga.sessions',
+                                               end_date='2020-01-31', incremental=True, date_column='date')
+    assert command._incremental_load() == (None, [], [])
+
+    monkeypatch.setattr(command, 'shell_command', lambda *args, **kwargs: pytest.fail('nothing to download'))
+    assert command.run()
+
+
+def test_shared_table_needs_view_id_column():
+    with pytest.raises(ValueError):
+        DownloadGoogleAnalyticsMultiViewFlatTable([1, 2], '2020-01-01', ['ga:sessions'], 'ga.sessions',
+                                                  incremental=True, date_column='date')
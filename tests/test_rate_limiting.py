@@ -0,0 +1,130 @@
+import multiprocessing
+
+import pytest
+
+from mara_google_analytics_downloader import rate_limiting
+from mara_google_analytics_downloader.rate_limiting import RateLimiter
+
+
+class Clock:
+    """A clock which only advances when sleeping"""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(rate_limiting.time, 'time', clock.time)
+    monkeypatch.setattr(rate_limiting.time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def state_file(request, tmp_path):
+    return str(tmp_path / 'rate_limit.sqlite') if request.param == 'sqlite' else None
+
+
+def test_token_bucket_refill(clock, state_file):
+    limiter = RateLimiter(requests_per_second=2, state_file=state_file)
+    # a burst of one second
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [0.5]
+
+    clock.now += 1
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == [0.5]
+
+
+def test_bucket_per_view(clock, state_file):
+    limiter = RateLimiter(requests_per_second_per_view=1, state_file=state_file)
+    limiter.acquire(1)
+    limiter.acquire(2)
+    limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire(1)
+    assert clock.sleeps == [1]
+
+
+def test_back_off_and_recovery(clock, state_file):
+    limiter = RateLimiter(requests_per_second=10, state_file=state_file)
+
+    def rate() -> float:
+        with limiter._store.transaction('project') as state:
+            return round(state['rate'], 6)
+
+    limiter.report_rate_limited()
+    assert rate() == 5
+    # the bucket is emptied
+    limiter.acquire()
+    assert clock.sleeps == [0.2]
+
+    limiter.report_success()
+    assert rate() == 5.5
+    for _ in range(20):
+        limiter.report_success()
+    assert rate() == 10
+
+    for _ in range(20):
+        limiter.report_rate_limited()
+    assert rate() == 0.1
+
+
+def test_daily_limit(clock, state_file):
+    limiter = RateLimiter(requests_per_day=3, requests_per_day_per_view=1, state_file=state_file)
+    limiter.acquire(1)
+    with pytest.raises(RuntimeError, match='view:1'):
+        limiter.acquire(1)
+    limiter.acquire(2)
+    with pytest.raises(RuntimeError, match='project'):
+        limiter.acquire(3)
+
+    # the next day
+    for key in ['project', 'view:1']:
+        with limiter._store.transaction(key) as state:
+            state['day'] = '2020-01-01'
+    limiter.acquire(1)
+
+
+def acquire(state_file: str, n: int):
+    limiter = RateLimiter(state_file=state_file)
+    for _ in range(n):
+        limiter.acquire(1)
+
+
+def test_state_file_is_shared_between_processes(tmp_path):
+    state_file = str(tmp_path / 'rate_limit.sqlite')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=acquire, args=(state_file, 50)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0, 0, 0]
+
+    # no request got lost between concurrent transactions
+    limiter = RateLimiter(state_file=state_file)
+    for key in ['project', 'view:1']:
+        with limiter._store.transaction(key) as state:
+            assert state['requests'] == 200
+
+
+def test_state_file_shares_the_back_off(clock, tmp_path):
+    state_file = str(tmp_path / 'rate_limit.sqlite')
+    RateLimiter(requests_per_second=10, state_file=state_file).report_rate_limited()
+
+    RateLimiter(requests_per_second=10, state_file=state_file).acquire()
+    assert clock.sleeps == [0.2]
@@ -0,0 +1,85 @@
+from mara_google_analytics_downloader.reporting import batch_report_requests, iter_report_pages, join_reports, \
+    metric_groups
+
+
+def report(metrics: list, rows: list) -> dict:
+    return {'columnHeader': {'dimensions': ['ga:country'],
+                             'metricHeader': {'metricHeaderEntries': [{'name': metric, 'type': 'INTEGER'}
+                                                                      for metric in metrics]}},
+            'data': {'rows': [{'dimensions': [country], 'metrics': [{'values': values}]}
+                              for country, values in rows]}}
+
+
+def test_metric_groups():
+    metrics = [f'ga:goal{i}Completions' for i in range(1, 24)]
+    assert [len(group) for group in metric_groups(metrics)] == [10, 10, 3]
+    assert sum(metric_groups(metrics), []) == metrics
+
+
+def test_join_reports_fills_missing_rows():
+    joined = join_reports([report(['ga:sessions', 'ga:users'], [('DE', ['3', '2']), ('FR', ['1', '1'])]),
+                           report(['ga:transactions'], [('FR', ['5']), ('IT', ['7'])])])
+    assert [entry['name'] for entry in joined['columnHeader']['metricHeader']['metricHeaderEntries']] \
+           == ['ga:sessions', 'ga:users', 'ga:transactions']
+    assert [(row['dimensions'], row['metrics'][0]['values']) for row in joined['data']['rows']] \
+           == [(['DE'], ['3', '2', '0']), (['FR'], ['1', '1', '5']), (['IT'], ['0', '0', '7'])]
+
+
+def report_request(metric: str, view_id: str = '1', start_date: str = '2020-01-01', **kwargs) -> dict:
+    return {'viewId': view_id, 'dateRanges': [{'startDate': start_date, 'endDate': '2020-01-31'}],
+            'metrics': [{'expression': metric}], **kwargs}
+
+
+def test_at_most_five_report_requests_per_batch():
+    report_requests = [report_request(f'ga:goal{i}Completions') for i in range(1, 13)]
+    assert batch_report_requests(report_requests) == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9], [10, 11]]
+
+
+def test_batches_only_compatible_report_requests():
+    report_requests = [report_request('ga:sessions'),
+                       report_request('ga:sessions', view_id='2'),
+                       report_request('ga:users'),
+                       report_request('ga:sessions', start_date='2020-01-02'),
+                       report_request('ga:sessions', segments=[{'segmentId': 'gaid::-1'}]),
+                       report_request('ga:sessions', samplingLevel='LARGE'),
+                       report_request('ga:pageviews', view_id='2'),
+                       report_request('ga:sessions', samplingLevel='LARGE')]
+    assert batch_report_requests(report_requests) == [[0, 2], [1, 6], [3], [4], [5, 7]]
+
+
+class Analytics:
+    """A Reporting API V4 service object which returns the batchGet body as request"""
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body: dict) -> dict:
+        return body
+
+
+def test_iter_report_pages_follows_page_tokens():
+    # the number of pages of each report request
+    pages = {'ga:sessions': 3, 'ga:users': 1, 'ga:pageviews': 2}
+    report_requests = [report_request(metric) for metric in pages]
+    calls = []
+
+    def execute(body: dict, view_id: str) -> dict:
+        calls.append([(request['metrics'][0]['expression'], request.get('pageToken'))
+                      for request in body['reportRequests']])
+        reports = []
+        for request in body['reportRequests']:
+            metric, page = request['metrics'][0]['expression'], int(request.get('pageToken', 0))
+            reports.append({'data': {'rows': [{'dimensions': [str(page)]}]},
+                            **({'nextPageToken': str(page + 1)} if page + 1 < pages[metric] else {})})
+        return {'reports': reports}
+
+    received = [(index, report['data']['rows'][0]['dimensions'][0])
+                for index, report in iter_report_pages(Analytics(), report_requests, execute=execute)]
+
+    # complete reports are not requested again
+    assert calls == [[('ga:sessions', None), ('ga:users', None), ('ga:pageviews', None)],
+                     [('ga:sessions', '1'), ('ga:pageviews', '1')],
+                     [('ga:sessions', '2')]]
+    assert received == [(0, '0'), (1, '0'), (2, '0'), (0, '1'), (2, '1'), (0, '2')]
+    # the report requests are not modified
+    assert all('pageToken' not in request for request in report_requests)
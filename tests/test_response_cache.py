@@ -0,0 +1,69 @@
+import datetime
+import time
+
+from mara_google_analytics_downloader import response_cache as response_cache_module
+from mara_google_analytics_downloader.response_cache import ResponseCache, cache_key, ga_cache_key
+
+HISTORICAL = datetime.date(2020, 1, 31)
+
+
+def body(start_date: str, end_date: str, metric: str = 'ga:sessions') -> dict:
+    return {'reportRequests': [{'viewId': '1', 'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
+                                'metrics': [{'expression': metric}]}]}
+
+
+def test_ga_cache_key():
+    key, end_date = ga_cache_key(body('2020-01-01', '2020-01-31'))
+    assert end_date == HISTORICAL
+    assert key == ga_cache_key(body('2020-01-01', '2020-01-31'))[0]
+    assert key != ga_cache_key(body('2020-01-01', '2020-01-30'))[0]
+    assert key != ga_cache_key(body('2020-01-01', '2020-01-31', metric='ga:users'))[0]
+
+    # relative dates are resolved, so that a key is valid only for one day
+    today = datetime.date.today()
+    assert ga_cache_key(body('7daysAgo', 'today')) \
+           == ga_cache_key(body((today - datetime.timedelta(days=7)).isoformat(), today.isoformat()))
+    # the body is not changed
+    relative_body = body('7daysAgo', 'today')
+    ga_cache_key(relative_body)
+    assert relative_body == body('7daysAgo', 'today')
+
+    assert cache_key(api='mcf', view_id='1', start_index=1) == cache_key(start_index=1, view_id='1', api='mcf')
+
+
+def test_historical_pages_do_not_expire(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl_seconds=60)
+    cache.put('old', {'rows': [1]}, HISTORICAL)
+    cache.put('recent', {'rows': [2]}, datetime.date.today())
+    cache.put('not golden', {'rows': [3]}, HISTORICAL, final=False)
+    assert cache.get('old') == {'rows': [1]}
+    assert cache.get('recent') == {'rows': [2]}
+
+    now = time.time()
+    monkeypatch.setattr(response_cache_module.time, 'time', lambda: now + 61)
+    assert cache.get('old') == {'rows': [1]}
+    assert cache.get('recent') is None
+    assert cache.get('not golden') is None
+    assert cache.get('missing') is None
+
+
+def test_least_recently_used_pages_are_evicted(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(response_cache_module.time, 'time', lambda: clock[0])
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    page = {'rows': [list(range(100))]}
+
+    def put(key: str):
+        clock[0] += 1
+        cache.put(key, page, HISTORICAL)
+
+    put('a')
+    put('b')
+    # all three pages fit
+    cache.max_size = 3 * cache._connection().execute('SELECT size FROM response_cache').fetchone()[0]
+    put('c')
+    clock[0] += 1
+    assert cache.get('a') == page
+    put('d')
+    # 'b' is the least recently used page
+    assert [cache.get(key) is not None for key in 'abcd'] == [True, False, True, True]
@@ -0,0 +1,109 @@
+import email.utils
+import time
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from mara_google_analytics_downloader import retry
+from mara_google_analytics_downloader.__main__ import _execute_with_retries
+from mara_google_analytics_downloader.rate_limiting import configure_rate_limiter
+from mara_google_analytics_downloader.retry import RetryPolicy, is_rate_limit_error
+
+
+def http_error(status: int, reason: str = None, **headers) -> HttpError:
+    content = f'{{"error": {{"code": {status}, "errors": [{{"reason": "{reason}"}}]}}}}' if reason else '{}'
+    return HttpError(httplib2.Response({'status': status, **headers}), content.encode('utf-8'), uri='')
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list:
+    configure_rate_limiter()
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def failing_execute(*errors: Exception, response: dict = None):
+    """An `execute` which raises the errors in turn, then returns the response"""
+    errors = list(errors)
+    calls = []
+
+    def execute():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return response
+
+    execute.calls = calls
+    return execute
+
+
+def test_retryable_errors():
+    policy = RetryPolicy()
+    assert policy.is_retryable(http_error(429))
+    assert policy.is_retryable(http_error(500))
+    assert policy.is_retryable(http_error(503, 'backendError'))
+    assert policy.is_retryable(http_error(403, 'rateLimitExceeded'))
+    assert policy.is_retryable(http_error(403, 'userRateLimitExceeded'))
+    assert policy.is_retryable(http_error(403, 'quotaExceeded'))
+    assert policy.is_retryable(ConnectionResetError())
+
+    assert not policy.is_retryable(http_error(400, 'badRequest'))
+    assert not policy.is_retryable(http_error(401, 'authError'))
+    assert not policy.is_retryable(http_error(403, 'insufficientPermissions'))
+    assert not policy.is_retryable(ValueError())
+
+
+def test_rate_limit_errors():
+    assert is_rate_limit_error(http_error(429))
+    assert is_rate_limit_error(http_error(403, 'userRateLimitExceeded'))
+    assert not is_rate_limit_error(http_error(403, 'quotaExceeded'))
+    assert not is_rate_limit_error(http_error(503, 'backendError'))
+
+
+def test_backoff_is_bounded_with_jitter(monkeypatch):
+    policy = RetryPolicy(initial_backoff_seconds=1, max_backoff_seconds=8)
+    monkeypatch.setattr(retry.random, 'uniform', lambda low, high: high)
+    assert [policy.backoff_seconds(n) for n in range(6)] == [1, 2, 4, 8, 8, 8]
+    monkeypatch.setattr(retry.random, 'uniform', lambda low, high: low)
+    assert [policy.backoff_seconds(n) for n in range(6)] == [0.5, 1, 2, 4, 4, 4]
+
+
+def test_retry_after():
+    policy = RetryPolicy(initial_backoff_seconds=1, max_backoff_seconds=8)
+    assert policy.backoff_seconds(0, http_error(429, **{'retry-after': '30'})) == 30
+    assert policy.backoff_seconds(3, http_error(429, **{'retry-after': '0'})) >= 4
+
+    retry_after = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < policy.backoff_seconds(0, http_error(503, **{'retry-after': retry_after})) <= 60
+    assert policy.backoff_seconds(0, http_error(503, **{'retry-after': 'invalid'})) <= 1
+
+
+def test_retries_transient_errors(sleeps):
+    execute = failing_execute(http_error(503, 'backendError'), http_error(429, 'rateLimitExceeded'),
+                              response={'rows': []})
+    policy = RetryPolicy(initial_backoff_seconds=1, max_backoff_seconds=64)
+    assert _execute_with_retries(None, 1, retry_policy=policy, execute=execute) == {'rows': []}
+    assert len(execute.calls) == 3
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] <= 1 and 1 <= sleeps[1] <= 2
+
+
+def test_fails_immediately_on_other_errors(sleeps):
+    execute = failing_execute(http_error(400, 'badRequest'), response={})
+    with pytest.raises(HttpError):
+        _execute_with_retries(None, 1, execute=execute)
+    assert len(execute.calls) == 1
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries(sleeps):
+    execute = failing_execute(*[http_error(503, 'backendError') for _ in range(5)], response={})
+    with pytest.raises(HttpError):
+        _execute_with_retries(None, 1, retry_policy=RetryPolicy(max_retries=2), execute=execute)
+    assert len(execute.calls) == 3
+    assert len(sleeps) == 2
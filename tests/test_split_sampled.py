@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from benchmarks.fake_api import FakeApiServer
+from mara_google_analytics_downloader.__main__ import _google_analytics_credentials_from_user_credentials, \
+    download_unsampled_to_stream
+from mara_google_analytics_downloader.rate_limiting import configure_rate_limiter
+from mara_google_analytics_downloader.response_cache import configure_response_cache
+from mara_google_analytics_downloader.services import configure_api_root_url
+
+
+@pytest.fixture
+def fake_api(request):
+    with FakeApiServer(rows=50, latency=0.01, sampled=True, **getattr(request, 'param', {})) as server:
+        configure_api_root_url(server.url)
+        configure_rate_limiter()
+        configure_response_cache(None)
+        try:
+            yield server
+        finally:
+            configure_api_root_url(None)
+
+
+def download(server: FakeApiServer, max_workers: int):
+    credentials = _google_analytics_credentials_from_user_credentials(
+        client_id='test', client_secret='test', refresh_token='test', token_uri=server.token_uri)
+    stream = io.StringIO()
+    totals = download_unsampled_to_stream(credentials, 1, '2020-01-01', '2020-01-31', metrics='ga:sessions',
+                                          dimensions='ga:date', stream=stream, page_size=20,
+                                          max_workers=max_workers)
+    return totals, [line.split('\t') for line in stream.getvalue().splitlines()]
+
+
+def date_range_blocks(rows: list, rows_per_date_range: int) -> list:
+    """The first and last date of each block of rows of one date range, in the order of the output"""
+    blocks = [rows[i:i + rows_per_date_range] for i in range(0, len(rows), rows_per_date_range)]
+    return [(min(row[0] for row in block), max(row[0] for row in block)) for block in blocks]
+
+
+def test_split_until_single_days(fake_api):
+    (nrows, date_ranges, _, _), rows = download(fake_api, max_workers=3)
+
+    assert (nrows, date_ranges) == (31 * 50, 31)
+    assert len(rows) == nrows
+    assert [row[0] for row in rows] == [f'202001{day:02}' for day in range(1, 32) for _ in range(50)]
+    assert 1 < fake_api.max_requests_in_flight <= 3
+
+
+@pytest.mark.parametrize('fake_api', [{'unsampled_days': 7}], indirect=True)
+def test_split_until_unsampled(fake_api):
+    (nrows, date_ranges, samples_read, _), rows = download(fake_api, max_workers=2)
+
+    # 31 days -> 16 + 15 -> 8 + 8 + 8 + 7 -> 4 + 4 + 4 + 4 + 4 + 4 + 7
+    assert (nrows, date_ranges, samples_read) == (7 * 50, 7, 0)
+    assert date_range_blocks(rows, 50) == [('20200101', '20200104'), ('20200105', '20200108'),
+                                           ('20200109', '20200112'), ('20200113', '20200116'),
+                                           ('20200117', '20200120'), ('20200121', '20200124'),
+                                           ('20200125', '20200131')]
+    assert fake_api.max_requests_in_flight <= 2
+
+
+@pytest.mark.parametrize('fake_api', [{'unsampled_days': 31}], indirect=True)
+def test_unsampled_date_range(fake_api):
+    (nrows, date_ranges, _, _), rows = download(fake_api, max_workers=4)
+
+    assert (nrows, date_ranges) == (50, 1)
+    # the first page and the two following ones
+    assert fake_api.requests == 3
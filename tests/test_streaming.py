@@ -0,0 +1,87 @@
+import gzip
+import io
+import json
+import time
+
+import pytest
+
+pytest.importorskip('ijson')
+pytest.importorskip('googleapiclient')
+
+from mara_google_analytics_downloader.__main__ import _StreamedRowWriter, _execute_with_retries
+from mara_google_analytics_downloader.rate_limiting import configure_rate_limiter
+from mara_google_analytics_downloader.retry import RetryPolicy
+from mara_google_analytics_downloader.streaming import GA_ROWS_PREFIX, MCF_ROWS_PREFIX, _parse
+
+
+def ga_rows(report_index: int, n: int) -> list:
+    return [{'dimensions': [f'2020010{report_index}', str(index)], 'metrics': [{'values': [str(index * 1.5)]}]}
+            for index in range(n)]
+
+
+GA_RESPONSE = {'reports': [{'columnHeader': {'dimensions': ['ga:date', 'ga:hour']},
+                            'data': {'rows': ga_rows(index, n), 'rowCount': n},
+                            'nextPageToken': str(n)}
+                           for index, n in enumerate([7, 0, 5])]}
+
+
+def parse(fileobj, rows_prefix: str, batch_size: int):
+    batches = []
+    document = _parse(fileobj, rows_prefix, lambda report_index, rows, partial: batches.append((report_index, rows)),
+                      batch_size)
+    return batches, document
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_parse_ga_response_in_batches(compress):
+    body = json.dumps(GA_RESPONSE).encode('utf-8')
+    # like `_open`, which decompresses gzipped responses while reading them
+    fileobj = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(body)), mode='rb') if compress else io.BytesIO(body)
+    batches, document = parse(fileobj, GA_ROWS_PREFIX, batch_size=3)
+
+    assert [(report_index, len(rows)) for report_index, rows in batches] == [(0, 3), (0, 3), (0, 1), (2, 3), (2, 2)]
+    assert [row for report_index, rows in batches if report_index == 0 for row in rows] == ga_rows(0, 7)
+    assert [row for report_index, rows in batches if report_index == 2 for row in rows] == ga_rows(2, 5)
+    # the response without the rows
+    assert [report['nextPageToken'] for report in document['reports']] == ['7', '0', '5']
+    assert document['reports'][2]['data'] == {'rows': [], 'rowCount': 5}
+
+
+def test_parse_mcf_response():
+    rows = [[{'primitiveValue': str(index)}, {'conversionPathValue': [{'nodeValue': 'google'}]}]
+            for index in range(5)]
+    body = json.dumps({'columnHeaders': [{'name': 'mcf:a'}], 'rows': rows, 'totalResults': 5}).encode('utf-8')
+    batches, document = parse(io.BytesIO(body), MCF_ROWS_PREFIX, batch_size=2)
+
+    assert [report_index for report_index, _ in batches] == [0, 0, 0]
+    assert [row for _, batch in batches for row in batch] == rows
+    assert document == {'columnHeaders': [{'name': 'mcf:a'}], 'rows': [], 'totalResults': 5}
+
+
+def test_retry_partway_through_a_page(monkeypatch):
+    configure_rate_limiter()
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    body = json.dumps(GA_RESPONSE).encode('utf-8')
+    written = []
+    row_writer = _StreamedRowWriter(lambda report_index, rows, partial: written.extend(
+        (report_index, row) for row in rows))
+    tries = []
+
+    def execute_try() -> dict:
+        tries.append(1)
+        if len(tries) == 1:
+            # the connection breaks off after 8 rows
+            def on_rows(report_index, rows, partial):
+                row_writer(report_index, rows, partial)
+                if row_writer.received_rows() >= 8:
+                    raise ConnectionResetError()
+
+            return _parse(io.BytesIO(body), GA_ROWS_PREFIX, on_rows, 4)
+        return _parse(io.BytesIO(body), GA_ROWS_PREFIX, row_writer, 3)
+
+    _execute_with_retries(None, 1, retry_policy=RetryPolicy(initial_backoff_seconds=0),
+                          execute=lambda: row_writer.execute(execute_try), streamed_rows=row_writer.received_rows)
+
+    assert len(tries) == 2
+    assert written == [(0, row) for row in ga_rows(0, 7)] + [(2, row) for row in ga_rows(2, 5)]
+    assert row_writer.nrows == 12
@@ -0,0 +1,64 @@
+import pytest
+
+from mara_google_analytics_downloader import config as c
+from mara_google_analytics_downloader.telemetry import Telemetry, read_prometheus_textfile
+
+
+def test_download_totals(tmp_path):
+    textfile = tmp_path / 'ga.prom'
+    telemetry = Telemetry(prometheus_textfile=str(textfile))
+    telemetry.start_download()
+    telemetry.record_request('ga', 1, 0.5, {'reports': [{'data': {'rows': [{}, {}], 'samplesReadCounts': ['10']}}]},
+                             bytes_received=100, retries=2, backoff_seconds=3.0, rate_limited_errors=1)
+    telemetry.record_request('mcf', 1, 0.25, {'rows': [[], [], []]}, bytes_received=50)
+    summary = telemetry.finish_download('ga', 1, nrows=5)
+
+    assert {key: summary[key] for key in ['requests', 'retries', 'backoff_seconds', 'rate_limited_errors',
+                                          'request_seconds', 'bytes_received', 'rows_received',
+                                          'sampled_responses']} \
+           == {'requests': 2, 'retries': 2, 'backoff_seconds': 3.0, 'rate_limited_errors': 1,
+               'request_seconds': 0.75, 'bytes_received': 150, 'rows_received': 5, 'sampled_responses': 1}
+    assert 'ga_downloader_last_download_rows{api="ga",view_id="1"} 5\n' in textfile.read_text()
+
+
+def test_read_prometheus_textfile(tmp_path):
+    textfile = tmp_path / 'ga.prom'
+    telemetry = Telemetry(prometheus_textfile=str(textfile))
+    telemetry.start_download()
+    telemetry.record_request('ga', 1, 0.5, {'reports': [{'data': {'rows': [{}, {}]}}]}, bytes_received=100,
+                             retries=1, backoff_seconds=1.5)
+    summary = telemetry.finish_download('ga', 1, nrows=2)
+
+    totals = read_prometheus_textfile(str(textfile))
+    assert {key: totals[key] for key in ['requests', 'retries', 'backoff_seconds', 'request_seconds',
+                                         'bytes_received', 'rows', 'success']} \
+           == {'requests': 1, 'retries': 1, 'backoff_seconds': 1.5, 'request_seconds': 0.5,
+               'bytes_received': 100, 'rows': 2, 'success': 1}
+    assert totals['seconds'] == summary['seconds']
+
+
+def test_command_uses_telemetry_config(tmp_path, monkeypatch):
+    pytest.importorskip('googleapiclient')
+    import mara_google_analytics_downloader.__main__ as main
+
+    configured = []
+    monkeypatch.setattr(main, 'configure_telemetry', lambda **kwargs: configured.append(kwargs))
+    monkeypatch.setattr(main, '_google_analytics_credentials', lambda **kwargs: None)
+    monkeypatch.setattr(main, 'download', lambda *args, **kwargs: None)
+
+    def download_command(**kwargs):
+        main.ga_download_to_csv.callback(**{**dict(view_id='1,2', start_date='2020-01-01', end_date='2020-01-31',
+                                                   metrics='ga:sessions'), **kwargs})
+
+    download_command()
+    assert configured == []
+
+    monkeypatch.setattr(c, 'ga_telemetry_json_lines', lambda: True)
+    monkeypatch.setattr(c, 'ga_telemetry_prometheus_dir', lambda: str(tmp_path))
+    download_command()
+    assert configured[-1] == {'json_lines': True,
+                              'prometheus_textfile': str(tmp_path / 'ga_downloader_1_2.prom')}
+
+    # the parameters override the config
+    download_command(prometheus_textfile=str(tmp_path / 'ga.prom'))
+    assert configured[-1] == {'json_lines': True, 'prometheus_textfile': str(tmp_path / 'ga.prom')}
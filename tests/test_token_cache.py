@@ -0,0 +1,53 @@
+import datetime
+
+from mara_google_analytics_downloader.token_cache import cache_credentials
+
+
+class Credentials:
+    """The attributes of oauth2client credentials used by the token cache"""
+
+    def __init__(self, client_id: str, refresh_token: str = None, service_account_email: str = None,
+                 private_key_id: str = None) -> None:
+        self.client_id = client_id
+        self.refresh_token = refresh_token
+        self._service_account_email = service_account_email
+        self._private_key_id = private_key_id
+        self.scopes = {'https://www.googleapis.com/auth/analytics.readonly'}
+        self.access_token = None
+        self.token_expiry = None
+        self.invalid = False
+        self.store = None
+
+    def set_store(self, store):
+        self.store = store
+
+
+def put_token(credentials, access_token: str):
+    credentials.access_token = access_token
+    credentials.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    credentials.store.locked_put(credentials)
+
+
+def test_user_accounts_sharing_a_client_id(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    first = cache_credentials(Credentials('client', refresh_token='refresh-1'), path)
+    second = cache_credentials(Credentials('client', refresh_token='refresh-2'), path)
+    assert first.store.key != second.store.key
+
+    put_token(first, 'token-1')
+    assert second.store.locked_get() is None
+    assert first.store.locked_get().access_token == 'token-1'
+    assert cache_credentials(Credentials('client', refresh_token='refresh-1'), path) \
+               .store.locked_get().access_token == 'token-1'
+
+
+def test_service_accounts_sharing_a_client_id(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    first = cache_credentials(Credentials('client', service_account_email='a@example.com', private_key_id='1'), path)
+    second = cache_credentials(Credentials('client', service_account_email='b@example.com', private_key_id='1'), path)
+    rotated = cache_credentials(Credentials('client', service_account_email='a@example.com', private_key_id='2'), path)
+
+    put_token(first, 'token-1')
+    assert second.store.locked_get() is None
+    assert rotated.store.locked_get() is None
+    assert first.store.locked_get().access_token == 'token-1'
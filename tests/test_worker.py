@@ -0,0 +1,74 @@
+import io
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+from mara_google_analytics_downloader.worker import _WorkerServer, submit
+
+
+def test_socket_is_only_accessible_by_the_user(tmp_path):
+    socket_path = str(tmp_path / 'worker.sock')
+    umask = os.umask(0o022)
+    try:
+        server = _WorkerServer(socket_path, max_jobs=1)
+        try:
+            assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+            assert os.umask(0o022) == 0o022
+        finally:
+            server.server_close()
+    finally:
+        os.umask(umask)
+    assert not os.path.exists(socket_path)
+
+
+def test_socket_of_running_worker_is_not_replaced(tmp_path):
+    socket_path = str(tmp_path / 'worker.sock')
+    server = _WorkerServer(socket_path, max_jobs=1)
+    try:
+        with pytest.raises(RuntimeError, match='already running'):
+            _WorkerServer(socket_path, max_jobs=1)
+        assert os.path.exists(socket_path)
+    finally:
+        server.server_close()
+
+    # the socket of a worker which did not clean up
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    _WorkerServer(socket_path, max_jobs=1).server_close()
+
+
+def test_submit(tmp_path):
+    pytest.importorskip('googleapiclient')
+    from benchmarks.fake_api import FakeApiServer
+    from mara_google_analytics_downloader.rate_limiting import configure_rate_limiter
+    from mara_google_analytics_downloader.response_cache import configure_response_cache
+    from mara_google_analytics_downloader.services import api_root_url
+
+    configure_rate_limiter()
+    configure_response_cache(None)
+    socket_path = str(tmp_path / 'worker.sock')
+    with FakeApiServer(rows=250) as fake_api:
+        server = _WorkerServer(socket_path, max_jobs=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            stream = io.StringIO()
+            job = dict(view_id='1', start_date='2020-01-01', end_date='2020-01-31', metrics='ga:sessions',
+                       dimensions='ga:date', page_size=100, shard_by='week', max_workers=2,
+                       api_root_url=fake_api.url,
+                       credentials=dict(user_account_client_id='test', user_account_client_secret='test',
+                                        user_account_refresh_token='test', token_uri=fake_api.token_uri))
+            nrows = submit(socket_path, job, stream)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # 5 weekly shards
+        assert nrows == 5 * 250
+        assert len(stream.getvalue().splitlines()) == nrows
+        assert fake_api.requests == 5 * 3
+    # the root url is only used for the job
+    assert api_root_url() is None